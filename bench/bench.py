@@ -0,0 +1,267 @@
+"""
+bench.py
+
+Benchmark harness for the Bazar.com services.
+
+It starts a topology of services locally (see topology.py), drives it with open-loop load
+(see load.py) and reports throughput, latency percentiles and error rates, overall, per
+operation and per second of the run. Results are written as JSON so that runs of different
+commits can be compared.
+
+Usage (from the repository root, with the packages of bench/requirements.txt installed):
+
+    # One scenario
+    python bench/bench.py run --topology single --rate 200 --duration 30 \\
+        --mix search=30,info=50,purchase=15,orders=5 --out single.json
+
+    # The replicated deployment without the frontend cache, losing a catalog replica halfway
+    python bench/bench.py run --topology replicated --no-cache \\
+        --fail catalog_service_2 --fail-at 15 --out failover.json
+
+    # Every predefined scenario (single, replicated and sharded, cache on and off, replica failure)
+    python bench/bench.py suite --rate 200 --duration 30 --out results.json
+
+    # Compare two result files; exits with status 1 if the second one regressed
+    python bench/bench.py compare base.json results.json --tolerance 0.1
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import load
+import topology
+
+SINGLE_MIX = 'search=30,info=50,purchase=15,orders=5'
+# The replicated frontend has no /orders
+REPLICATED_MIX = 'search=30,info=55,purchase=15'
+
+SUITE = [
+    {'name': 'single', 'topology': 'single', 'cache': True, 'mix': SINGLE_MIX},
+    {'name': 'single-no-cache', 'topology': 'single', 'cache': False, 'mix': SINGLE_MIX},
+    {'name': 'replicated', 'topology': 'replicated', 'cache': True, 'mix': REPLICATED_MIX},
+    {'name': 'replicated-no-cache', 'topology': 'replicated', 'cache': False, 'mix': REPLICATED_MIX},
+    # Purchases spread over two shard groups' primaries instead of one
+    {'name': 'sharded', 'topology': 'sharded', 'cache': True, 'mix': REPLICATED_MIX},
+    # Purchases always go to catalog replica 1 first, so losing replica 2 tests read failover
+    {'name': 'replicated-failover', 'topology': 'replicated', 'cache': True, 'mix': REPLICATED_MIX,
+     'fail': 'catalog_service_2'},
+]
+
+
+def percentile(sorted_values, p):
+    """
+    Returns the p-th percentile (nearest rank) of an ascending list, or None if it is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, duration):
+    """
+    Returns the statistics of a list of load.Sample: request and error counts, error rate,
+    throughput of successful requests per second, and latency percentiles in milliseconds.
+    """
+    latencies = sorted(s.latency for s in samples if s.ok)
+    errors = {}
+    for sample in samples:
+        if not sample.ok:
+            kind = sample.error or str(sample.status)
+            errors[kind] = errors.get(kind, 0) + 1
+    failed = sum(errors.values())
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'requests': len(samples),
+        'errors': failed,
+        'error_rate': round(failed / len(samples), 6) if samples else 0.0,
+        'error_kinds': errors,
+        'throughput': round(len(latencies) / duration, 3),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+    }
+
+
+def timeline(samples, duration):
+    # Statistics per second of the run, to see e.g. what a replica failure does over time
+    seconds = [[] for _ in range(int(duration) + 1)]
+    for sample in samples:
+        seconds[min(int(sample.at), len(seconds) - 1)].append(sample)
+    return [dict(second=i, **summarize(bucket, 1)) for i, bucket in enumerate(seconds) if bucket]
+
+
+def run_scenario(name, topology_name, mix, rate, duration, cache=True, fail=None, fail_at=None,
+                 workers=2, books=1000, timeout=10.0, max_in_flight=1000, seed=1, keep=False):
+    """
+    Starts a topology, runs one load and returns the scenario's results as a dict.
+    """
+    mix = load.parse_mix(mix)
+    setup = topology.build(topology_name, workers=workers, cache=cache, books=books, keep=keep)
+    with setup:
+        events = []
+        if fail:
+            victim = setup.service(fail)
+            fail_at = duration / 2 if fail_at is None else fail_at
+            events.append((fail_at, victim.kill))
+        print(f"[{name}] {topology_name}, cache {'on' if cache else 'off'}, {rate} req/s for {duration}s"
+              + (f", killing {fail} at {fail_at}s" if fail else ''), file=sys.stderr)
+        samples = asyncio.run(load.run(
+            setup.frontend.url, mix, rate, duration, books, timeout=timeout,
+            max_in_flight=max_in_flight, seed=seed, events=events
+        ))
+        if keep:
+            print(f"[{name}] databases and logs kept in {setup.workdir}", file=sys.stderr)
+    return {
+        'config': {
+            'topology': topology_name, 'cache': cache, 'mix': mix, 'rate': rate,
+            'duration': duration, 'workers': workers, 'books': books, 'timeout': timeout,
+            'max_in_flight': max_in_flight, 'seed': seed, 'fail': fail,
+            'fail_at': fail_at if fail else None,
+        },
+        'overall': summarize(samples, duration),
+        'operations': {op: summarize([s for s in samples if s.op == op], duration) for op in mix},
+        'timeline': timeline(samples, duration),
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=topology.ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def write_results(scenarios, out):
+    results = {'meta': metadata(), 'scenarios': scenarios}
+    text = json.dumps(results, indent=2)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    for name, result in scenarios.items():
+        overall = result['overall']
+        print(f"[{name}] {overall['throughput']} req/s, p50 {overall['p50_ms']} ms, "
+              f"p95 {overall['p95_ms']} ms, p99 {overall['p99_ms']} ms, "
+              f"errors {overall['error_rate']:.2%}", file=sys.stderr)
+
+
+def compare(base, new, tolerance, error_tolerance):
+    """
+    Returns the regressions of result dict 'new' against 'base', as human-readable lines.
+
+    Throughput may drop and latency percentiles may grow by the fraction 'tolerance' (latencies
+    also by at least 1 ms), and error rates may grow by 'error_tolerance', before they count.
+    """
+    regressions = []
+    for name, result in new['scenarios'].items():
+        if name not in base['scenarios']:
+            continue
+        old = base['scenarios'][name]
+        pairs = [('overall', old['overall'], result['overall'])]
+        pairs += [(op, old['operations'][op], stats) for op, stats in result['operations'].items()
+                  if op in old['operations']]
+        for label, before, after in pairs:
+            if after['throughput'] < before['throughput'] * (1 - tolerance):
+                regressions.append(f"{name} {label}: throughput {before['throughput']} -> {after['throughput']} req/s")
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                if before[key] is None or after[key] is None:
+                    continue
+                if after[key] > before[key] * (1 + tolerance) and after[key] - before[key] >= 1:
+                    regressions.append(f"{name} {label}: {key} {before[key]} -> {after[key]}")
+            if after['error_rate'] > before['error_rate'] + error_tolerance:
+                regressions.append(f"{name} {label}: error rate {before['error_rate']:.2%} -> {after['error_rate']:.2%}")
+    return regressions
+
+
+def add_load_arguments(parser):
+    parser.add_argument('--rate', type=float, default=200, help='requests per second (default: 200)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load (default: 30)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers per service (default: 2)')
+    parser.add_argument('--books', type=int, default=1000, help='books in the catalog (default: 1000)')
+    parser.add_argument('--timeout', type=float, default=10.0, help='request timeout in seconds (default: 10)')
+    parser.add_argument('--max-in-flight', type=int, default=1000,
+                        help='outstanding requests before arrivals are dropped (default: 1000)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the arrivals (default: 1)')
+    parser.add_argument('--keep', action='store_true', help='keep the databases and service logs')
+    parser.add_argument('--out', help='JSON results file (default: standard output)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Bazar.com services.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run one scenario')
+    run.add_argument('--name', help='scenario name in the results (default: the topology)')
+    run.add_argument('--topology', choices=['single', 'replicated', 'sharded'], default='single')
+    run.add_argument('--mix', help=f'weighted operations (default: {SINGLE_MIX}, or {REPLICATED_MIX} for part_two)')
+    run.add_argument('--no-cache', action='store_true', help="disable the frontend's cache")
+    run.add_argument('--fail', metavar='SERVICE', help='service to kill during the run, e.g. catalog_service_2')
+    run.add_argument('--fail-at', type=float, help='seconds into the run to kill it (default: halfway)')
+    add_load_arguments(run)
+
+    suite = commands.add_parser('suite', help='run every predefined scenario')
+    suite.add_argument('--only', nargs='+', choices=[s['name'] for s in SUITE], help='scenarios to run')
+    add_load_arguments(suite)
+
+    comparison = commands.add_parser('compare', help='compare two result files')
+    comparison.add_argument('base')
+    comparison.add_argument('new')
+    comparison.add_argument('--tolerance', type=float, default=0.1,
+                            help='allowed relative throughput drop / latency growth (default: 0.1)')
+    comparison.add_argument('--error-tolerance', type=float, default=0.01,
+                            help='allowed absolute error rate growth (default: 0.01)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(base, new, args.tolerance, args.error_tolerance)
+        for line in regressions:
+            print(line)
+        print(f"{len(regressions)} regression(s)")
+        return 1 if regressions else 0
+
+    common = dict(rate=args.rate, duration=args.duration, workers=args.workers, books=args.books,
+                  timeout=args.timeout, max_in_flight=args.max_in_flight, seed=args.seed, keep=args.keep)
+    if args.command == 'run':
+        mix = args.mix or (SINGLE_MIX if args.topology == 'single' else REPLICATED_MIX)
+        name = args.name or args.topology
+        scenarios = {name: run_scenario(name, args.topology, mix, cache=not args.no_cache,
+                                        fail=args.fail, fail_at=args.fail_at, **common)}
+    else:
+        scenarios = {}
+        for scenario in SUITE:
+            if args.only and scenario['name'] not in args.only:
+                continue
+            scenarios[scenario['name']] = run_scenario(
+                scenario['name'], scenario['topology'], scenario['mix'], cache=scenario['cache'],
+                fail=scenario.get('fail'), **common
+            )
+    write_results(scenarios, args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+load.py
+
+This module implements the open-loop load generator of the benchmark.
+
+Requests arrive as a Poisson process at a fixed rate, whatever the service's response times: a
+slow response does not delay the next request, as it would with a fixed number of clients
+waiting on each other (closed loop). Every request is timed from the moment it was scheduled to
+be sent, not from when it actually was, so time spent waiting for a free connection counts
+towards its latency (no "coordinated omission").
+
+Each arrival picks an operation from a weighted mix:
+- search:   GET /search/<topic>
+- info:     GET /info/<id>
+- purchase: POST /purchase/<id>
+- orders:   GET /orders?limit=50
+"""
+
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from topology import TOPICS
+
+OPERATIONS = ('search', 'info', 'purchase', 'orders')
+
+
+def parse_mix(text):
+    """
+    Parses a mix such as 'search=30,info=50,purchase=15,orders=5' into {operation: weight}.
+    """
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise ValueError(f'unknown operation {op!r}; choose from {", ".join(OPERATIONS)}')
+        mix[op] = float(weight or 1)
+    if not mix or min(mix.values()) < 0 or sum(mix.values()) <= 0:
+        raise ValueError('a mix needs at least one operation with a positive weight')
+    return mix
+
+
+class Sample:
+    """
+    The outcome of one request: when it was scheduled (seconds since the start of the run),
+    its latency in seconds, and its HTTP status or the name of the error that prevented one.
+    """
+
+    __slots__ = ('op', 'at', 'latency', 'status', 'error')
+
+    def __init__(self, op, at, latency, status=None, error=None):
+        self.op = op
+        self.at = at
+        self.latency = latency
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and self.status < 400
+
+
+def request_for(op, rng, books):
+    # (method, path) of one request of the given operation
+    if op == 'search':
+        return 'GET', f'/search/{rng.choice(TOPICS)}'
+    if op == 'info':
+        return 'GET', f'/info/{rng.randint(1, books)}'
+    if op == 'purchase':
+        return 'POST', f'/purchase/{rng.randint(1, books)}'
+    return 'GET', '/orders?limit=50'
+
+
+async def run(base_url, mix, rate, duration, books, timeout=10.0,
+              max_in_flight=1000, seed=None, events=()):
+    """
+    Sends requests to base_url at 'rate' requests per second for 'duration' seconds.
+
+    Parameters:
+        mix (dict): {operation: weight}, see parse_mix().
+        books (int): Book IDs are drawn uniformly from 1..books.
+        timeout (float): Seconds before a request counts as failed ('timeout').
+        max_in_flight (int): Arrivals while this many requests are outstanding are not sent and
+                             count as failed ('overload'), so an overloaded service cannot make
+                             the generator exhaust its file descriptors.
+        events (list): (seconds, function) pairs: each function is called once, in a thread,
+                       that many seconds into the run (e.g. to kill a replica).
+
+    Returns:
+        list: A Sample for every arrival.
+    """
+    rng = random.Random(seed)
+    ops, weights = list(mix), list(mix.values())
+    samples = []
+    loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(base_url, connector=connector, timeout=client_timeout) as session:
+
+        async def send(op, method, path, scheduled):
+            at = scheduled - start
+            try:
+                async with session.request(method, path) as resp:
+                    await resp.read()
+                samples.append(Sample(op, at, time.monotonic() - scheduled, status=resp.status))
+            except asyncio.TimeoutError:
+                samples.append(Sample(op, at, time.monotonic() - scheduled, error='timeout'))
+            except aiohttp.ClientError as e:
+                samples.append(Sample(op, at, time.monotonic() - scheduled, error=type(e).__name__))
+
+        start = time.monotonic()
+        for delay, fn in events:
+            loop.call_later(delay, loop.run_in_executor, None, fn)
+        pending = set()
+        scheduled = start
+        while True:
+            scheduled += rng.expovariate(rate)
+            if scheduled - start >= duration:
+                break
+            wait = scheduled - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            op = rng.choices(ops, weights)[0]
+            if len(pending) >= max_in_flight:
+                samples.append(Sample(op, scheduled - start, 0.0, error='overload'))
+                continue
+            method, path = request_for(op, rng, books)
+            task = asyncio.ensure_future(send(op, method, path, scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+    return samples
@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+import bench
+import load
+from load import Sample
+
+
+def test_mix_is_parsed_into_weights():
+    assert load.parse_mix('search=30, info=50,purchase') == {'search': 30.0, 'info': 50.0, 'purchase': 1.0}
+
+
+@pytest.mark.parametrize('text', ['browse=10', 'search=0', 'search=-1,info=5'])
+def test_invalid_mixes_are_rejected(text):
+    with pytest.raises(ValueError):
+        load.parse_mix(text)
+
+
+def test_requests_target_existing_books():
+    rng = random.Random(1)
+    for _ in range(100):
+        method, path = load.request_for('purchase', rng, 3)
+        assert method == 'POST' and path in ('/purchase/1', '/purchase/2', '/purchase/3')
+    assert load.request_for('orders', rng, 3) == ('GET', '/orders?limit=50')
+
+
+def test_percentile_is_the_nearest_rank():
+    values = list(range(1, 101))
+    assert bench.percentile(values, 50) == 50
+    assert bench.percentile(values, 99) == 99
+    assert bench.percentile([7], 95) == 7
+    assert bench.percentile([], 50) is None
+
+
+def test_failed_requests_are_counted_by_kind_and_left_out_of_latencies():
+    samples = [Sample('info', 0.1, 0.010, status=200), Sample('info', 0.2, 0.020, status=200),
+               Sample('info', 0.3, 5.0, status=503), Sample('info', 0.4, 9.0, error='timeout')]
+    stats = bench.summarize(samples, 2)
+    assert stats['requests'] == 4 and stats['errors'] == 2 and stats['error_rate'] == 0.5
+    assert stats['error_kinds'] == {'503': 1, 'timeout': 1}
+    assert stats['throughput'] == 1.0
+    assert (stats['p50_ms'], stats['max_ms']) == (10.0, 20.0)
+    assert bench.summarize([], 1)['p99_ms'] is None
+
+
+def test_timeline_buckets_samples_by_second():
+    samples = [Sample('info', 0.5, 0.01, status=200), Sample('info', 2.2, 0.01, status=200),
+               Sample('info', 2.9, 0.01, error='timeout'), Sample('info', 3.0, 0.01, status=200)]
+    seconds = bench.timeline(samples, 3)
+    assert [s['second'] for s in seconds] == [0, 2, 3]
+    assert [s['requests'] for s in seconds] == [1, 2, 1]
+    assert seconds[1]['errors'] == 1
+
+
+def result(throughput, p95_ms, error_rate):
+    stats = {'throughput': throughput, 'p50_ms': 1.0, 'p95_ms': p95_ms, 'p99_ms': None,
+             'error_rate': error_rate}
+    return {'scenarios': {'single': {'overall': stats, 'operations': {'info': stats}}}}
+
+
+def test_compare_reports_only_regressions_beyond_the_tolerance():
+    base = result(100, 20.0, 0.0)
+    assert bench.compare(base, result(95, 21.0, 0.001), 0.1, 0.01) == []
+    # Latencies must also grow by at least 1 ms
+    assert bench.compare(result(100, 2.0, 0.0), result(100, 2.5, 0.0), 0.1, 0.01) == []
+    regressions = bench.compare(base, result(80, 30.0, 0.05), 0.1, 0.01)
+    assert len(regressions) == 6
+    assert 'single overall: throughput 100 -> 80 req/s' in regressions
+    assert 'single info: p95_ms 20.0 -> 30.0' in regressions
+    # Scenarios missing from the base run are not compared
+    assert bench.compare({'scenarios': {}}, result(1, 100.0, 1.0), 0.1, 0.01) == []
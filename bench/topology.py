@@ -0,0 +1,253 @@
+"""
+topology.py
+
+This module starts the Bazar.com services locally for a benchmark: every service runs as a
+gunicorn subprocess in its own directory, with the shared modules of common/ on its path, exactly
+as its Docker image runs it, but listens on a free local port and keeps its SQLite database in a
+temporary directory. No Docker is needed, only the services' requirements (see requirements.txt).
+
+Three topologies are available:
+- 'single': the catalog, order and frontend services at the top of the repository.
+- 'replicated': the part_two deployment, with two catalog replicas, two order replicas and the
+  replica-aware frontend.
+- 'sharded': the same with the catalog split into two shard groups of two replicas each (see
+  common/sharding.py).
+
+Before the load starts, the catalog is seeded with a configurable number of books with plenty of
+stock, so purchases do not run out during a run. A shard group only gets the books it owns.
+"""
+
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules shared by all services, which the Docker images copy next to each service's own
+COMMON = os.path.join(ROOT, 'common')
+
+TOPICS = ['distributed systems', 'undergraduate school', 'project management', 'education', 'travel']
+
+
+def free_port():
+    """
+    Returns a TCP port that is currently free on the loopback interface.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Service:
+    """
+    One service, run as a gunicorn subprocess in its own process group.
+    """
+
+    def __init__(self, name, directory, env, probe, app=True):
+        self.name = name
+        self.directory = directory
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.env = dict(env, PORT=str(self.port))
+        self.probe = probe
+        self.app = app
+        self.process = None
+        self.log_path = None
+
+    def start(self, workdir):
+        self.log_path = os.path.join(workdir, f'{self.name}.log')
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py']
+        if self.app:
+            command.append('app:app')
+        env = dict(os.environ, **self.env)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [COMMON, os.environ.get('PYTHONPATH')]))
+        with open(self.log_path, 'wb') as log:
+            self.process = subprocess.Popen(
+                command, cwd=self.directory, env=env,
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+
+    def wait_ready(self, timeout=30):
+        """
+        Waits until the service answers its probe request.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{self.name} exited during startup:\n{self.log_tail()}')
+            try:
+                with urllib.request.urlopen(self.url + self.probe, timeout=1):
+                    return
+            except urllib.error.HTTPError as e:
+                if e.code < 500:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f'{self.name} not ready after {timeout}s:\n{self.log_tail()}')
+
+    def kill(self):
+        """
+        Simulates a crash: kills the whole process group (master and workers) at once.
+        """
+        if self.process is not None and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+    def stop(self, timeout=10):
+        if self.process is None or self.process.poll() is not None:
+            return
+        os.killpg(self.process.pid, signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+    def log_tail(self, lines=20):
+        if not self.log_path or not os.path.exists(self.log_path):
+            return ''
+        with open(self.log_path, errors='replace') as log:
+            return ''.join(log.readlines()[-lines:])
+
+
+class Topology:
+    """
+    A set of services started together, in order, and the catalog databases to seed, as
+    (database, function telling whether a book ID belongs in it, or None for all of them).
+
+    Use as a context manager: services are started on entry and stopped on exit, and the
+    temporary directory is removed unless 'keep' is set.
+    """
+
+    def __init__(self, name, workdir, services, frontend, catalog_databases, books, stock, keep=False):
+        self.name = name
+        self.workdir = workdir
+        self.services = services
+        self.frontend = frontend
+        self.catalog_databases = catalog_databases
+        self.books = books
+        self.stock = stock
+        self.keep = keep
+
+    def service(self, name):
+        for service in self.services:
+            if service.name == name:
+                return service
+        raise KeyError(f'{self.name} has no service named {name!r}; '
+                       f'choose from {[s.name for s in self.services]}')
+
+    def __enter__(self):
+        try:
+            for service in self.services:
+                service.start(self.workdir)
+                service.wait_ready()
+            for database, owns in self.catalog_databases:
+                seed(database, self.books, self.stock, owns)
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        for service in reversed(self.services):
+            service.stop()
+        if not self.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def seed(database, books, stock, owns=None):
+    """
+    Fills a catalog database with 'books' books (IDs 1..books, those for which owns(id) is true
+    if given), each with 'stock' copies.
+    """
+    with sqlite3.connect(database, timeout=30) as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO books (id, title, topic, quantity, price) VALUES (?, ?, ?, ?, ?)',
+            [(i, f'Benchmark book {i}', TOPICS[i % len(TOPICS)], stock, 10.0 + i % 90)
+             for i in range(1, books + 1) if owns is None or owns(i)]
+        )
+        conn.execute('UPDATE books SET quantity = ?', (stock,))
+    conn.close()
+
+
+def shard_owner(groups):
+    """
+    Returns the function mapping a book ID to its shard group, from common/sharding.py.
+    """
+    sys.path.insert(0, COMMON)
+    try:
+        import sharding
+    finally:
+        sys.path.pop(0)
+    return sharding.HashRing(groups).owner
+
+
+def build(name, workers=2, cache=True, books=1000, stock=10 ** 9, keep=False):
+    """
+    Describes a topology ('single', 'replicated' or 'sharded') in a new temporary directory.
+
+    Parameters:
+        workers (int): gunicorn worker processes per service.
+        cache (bool): Whether the frontend caches catalog responses.
+        books (int), stock (int): How the catalog is seeded.
+        keep (bool): Keep the temporary directory (databases and service logs) afterwards.
+    """
+    workdir = tempfile.mkdtemp(prefix=f'bazar-bench-{name}-')
+    common = {'WEB_CONCURRENCY': str(workers), 'PYTHONUNBUFFERED': '1'}
+    frontend_env = {} if cache else {'CACHE_TTL': '0', 'CACHE_NEGATIVE_TTL': '0'}
+    if name == 'single':
+        catalog_db = os.path.join(workdir, 'catalog.db')
+        catalog = Service('catalog_service', os.path.join(ROOT, 'catalog_service'),
+                          dict(common, DATABASE=catalog_db), '/info/1')
+        order = Service('order_service', os.path.join(ROOT, 'order_service'),
+                        dict(common, DATABASE=os.path.join(workdir, 'orders.db'),
+                             CATALOG_SERVICE_URL=catalog.url), '/orders?limit=1')
+        frontend = Service('frontend_service', os.path.join(ROOT, 'frontend_service'),
+                           dict(common, **frontend_env, CATALOG_SERVICE_URL=catalog.url,
+                                ORDER_SERVICE_URL=order.url), '/info/1', app=False)
+        services, catalog_dbs = [catalog, order, frontend], [(catalog_db, None)]
+    elif name in ('replicated', 'sharded'):
+        part_two = os.path.join(ROOT, 'part_two')
+        sharded = name == 'sharded'
+        # Pairs of catalog replicas: one, or one per shard group
+        groups = {}
+        for g, group in enumerate(['a', 'b'] if sharded else ['catalog']):
+            groups[group] = [Service(f'catalog_service_{2 * g + i}', os.path.join(part_two, 'catalog_service'),
+                                     {}, '/health') for i in (1, 2)]
+        catalogs = [catalog for members in groups.values() for catalog in members]
+        orders = [Service(f'order_service_{i}', os.path.join(part_two, 'order_service'), {}, '/health')
+                  for i in (1, 2)]
+        shards = {}
+        if sharded:
+            shards['CATALOG_SHARDS'] = ';'.join(f"{group}={','.join(c.url for c in members)}"
+                                                for group, members in groups.items())
+            owner = shard_owner(list(groups))
+        catalog_dbs = []
+        for group, members in groups.items():
+            owns = (lambda book_id, group=group: owner(book_id) == group) if sharded else None
+            for i, catalog in enumerate(members):
+                database = os.path.join(workdir, f'{catalog.name}.db')
+                catalog_dbs.append((database, owns))
+                catalog.env.update(common, **shards, DATABASE=database, REPLICA=members[1 - i].url,
+                                   REPLICA_NAME=catalog.name)
+                if sharded:
+                    catalog.env['SHARD_NAME'] = group
+        for i, order in enumerate(orders):
+            order.env.update(common, **shards, DATABASE=os.path.join(workdir, f'{order.name}.db'),
+                             ORDER_REPLICA=orders[1 - i].url,
+                             CATALOG_REPLICA_1=catalogs[0].url, CATALOG_REPLICA_2=catalogs[1].url)
+        frontend = Service('frontend_service', os.path.join(part_two, 'frontend_service'),
+                           dict(common, **frontend_env, **shards,
+                                CATALOG_REPLICAS=','.join(c.url for c in catalogs[:2]),
+                                ORDER_REPLICAS=','.join(o.url for o in orders)), '/replicas')
+        services = catalogs + orders + [frontend]
+    else:
+        raise ValueError(f'unknown topology {name!r}')
+    return Topology(name, workdir, services, frontend, catalog_dbs, books, stock, keep)
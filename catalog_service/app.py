@@ -3,63 +3,140 @@ catalog_service.py
 
 This module implements the Catalog Service for Bazar.com, an online bookstore.
 It handles search, info, and update operations on the book catalog.
-It also includes a background thread that periodically restocks items.
+It also includes a background thread that restocks books whose stock is low (see restock.py).
+Other services may ask for MessagePack instead of JSON responses (see codec.py).
+
+Environment Variables:
+- SEARCH_INDEX: 'memory' to answer searches from the in-process index in search_index.py,
+                'sqlite' to query the database for every search. Defaults to 'memory'.
 """
 
-from flask import Flask, jsonify, request
-import sqlite3
-from database import init_db
+from flask import Flask, Response, jsonify, request
+from database import init_db, DATABASE
+from search_index import CatalogIndex
+from restock import RestockScheduler
+import codec
+import db_pool
+import metrics
+import tracing
+import os
 import threading
 import time
-import logging
 
 app = Flask(__name__)
-DATABASE = 'catalog.db'
+metrics.instrument_flask(app)
+tracing.instrument_flask(app)
+codec.install(app)
+
+# Upper bound on the number of books in one batch request; keeps every query well below
+# SQLite's limit on bound parameters
+MAX_BATCH_ITEMS = 500
+
+# Page sizes of searches: title searches are always paginated, topic searches only on request
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# Seconds a released stock lease is remembered (see /leases)
+LEASES_RETAIN = 24 * 60 * 60
 
-# Create a lock object to ensure thread safety during database operations
-db_lock = threading.Lock()
+SEARCH_INDEX = os.environ.get('SEARCH_INDEX', 'memory')
+index = CatalogIndex(DATABASE) if SEARCH_INDEX == 'memory' else None
 
-def restock_items():
+restocker = RestockScheduler(DATABASE)
+
+def parse_page(default_limit=None):
     """
-    Background thread function that periodically increases the quantity of each book.
+    Parses the pagination parameters of a search request.
+
+    'limit' is the maximum number of books per page (at most MAX_PAGE_SIZE) and 'cursor' is the
+    value of the X-Next-Cursor header of the previous page; a page holds the books after it.
+
+    Parameters:
+        default_limit (int): The page size if 'limit' is not given; None for no limit.
 
-    This function runs in an infinite loop, sleeping for a specified interval (default is 60 seconds),
-    and then increments the quantity of all books in the catalog by 5.
-    It uses a threading lock to ensure thread safety during database operations.
+    Returns:
+        tuple: (cursor, limit), or None if either parameter is invalid.
+    """
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = request.args.get('limit', default_limit)
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        return None
+    if cursor < 0 or (limit is not None and not 0 < limit <= MAX_PAGE_SIZE):
+        return None
+    return cursor, limit
+
+def search_page(books, limit):
     """
-    while True:
-        time.sleep(60)  # Restock every 60 seconds
-        with db_lock:
-            try:
-                conn = sqlite3.connect(DATABASE)
-                cursor = conn.cursor()
-                # Increase the quantity of each book by 5
-                cursor.execute('UPDATE books SET quantity = quantity + 5')
-                conn.commit()
-                conn.close()
-                logging.info("Stock updated: Each item's quantity increased by 5.")
-            except Exception as e:
-                logging.info(f"Error in restocking items: {e}")
+    Builds the response for one page of search results.
+
+    Books are returned in ID order. When the page is full, the X-Next-Cursor header holds the
+    cursor of the next page (the last ID on this one); its absence means there are no more pages.
+    """
+    response = jsonify(books)
+    if limit is not None and len(books) == limit:
+        response.headers['X-Next-Cursor'] = str(books[-1]['id'])
+    return response
 
 @app.route('/search/<topic>', methods=['GET'])
 def search(topic):
     """
-    Handles GET requests to /search/<topic>.
+    Handles GET requests to /search/<topic>?limit=<n>&cursor=<cursor>.
 
-    Queries the catalog database for books matching the given topic and returns a list of books.
+    Returns the books on the given topic, from the in-process index or, with SEARCH_INDEX=sqlite,
+    from the topic index of the database. Without 'limit' all of them are returned.
 
     Parameters:
         topic (str): The topic to search for.
 
     Returns:
-        Response: A JSON response containing a list of books with their IDs and titles.
+        Response: A JSON response containing a list of books with their IDs and titles
+                  (see search_page() for pagination), or an error message with a 400 status
+                  code if 'limit' or 'cursor' is invalid.
     """
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, title FROM books WHERE topic=?', (topic,))
-    books = [{'id': row[0], 'title': row[1]} for row in cursor.fetchall()]
-    conn.close()
-    return jsonify(books)
+    page = parse_page()
+    if page is None:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}, cursor a cursor returned by this endpoint'}), 400
+    cursor, limit = page
+    if index is not None:
+        rows = index.search_topic(topic, cursor, limit)
+    else:
+        with db_pool.connection(DATABASE) as conn:
+            rows = conn.execute(
+                'SELECT id, title FROM books WHERE topic=? AND id > ? ORDER BY id LIMIT ?',
+                (topic, cursor, -1 if limit is None else limit)
+            ).fetchall()
+    return search_page([{'id': row[0], 'title': row[1]} for row in rows], limit)
+
+@app.route('/search', methods=['GET'])
+def search_title():
+    """
+    Handles GET requests to /search?q=<text>&limit=<n>&cursor=<cursor>.
+
+    Returns the books whose title contains the given text, ignoring case, DEFAULT_PAGE_SIZE
+    books per page unless 'limit' says otherwise.
+
+    Returns:
+        Response: A JSON response containing a list of books with their IDs, titles and topics
+                  (see search_page() for pagination), or an error message with a 400 status
+                  code if 'q' is missing or 'limit' or 'cursor' is invalid.
+    """
+    query = request.args.get('q', '').strip()
+    page = parse_page(DEFAULT_PAGE_SIZE)
+    if not query or page is None:
+        return jsonify({'error': f'q is required, limit must be between 1 and {MAX_PAGE_SIZE}, cursor a cursor returned by this endpoint'}), 400
+    cursor, limit = page
+    if index is not None:
+        rows = index.search_title(query, cursor, limit)
+    else:
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        with db_pool.connection(DATABASE) as conn:
+            rows = conn.execute(
+                "SELECT id, title, topic FROM books WHERE title LIKE ? ESCAPE '\\' AND id > ? ORDER BY id LIMIT ?",
+                (pattern, cursor, limit)
+            ).fetchall()
+    return search_page([{'id': row[0], 'title': row[1], 'topic': row[2]} for row in rows], limit)
 
 @app.route('/info/<int:item_id>', methods=['GET'])
 def info(item_id):
@@ -75,16 +152,83 @@ def info(item_id):
         Response: A JSON response containing the book's details,
                   or an error message with a 404 status code if not found.
     """
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT title, quantity, price FROM books WHERE id=?', (item_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with db_pool.connection(DATABASE) as conn:
+        row = conn.execute('SELECT title, quantity, price FROM books WHERE id=?', (item_id,)).fetchone()
     if row:
         return jsonify({'title': row[0], 'quantity': row[1], 'price': row[2]})
     else:
         return jsonify({'error': 'Item not found'}), 404
 
+def parse_ids(raw):
+    """
+    Parses a comma separated list of book IDs, e.g. the 'ids' query parameter.
+
+    Parameters:
+        raw (str): The list to parse, e.g. '1,2,3'.
+
+    Returns:
+        list: The distinct IDs in request order, or None if the list is empty, malformed
+              or longer than MAX_BATCH_ITEMS.
+    """
+    try:
+        ids = list(dict.fromkeys(int(part) for part in raw.split(',')))
+    except ValueError:
+        return None
+    if not ids or len(ids) > MAX_BATCH_ITEMS:
+        return None
+    return ids
+
+@app.route('/info', methods=['GET'])
+def info_batch():
+    """
+    Handles GET requests to /info?ids=<id>,<id>,...
+
+    Retrieves the details of several books with a single query.
+
+    Returns:
+        Response: A JSON response of the form {"items": {"<id>": {...}}, "missing": [<id>, ...]},
+                  where every item has the same fields as /info/<item_id> and 'missing' lists
+                  the requested IDs that do not exist, or an error message with a 400 status
+                  code if 'ids' is invalid.
+    """
+    ids = parse_ids(request.args.get('ids', ''))
+    if ids is None:
+        return jsonify({'error': f'ids must be a comma separated list of at most {MAX_BATCH_ITEMS} book IDs'}), 400
+    placeholders = ','.join('?' * len(ids))
+    with db_pool.connection(DATABASE) as conn:
+        rows = conn.execute(
+            f'SELECT id, title, quantity, price FROM books WHERE id IN ({placeholders})', ids
+        ).fetchall()
+    found = {row[0]: {'title': row[1], 'quantity': row[2], 'price': row[3]} for row in rows}
+    return jsonify({
+        'items': {str(item_id): found[item_id] for item_id in ids if item_id in found},
+        'missing': [item_id for item_id in ids if item_id not in found]
+    })
+
+@app.route('/books', methods=['GET'])
+def list_books():
+    """
+    Handles GET requests to /books?limit=<n>&cursor=<cursor>.
+
+    Dumps the catalog in ID order, DEFAULT_PAGE_SIZE books per page unless 'limit' says
+    otherwise, e.g. for the frontend to warm up its cache.
+
+    Returns:
+        Response: A JSON response containing a list of books with their IDs and the same fields
+                  as /info/<item_id> (see search_page() for pagination), or an error message
+                  with a 400 status code if 'limit' or 'cursor' is invalid.
+    """
+    page = parse_page(DEFAULT_PAGE_SIZE)
+    if page is None:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}, cursor a cursor returned by this endpoint'}), 400
+    cursor, limit = page
+    with db_pool.connection(DATABASE) as conn:
+        rows = conn.execute(
+            'SELECT id, title, quantity, price FROM books WHERE id > ? ORDER BY id LIMIT ?', (cursor, limit)
+        ).fetchall()
+    return search_page([{'id': row[0], 'title': row[1], 'quantity': row[2], 'price': row[3]} for row in rows],
+                       limit)
+
 @app.route('/update/<int:item_id>', methods=['PUT'])
 def update(item_id):
     """
@@ -101,18 +245,319 @@ def update(item_id):
         Response: A JSON response indicating the result of the operation.
     """
     data = request.get_json()
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    if 'quantity' in data:
-        cursor.execute('UPDATE books SET quantity=? WHERE id=?', (data['quantity'], item_id))
-    if 'price' in data:
-        cursor.execute('UPDATE books SET price=? WHERE id=?', (data['price'], item_id))
-    conn.commit()
-    conn.close()
+    with db_pool.connection(DATABASE) as conn:
+        if 'quantity' in data:
+            conn.execute('UPDATE books SET quantity=? WHERE id=?', (data['quantity'], item_id))
+        if 'price' in data:
+            conn.execute('UPDATE books SET price=? WHERE id=?', (data['price'], item_id))
     return jsonify({'message': 'Item updated'})
 
-if __name__ == '__main__':
+@app.route('/decrement/<int:item_id>', methods=['PUT'])
+def decrement(item_id):
+    """
+    Handles PUT requests to /decrement/<item_id>?n=<count>.
+
+    Atomically removes 'n' copies (default 1) of a book from stock. The stock check and the
+    decrement happen in a single conditional UPDATE, so concurrent buyers can never drive the
+    quantity below zero and no decrement is lost.
+
+    Parameters:
+        item_id (int): The ID of the book to decrement.
+
+    Returns:
+        Response: A JSON response containing the remaining quantity,
+                  an error message with a 400 status code if 'n' is invalid,
+                  a 404 status code if the book does not exist,
+                  or a 409 status code if there is not enough stock.
+    """
+    try:
+        n = int(request.args.get('n', 1))
+    except ValueError:
+        n = 0
+    if n <= 0:
+        return jsonify({'error': 'n must be a positive integer'}), 400
+    with db_pool.connection(DATABASE) as conn:
+        row = conn.execute(
+            'UPDATE books SET quantity = quantity - ? WHERE id = ? AND quantity >= ? RETURNING quantity',
+            (n, item_id, n)
+        ).fetchone()
+        if row is None:
+            # Nothing was updated: tell the caller whether the book is missing or just sold out
+            existing = conn.execute('SELECT quantity FROM books WHERE id=?', (item_id,)).fetchone()
+    if row is None:
+        if existing is None:
+            return jsonify({'error': 'Item not found'}), 404
+        return jsonify({'error': 'Item out of stock', 'quantity': existing[0]}), 409
+    return jsonify({'message': 'Item decremented', 'quantity': row[0]})
+
+@app.route('/decrement', methods=['PUT'])
+def decrement_batch():
+    """
+    Handles PUT requests to /decrement with a JSON payload {"items": {"<item_id>": <count>, ...}}.
+
+    Removes stock for several books in one transaction. Every decrement is the same conditional
+    UPDATE as in /decrement/<item_id>; if any of them fails, the whole transaction is rolled
+    back, so either every book is decremented or none is.
+
+    Returns:
+        Response: A JSON response containing the remaining quantity of every book,
+                  an error message with a 400 status code if the payload is invalid,
+                  a 404 status code if a book does not exist,
+                  or a 409 status code if a book does not have enough stock.
+                  Errors name the offending book in 'item_id'.
+    """
+    data = request.get_json(silent=True)
+    try:
+        items = {int(item_id): n for item_id, n in data['items'].items()}
+    except (AttributeError, KeyError, TypeError, ValueError):
+        items = {}
+    # JSON true is an int to Python, and would count as one copy
+    if not items or len(items) > MAX_BATCH_ITEMS or not all(
+            isinstance(n, int) and not isinstance(n, bool) and n > 0 for n in items.values()):
+        return jsonify({'error': f'items must map at most {MAX_BATCH_ITEMS} book IDs to positive counts'}), 400
+    quantities = {}
+    with db_pool.connection(DATABASE) as conn:
+        for item_id, n in items.items():
+            row = conn.execute(
+                'UPDATE books SET quantity = quantity - ? WHERE id = ? AND quantity >= ? RETURNING quantity',
+                (n, item_id, n)
+            ).fetchone()
+            if row is None:
+                existing = conn.execute('SELECT quantity FROM books WHERE id=?', (item_id,)).fetchone()
+                conn.rollback()
+                if existing is None:
+                    return jsonify({'error': 'Item not found', 'item_id': item_id}), 404
+                return jsonify({'error': 'Item out of stock', 'item_id': item_id, 'quantity': existing[0]}), 409
+            quantities[str(item_id)] = row[0]
+    return jsonify({'message': 'Items decremented', 'quantities': quantities})
+
+@app.route('/leases', methods=['POST'])
+def lease_stock():
+    """
+    Handles POST requests to /leases with a JSON payload {"id": "<lease_id>", "item_id": <id>, "n": <count>}.
+
+    Leases up to 'n' copies of a book to the Order Service, which sells them without calling
+    this service again and returns the unsold ones through DELETE /leases/<lease_id>. Fewer than
+    'n' copies are leased if fewer are in stock. The copies are taken out of stock and the lease
+    is recorded in one transaction, which holds the write lock from the start, so concurrent
+    purchases can never drive the quantity below zero. The caller chooses the lease ID, so a
+    repeated request for a lease that is still outstanding returns the same lease and takes no
+    more stock.
+
+    Returns:
+        Response: A JSON response containing the lease ('granted' copies) and the remaining quantity,
+                  an error message with a 400 status code if the payload is invalid,
+                  a 404 status code if the book does not exist,
+                  or a 409 status code if the book is out of stock or the lease was already released.
+    """
+    data = request.get_json(silent=True)
+    try:
+        lease_id, item_id, n = data['id'], data['item_id'], data['n']
+    except (KeyError, TypeError):
+        lease_id = item_id = n = None
+    # JSON true is an int to Python, and would lease one copy; int() would also take "3" and 2.5
+    if not (isinstance(lease_id, str) and lease_id
+            and isinstance(item_id, int) and not isinstance(item_id, bool)
+            and isinstance(n, int) and not isinstance(n, bool) and n > 0):
+        return jsonify({'error': 'id, item_id and a positive n are required'}), 400
+    with db_pool.connection(DATABASE) as conn:
+        # Take the write lock up front: the stock read here is what the lease is cut from
+        conn.execute('BEGIN IMMEDIATE')
+        lease = conn.execute(
+            'SELECT book_id, granted, returned FROM stock_leases WHERE lease_id = ?', (lease_id,)
+        ).fetchone()
+        if lease is not None:
+            item_id, granted = lease[0], lease[1]
+        row = conn.execute('SELECT quantity FROM books WHERE id=?', (item_id,)).fetchone()
+        if lease is None and row is not None and row[0] > 0:
+            granted = min(n, row[0])
+            row = conn.execute(
+                'UPDATE books SET quantity = quantity - ? WHERE id = ? RETURNING quantity', (granted, item_id)
+            ).fetchone()
+            conn.execute('INSERT INTO stock_leases (lease_id, book_id, granted, time) VALUES (?, ?, ?, ?)',
+                         (lease_id, item_id, granted, time.time()))
+            lease = (item_id, granted, None)
+    if lease is None:
+        if row is None:
+            return jsonify({'error': 'Item not found'}), 404
+        return jsonify({'error': 'Item out of stock', 'quantity': row[0]}), 409
+    if lease[2] is not None:
+        return jsonify({'error': 'Lease already released', 'id': lease_id}), 409
+    return jsonify({'id': lease_id, 'item_id': item_id, 'granted': granted,
+                    'quantity': row[0] if row else 0})
+
+@app.route('/leases/<lease_id>', methods=['DELETE'])
+def release_stock(lease_id):
+    """
+    Handles DELETE requests to /leases/<lease_id>?sold=<count>.
+
+    Ends a lease: the copies of it that were not sold go back into stock. Releasing a lease
+    that was already released returns nothing more, and releasing one this service never granted
+    records it as released, so that a late request for it leases nothing.
+
+    Returns:
+        Response: A JSON response containing the number of copies 'returned' by this request,
+                  or an error message with a 400 status code if 'sold' is invalid or more than
+                  the lease granted.
+    """
+    try:
+        sold = int(request.args.get('sold', 0))
+    except ValueError:
+        sold = -1
+    if sold < 0:
+        return jsonify({'error': 'sold must be a non-negative integer'}), 400
+    now = time.time()
+    with db_pool.connection(DATABASE) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        lease = conn.execute(
+            'SELECT book_id, granted, returned FROM stock_leases WHERE lease_id = ?', (lease_id,)
+        ).fetchone()
+        if lease is None:
+            conn.execute('INSERT INTO stock_leases (lease_id, granted, returned, time) VALUES (?, 0, 0, ?)',
+                         (lease_id, now))
+            return jsonify({'id': lease_id, 'returned': 0})
+        if lease[2] is not None:
+            return jsonify({'id': lease_id, 'returned': 0})
+        book_id, granted = lease[0], lease[1]
+        if sold > granted:
+            conn.rollback()
+            return jsonify({'error': f'sold must be at most the {granted} copies leased'}), 400
+        conn.execute('UPDATE books SET quantity = quantity + ? WHERE id = ?', (granted - sold, book_id))
+        conn.execute('UPDATE stock_leases SET returned = ?, time = ? WHERE lease_id = ?',
+                     (granted - sold, now, lease_id))
+        conn.execute('DELETE FROM stock_leases WHERE returned IS NOT NULL AND time < ?', (now - LEASES_RETAIN,))
+    return jsonify({'id': lease_id, 'returned': granted - sold})
+
+@app.route('/restock/events', methods=['GET'])
+def restock_events():
+    """
+    Handles GET requests to /restock/events?limit=<n>&cursor=<cursor>.
+
+    Returns the restocks logged after 'cursor', oldest first, so that caches can invalidate
+    what they hold about the restocked books. Each event has a sequence number ('seq'), the
+    book's ID ('id'), the number of copies added and the resulting quantity, and the time of
+    the restock (seconds since the epoch). When the page is full, the X-Next-Cursor header holds
+    the cursor of the next page (the last 'seq' on this one).
+
+    Returns:
+        Response: A JSON response containing a list of events,
+                  or an error message with a 400 status code if 'limit' or 'cursor' is invalid.
+    """
+    page = parse_page(MAX_PAGE_SIZE)
+    if page is None:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}, cursor a cursor returned by this endpoint'}), 400
+    cursor, limit = page
+    events = restocker.events(cursor, limit)
+    response = jsonify(events)
+    if len(events) == limit:
+        response.headers['X-Next-Cursor'] = str(events[-1]['seq'])
+    return response
+
+@app.route('/restock/policies/<int:item_id>', methods=['GET'])
+def get_restock_policy(item_id):
+    """
+    Handles GET requests to /restock/policies/<item_id>.
+
+    Returns the restock policy of a book: 'threshold', 'target' and 'interval', and whether it
+    is the default policy.
+
+    Parameters:
+        item_id (int): The ID of the book.
+
+    Returns:
+        Response: A JSON response containing the policy.
+    """
+    return jsonify(restocker.policy(item_id))
+
+@app.route('/restock/policies/<int:item_id>', methods=['PUT'])
+def set_restock_policy(item_id):
+    """
+    Handles PUT requests to /restock/policies/<item_id>.
+
+    Gives a book its own restock policy. Expects a JSON payload with 'threshold' (the book is
+    restocked when its quantity falls below it), 'target' (the quantity it is restocked to) and
+    'interval' (the minimum number of seconds between two restocks).
+
+    Parameters:
+        item_id (int): The ID of the book.
+
+    Returns:
+        Response: A JSON response containing the new policy,
+                  an error message with a 400 status code if the payload is invalid,
+                  or a 404 status code if the book does not exist.
+    """
+    data = request.get_json(silent=True)
+    try:
+        threshold, target = int(data['threshold']), int(data['target'])
+        interval = float(data['interval'])
+    except (KeyError, TypeError, ValueError):
+        threshold = None
+    if threshold is None or not 0 <= threshold <= target or interval < 0:
+        return jsonify({'error': 'threshold, target and interval are required, with 0 <= threshold <= target and interval >= 0'}), 400
+    with db_pool.connection(DATABASE) as conn:
+        exists = conn.execute('SELECT 1 FROM books WHERE id=?', (item_id,)).fetchone()
+    if exists is None:
+        return jsonify({'error': 'Item not found'}), 404
+    restocker.set_policy(item_id, threshold, target, interval)
+    return jsonify(restocker.policy(item_id))
+
+@app.route('/restock/policies/<int:item_id>', methods=['DELETE'])
+def reset_restock_policy(item_id):
+    """
+    Handles DELETE requests to /restock/policies/<item_id>.
+
+    Makes a book use the default restock policy again.
+
+    Parameters:
+        item_id (int): The ID of the book.
+
+    Returns:
+        Response: A JSON response containing the default policy.
+    """
+    restocker.reset_policy(item_id)
+    return jsonify(restocker.policy(item_id))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Handles GET requests to /metrics.
+
+    Returns the metrics of every worker process of the service (request counts and latencies
+    per route, database and connection pool timings, ...) in the Prometheus text format.
+
+    Returns:
+        Response: The metrics as text/plain.
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+def setup():
+    """
+    One-time initialisation of the catalog database.
+
+    Runs once per start of the service, before any worker process serves requests.
+    """
     init_db()
+
+def start_worker_tasks():
+    """
+    Prepares a process that serves requests: loads the search index.
+    """
+    if index is not None:
+        index.load()
+
+def start_background_tasks():
+    """
+    Starts the background work that must run in exactly one process.
+
+    Under gunicorn only the worker holding the leader lock calls this (see gunicorn.conf.py),
+    so each book is restocked once no matter how many workers there are.
+    """
     # Start the restocking thread
-    threading.Thread(target=restock_items, daemon=True).start()
+    threading.Thread(target=restocker.run, daemon=True).start()
+
+if __name__ == '__main__':
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
+    setup()
+    start_worker_tasks()
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -2,17 +2,32 @@
 database.py
 
 This module provides a function to initialize the catalog database for Bazar.com.
-It creates the 'books' table if it doesn't exist and seeds it with initial data.
+It creates the 'books' table if it doesn't exist, migrates its schema (secondary indexes, the
+change log used by the in-process search index, the tables of the restock scheduler and the
+stock leases of the Order Service) and seeds it with initial data.
+
+Environment Variables:
+- DATABASE: Specifies the filename for the catalog database. Defaults to 'catalog.db' if not set.
 """
 
+import os
 import sqlite3
 
+DATABASE = os.environ.get('DATABASE', 'catalog.db')
+
 def init_db():
     """
     Initializes the catalog database.
 
-    - Connects to the 'catalog.db' SQLite database.
+    - Connects to the SQLite database specified by DATABASE.
     - Creates the 'books' table if it doesn't exist.
+    - Adds the index on 'topic' used by /search/<topic>.
+    - Adds the 'book_changes' log and the triggers that record every insert, delete and
+      title or topic change of a book in it (see search_index.py).
+    - Adds the index on 'quantity' and the 'restock_policies' and 'restock_events' tables used
+      by the restock scheduler (see restock.py).
+    - Adds the 'stock_leases' table, which records the blocks of stock leased to the Order Service
+      and what was returned of them.
     - Seeds initial data into the 'books' table if it's empty.
 
     The 'books' table has the following schema:
@@ -24,7 +39,7 @@ def init_db():
 
     Initial data seeded includes four books with predefined details.
     """
-    conn = sqlite3.connect('catalog.db')
+    conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS books (
@@ -35,6 +50,59 @@ def init_db():
             price REAL
         )
     ''')
+    # Topic searches are answered from this index (in ID order, for pagination) instead of
+    # scanning the table
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_topic ON books(topic, id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS books_insert_log AFTER INSERT ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (NEW.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_update_log AFTER UPDATE OF id, title, topic ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (OLD.id);
+            INSERT INTO book_changes (book_id) SELECT NEW.id WHERE NEW.id != OLD.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_delete_log AFTER DELETE ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (OLD.id);
+        END;
+    ''')
+    # The restock scheduler only looks at books whose stock is low
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_quantity ON books(quantity)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS restock_policies (
+            book_id INTEGER PRIMARY KEY,
+            threshold INTEGER NOT NULL,
+            target INTEGER NOT NULL,
+            interval REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS restock_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            added INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            time REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_restock_events_book ON restock_events(book_id, time)')
+    # 'returned' is NULL while a lease is outstanding; released leases are kept for a while so
+    # that a repeated (or late) request for the same lease changes nothing
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_leases (
+            lease_id TEXT PRIMARY KEY,
+            book_id INTEGER,
+            granted INTEGER NOT NULL,
+            returned INTEGER,
+            time REAL NOT NULL
+        )
+    ''')
+    conn.commit()
     # Seed initial data if table is empty
     cursor.execute('SELECT COUNT(*) FROM books')
     if cursor.fetchone()[0] == 0:
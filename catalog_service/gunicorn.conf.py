@@ -0,0 +1,81 @@
+"""
+gunicorn.conf.py
+
+Production serving configuration for the Catalog Service:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The service runs as several worker processes, each handling requests on a pool of threads.
+The database is initialised once, in the master process, before any worker is forked; every
+worker then loads its own search index. The restocking thread must run exactly once, so the
+workers compete for an exclusive lock on a file next to the database: the worker holding it
+runs the background tasks, the others wait in a background thread and take over if that
+worker exits. On SIGTERM, workers stop accepting connections and finish their in-flight
+requests for up to GRACEFUL_TIMEOUT seconds.
+
+Environment Variables:
+- PORT: Port to listen on. Defaults to 5001.
+- WEB_CONCURRENCY: Number of worker processes. Defaults to the number of CPUs.
+- THREADS: Request threads per worker process. Defaults to 8.
+- GRACEFUL_TIMEOUT: Seconds to finish in-flight requests on shutdown. Defaults to 30.
+- METRICS_DIR: Directory the workers share their metrics through.
+               Defaults to a new temporary directory.
+- LEADER_LOCK: Lock file that elects the worker running background tasks.
+               Defaults to the database path plus '.leader'.
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+# Workers share their metrics through snapshot files in this directory (see metrics.py)
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='bazar-metrics-'))
+
+LEADER_LOCK = os.environ.get(
+    'LEADER_LOCK', os.path.abspath(os.environ.get('DATABASE', 'catalog.db')) + '.leader'
+)
+
+
+def on_starting(server):
+    import app
+    import metrics
+    metrics.clear()
+    import db_pool
+    app.setup()
+    # Workers open their own connections; don't keep the master's around
+    db_pool.get_pool(app.DATABASE).close()
+
+
+def post_worker_init(worker):
+    import metrics
+    metrics.start()
+    import app
+    app.start_worker_tasks()
+    threading.Thread(target=_lead, args=(worker,), daemon=True).start()
+
+
+def _lead(worker):
+    # Blocks until no other worker holds the lock. The descriptor is never closed,
+    # so the lock is held until this worker exits.
+    fd = os.open(LEADER_LOCK, os.O_CREAT | os.O_RDWR, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    worker.log.info(f"Worker {worker.pid} runs the background tasks")
+    import app
+    app.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    import app
+    import db_pool
+    import metrics
+    metrics.flush()
+    db_pool.get_pool(app.DATABASE).close()
@@ -0,0 +1,166 @@
+"""
+restock.py
+
+This module implements the restock scheduler of the Catalog Service.
+
+Every book has a restock policy: when its quantity falls below 'threshold', it is brought back
+up to 'target', but at most once every 'interval' seconds. Books without a row in the
+'restock_policies' table use the default policy from the environment.
+
+Every RESTOCK_CHECK_INTERVAL seconds the scheduler looks up the books below their threshold
+(through the index on 'quantity', so the check costs little when stock is plentiful) and
+restocks the ones that are due in transactions of at most RESTOCK_CHUNK_SIZE books, so request
+handlers never wait behind one long write. Books that are not low are never written.
+
+Every restock is recorded in the 'restock_events' log, which clients such as the frontend's
+cache read through /restock/events to invalidate what they cached about the restocked books.
+
+Environment Variables:
+- RESTOCK_THRESHOLD: Default quantity below which a book is restocked. Defaults to 5.
+- RESTOCK_TARGET: Default quantity a book is restocked to. Defaults to 10.
+- RESTOCK_INTERVAL: Default minimum seconds between two restocks of a book. Defaults to 60.
+- RESTOCK_CHECK_INTERVAL: Seconds between checks for books to restock. Defaults to 5.
+- RESTOCK_CHUNK_SIZE: Books restocked per transaction. Defaults to 100.
+- RESTOCK_EVENTS_RETAIN: Number of entries kept in the 'restock_events' log. Defaults to 10000.
+"""
+
+import logging
+import os
+import time
+
+import db_pool
+
+DEFAULT_THRESHOLD = int(os.environ.get('RESTOCK_THRESHOLD', 5))
+DEFAULT_TARGET = int(os.environ.get('RESTOCK_TARGET', 10))
+DEFAULT_INTERVAL = float(os.environ.get('RESTOCK_INTERVAL', 60))
+CHECK_INTERVAL = float(os.environ.get('RESTOCK_CHECK_INTERVAL', 5))
+CHUNK_SIZE = int(os.environ.get('RESTOCK_CHUNK_SIZE', 100))
+EVENTS_RETAIN = int(os.environ.get('RESTOCK_EVENTS_RETAIN', 10000))
+
+
+class RestockScheduler:
+    """
+    Restocks the low books of one database according to their policies.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def run(self):
+        """
+        Checks for books to restock every CHECK_INTERVAL seconds, forever.
+        """
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            try:
+                restocked = self.restock_due()
+                if restocked:
+                    logging.info(f"Restocked {restocked} books.")
+            except Exception as e:
+                logging.info(f"Error in restocking items: {e}")
+
+    def due(self, now=None):
+        """
+        Returns [(id, threshold, target), ...] of the books below their threshold whose last
+        restock is older than their interval.
+        """
+        now = time.time() if now is None else now
+        with db_pool.connection(self.database) as conn:
+            # No policy has a higher threshold than this, so only books below it can be low
+            highest = conn.execute(
+                'SELECT MAX(threshold) FROM restock_policies'
+            ).fetchone()[0]
+            highest = max(DEFAULT_THRESHOLD, highest or 0)
+            return conn.execute('''
+                SELECT b.id, COALESCE(p.threshold, :threshold), COALESCE(p.target, :target)
+                FROM books b LEFT JOIN restock_policies p ON p.book_id = b.id
+                WHERE b.quantity < :highest
+                  AND b.quantity < COALESCE(p.threshold, :threshold)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM restock_events e
+                      WHERE e.book_id = b.id AND e.time > :now - COALESCE(p.interval, :interval)
+                  )
+                ORDER BY b.id
+            ''', {'threshold': DEFAULT_THRESHOLD, 'target': DEFAULT_TARGET,
+                  'interval': DEFAULT_INTERVAL, 'highest': highest, 'now': now}).fetchall()
+
+    def restock_due(self):
+        """
+        Restocks every book that is due, CHUNK_SIZE books per transaction.
+
+        Returns:
+            int: The number of books restocked.
+        """
+        books = self.due()
+        restocked = 0
+        for start in range(0, len(books), CHUNK_SIZE):
+            restocked += self._restock(books[start:start + CHUNK_SIZE])
+        if restocked:
+            with db_pool.connection(self.database) as conn:
+                conn.execute(
+                    'DELETE FROM restock_events WHERE seq <= (SELECT MAX(seq) FROM restock_events) - ?',
+                    (EVENTS_RETAIN,)
+                )
+        return restocked
+
+    def _restock(self, books):
+        restocked = 0
+        now = time.time()
+        with db_pool.connection(self.database) as conn:
+            # Take the write lock up front: a purchase since due() must not be overwritten
+            conn.execute('BEGIN IMMEDIATE')
+            for book_id, threshold, target in books:
+                row = conn.execute('SELECT quantity FROM books WHERE id = ?', (book_id,)).fetchone()
+                if row is None or row[0] >= threshold:
+                    continue
+                conn.execute('UPDATE books SET quantity = ? WHERE id = ?', (target, book_id))
+                conn.execute(
+                    'INSERT INTO restock_events (book_id, added, quantity, time) VALUES (?, ?, ?, ?)',
+                    (book_id, target - row[0], target, now)
+                )
+                restocked += 1
+        return restocked
+
+    def events(self, cursor=0, limit=None):
+        """
+        Returns the restock events logged after 'cursor', oldest first.
+        """
+        with db_pool.connection(self.database) as conn:
+            rows = conn.execute(
+                'SELECT seq, book_id, added, quantity, time FROM restock_events WHERE seq > ? '
+                'ORDER BY seq LIMIT ?',
+                (cursor, -1 if limit is None else limit)
+            ).fetchall()
+        return [{'seq': seq, 'id': book_id, 'added': added, 'quantity': quantity, 'time': at}
+                for seq, book_id, added, quantity, at in rows]
+
+    def policy(self, book_id):
+        """
+        Returns the restock policy of a book: its own, or the default one.
+        """
+        with db_pool.connection(self.database) as conn:
+            row = conn.execute(
+                'SELECT threshold, target, interval FROM restock_policies WHERE book_id = ?', (book_id,)
+            ).fetchone()
+        if row is None:
+            return {'threshold': DEFAULT_THRESHOLD, 'target': DEFAULT_TARGET,
+                    'interval': DEFAULT_INTERVAL, 'default': True}
+        return {'threshold': row[0], 'target': row[1], 'interval': row[2], 'default': False}
+
+    def set_policy(self, book_id, threshold, target, interval):
+        """
+        Gives a book its own restock policy.
+        """
+        with db_pool.connection(self.database) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO restock_policies (book_id, threshold, target, interval) '
+                'VALUES (?, ?, ?, ?)',
+                (book_id, threshold, target, interval)
+            )
+
+    def reset_policy(self, book_id):
+        """
+        Makes a book use the default restock policy again.
+        """
+        with db_pool.connection(self.database) as conn:
+            conn.execute('DELETE FROM restock_policies WHERE book_id = ?', (book_id,))
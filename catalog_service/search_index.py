@@ -0,0 +1,306 @@
+"""
+search_index.py
+
+This module implements the in-process search index of the Catalog Service.
+
+The index keeps, for every book, its title and topic, plus two lookup tables:
+- topic -> sorted list of book IDs, which answers /search/<topic>.
+- title token (lowercase word) -> sorted list of book IDs, which narrows title substring searches
+  (/search?q=) down to the books containing the query's most selective word before their titles
+  are compared with the query.
+
+A query's first and last words can be parts of title words, so the tokens they match are looked
+up in the vocabulary: the last word's through a sorted token list (tokens starting with it), the
+first word's through a sorted list of reversed tokens (tokens ending with it), and a single word's
+through an index of every token's 1-, 2- and 3-letter substrings, whose sets are intersected.
+None of them scans the whole vocabulary.
+
+Both return books in ID order and support keyset pagination: a page starts after a given ID and
+stops after 'limit' books, so the cost of a search depends on the page size, not on the size of
+the catalog.
+
+Every process loads the index from the database on first use and then keeps it coherent with the
+'books' table through the 'book_changes' log, which database triggers fill on every insert,
+delete and title or topic change, whichever process or tool made it. Before answering a search
+the index applies the changes logged since it was last refreshed; if it fell too far behind, or
+the log was pruned past its position, it reloads everything.
+
+Environment Variables:
+- SEARCH_INDEX_REFRESH_INTERVAL: Minimum seconds between checks for new changes. Defaults to 1;
+                                 0 checks before every search.
+- SEARCH_INDEX_CHANGES_RETAIN: Number of entries kept in the 'book_changes' log. Defaults to 100000.
+"""
+
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+
+import db_pool
+
+REFRESH_INTERVAL = float(os.environ.get('SEARCH_INDEX_REFRESH_INTERVAL', 1))
+CHANGES_RETAIN = int(os.environ.get('SEARCH_INDEX_CHANGES_RETAIN', 100000))
+# Applying more changes than this one by one is slower than reloading the index
+RELOAD_THRESHOLD = 10000
+
+_TOKEN = re.compile(r'\w+')
+# Longest token substrings indexed; longer words are looked up through all of theirs
+GRAM = 3
+
+
+def tokens(text):
+    """
+    Returns the set of lowercase words in text.
+    """
+    return set(_TOKEN.findall(text.lower()))
+
+
+def grams(token, n=GRAM):
+    """
+    Returns the set of substrings of token that are up to n letters long.
+    """
+    return {token[i:i + size] for size in range(1, n + 1) for i in range(len(token) - size + 1)}
+
+
+def _starting_with(tokens, prefix):
+    # The tokens of a sorted list that start with prefix
+    i = bisect.bisect_left(tokens, prefix)
+    while i < len(tokens) and tokens[i].startswith(prefix):
+        yield tokens[i]
+        i += 1
+
+
+def _remove(ids, book_id):
+    i = bisect.bisect_left(ids, book_id)
+    if i < len(ids) and ids[i] == book_id:
+        del ids[i]
+
+
+def _after(ids, cursor):
+    # Iterates over the IDs of a sorted list that come after the cursor, without copying it
+    return map(ids.__getitem__, range(bisect.bisect_right(ids, cursor), len(ids)))
+
+
+class CatalogIndex:
+    """
+    In-memory topic and title index over the 'books' table of one database.
+
+    Thread-safe; searches refresh the index from the 'book_changes' log first.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.Lock()
+        # Serializes loads and refreshes, so changes are applied once and in order
+        self._refresh_lock = threading.Lock()
+        self._books = {}      # id -> (title, lowercase title, topic)
+        self._ids = []        # every ID, sorted
+        self._by_topic = {}   # topic -> sorted IDs
+        self._by_token = {}   # token -> sorted IDs
+        self._tokens = []     # every token, sorted
+        self._reversed = []   # every token spelled backwards, sorted
+        self._by_gram = {}    # 1- to 3-letter substring -> set of tokens containing it
+        self._seq = None      # last 'book_changes' entry applied; None until loaded
+        self._checked = 0.0
+
+    def load(self):
+        """
+        (Re)builds the whole index from the database.
+        """
+        with self._refresh_lock:
+            self._load()
+
+    def refresh(self):
+        """
+        Applies the changes other writers logged since the last refresh.
+        """
+        if self._seq is not None:
+            if REFRESH_INTERVAL and time.monotonic() - self._checked < REFRESH_INTERVAL:
+                return
+            # Cheap check first, so concurrent searches don't queue up when nothing changed
+            if self._position() == self._seq:
+                self._checked = time.monotonic()
+                return
+        with self._refresh_lock:
+            self._refresh()
+
+    def _position(self, conn=None):
+        if conn is None:
+            with db_pool.connection(self.database) as conn:
+                return self._position(conn)
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'book_changes'").fetchone()
+        return row[0] if row else 0
+
+    def _load(self):
+        with db_pool.connection(self.database) as conn:
+            # One read transaction, so the rows match the log position
+            conn.execute('BEGIN')
+            position = self._position(conn)
+            rows = conn.execute('SELECT id, title, topic FROM books ORDER BY id').fetchall()
+        books, by_topic, by_token = {}, {}, {}
+        for book_id, title, topic in rows:
+            title = title or ''
+            books[book_id] = (title, title.lower(), topic)
+            by_topic.setdefault(topic, []).append(book_id)
+            for token in tokens(title):
+                by_token.setdefault(token, []).append(book_id)
+        by_gram = {}
+        for token in by_token:
+            for gram in grams(token):
+                by_gram.setdefault(gram, set()).add(token)
+        with self._lock:
+            self._books = books
+            self._ids = [row[0] for row in rows]
+            self._by_topic = by_topic
+            self._by_token = by_token
+            self._tokens = sorted(by_token)
+            self._reversed = sorted(token[::-1] for token in by_token)
+            self._by_gram = by_gram
+            self._seq = position
+            self._checked = time.monotonic()
+
+    def _refresh(self):
+        if self._seq is None:
+            self._load()
+            return
+        with db_pool.connection(self.database) as conn:
+            conn.execute('BEGIN')
+            changes = conn.execute(
+                'SELECT seq, book_id FROM book_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                (self._seq, RELOAD_THRESHOLD + 1)
+            ).fetchall()
+            if not changes:
+                self._checked = time.monotonic()
+                return
+            if len(changes) > RELOAD_THRESHOLD or changes[0][0] != self._seq + 1:
+                # Too many changes, or some were pruned before we saw them
+                rows = None
+            else:
+                book_ids = list({book_id for _, book_id in changes})
+                placeholders = ','.join('?' * len(book_ids))
+                rows = conn.execute(
+                    f'SELECT id, title, topic FROM books WHERE id IN ({placeholders})', book_ids
+                ).fetchall()
+        if changes[-1][0] // 1000 != self._seq // 1000:
+            # Keep the log bounded; a process that falls further behind reloads
+            with db_pool.connection(self.database) as conn:
+                conn.execute('DELETE FROM book_changes WHERE seq <= ?', (changes[-1][0] - CHANGES_RETAIN,))
+        if rows is None:
+            self._load()
+            return
+        current = {book_id: (title, topic) for book_id, title, topic in rows}
+        with self._lock:
+            for book_id in book_ids:
+                self._unindex(book_id)
+                if book_id in current:
+                    self._index(book_id, *current[book_id])
+            self._seq = changes[-1][0]
+            self._checked = time.monotonic()
+
+    def _index(self, book_id, title, topic):
+        title = title or ''
+        self._books[book_id] = (title, title.lower(), topic)
+        bisect.insort(self._ids, book_id)
+        bisect.insort(self._by_topic.setdefault(topic, []), book_id)
+        for token in tokens(title):
+            if token not in self._by_token:
+                self._add_token(token)
+            bisect.insort(self._by_token[token], book_id)
+
+    def _unindex(self, book_id):
+        if book_id not in self._books:
+            return
+        title, _, topic = self._books.pop(book_id)
+        _remove(self._ids, book_id)
+        _remove(self._by_topic.get(topic, []), book_id)
+        for token in tokens(title):
+            ids = self._by_token.get(token)
+            if ids is not None:
+                _remove(ids, book_id)
+                if not ids:
+                    self._drop_token(token)
+
+    def _add_token(self, token):
+        self._by_token[token] = []
+        bisect.insort(self._tokens, token)
+        bisect.insort(self._reversed, token[::-1])
+        for gram in grams(token):
+            self._by_gram.setdefault(gram, set()).add(token)
+
+    def _drop_token(self, token):
+        del self._by_token[token]
+        del self._tokens[bisect.bisect_left(self._tokens, token)]
+        del self._reversed[bisect.bisect_left(self._reversed, token[::-1])]
+        for gram in grams(token):
+            tokens_with_gram = self._by_gram[gram]
+            tokens_with_gram.discard(token)
+            if not tokens_with_gram:
+                del self._by_gram[gram]
+
+    def search_topic(self, topic, cursor=0, limit=None):
+        """
+        Returns [(id, title), ...] of the books on a topic with an ID above 'cursor', in ID order.
+        """
+        self.refresh()
+        with self._lock:
+            ids = self._by_topic.get(topic, [])
+            start = bisect.bisect_right(ids, cursor)
+            end = len(ids) if limit is None else start + limit
+            return [(book_id, self._books[book_id][0]) for book_id in ids[start:end]]
+
+    def _postings(self, words, i):
+        # The ID lists of the title tokens the query's i-th word can be part of. Interior words
+        # are whole tokens; the first word can be the end of one, the last the start of one.
+        word = words[i]
+        first, last = i == 0, i == len(words) - 1
+        if not first and not last:
+            return [self._by_token.get(word, [])]
+        if first and last:
+            matches = self._containing(word)
+        elif first:
+            matches = (token[::-1] for token in _starting_with(self._reversed, word[::-1]))
+        else:
+            matches = _starting_with(self._tokens, word)
+        return [self._by_token[token] for token in matches]
+
+    def _containing(self, word):
+        # The tokens that contain word: those having all of its substrings of GRAM letters (or
+        # the whole word, if shorter), less the ones that have them in another order
+        size = min(GRAM, len(word))
+        sets = sorted((self._by_gram.get(word[i:i + size], set()) for i in range(len(word) - size + 1)),
+                      key=len)
+        return [token for token in sets[0].intersection(*sets[1:]) if word in token]
+
+    def search_title(self, query, cursor=0, limit=50):
+        """
+        Returns [(id, title, topic), ...] of the books whose title contains 'query' (ignoring
+        case) with an ID above 'cursor', in ID order.
+        """
+        self.refresh()
+        query = query.lower()
+        words = _TOKEN.findall(query)
+        with self._lock:
+            if not words:
+                candidates = _after(self._ids, cursor)
+            else:
+                postings = min((self._postings(words, i) for i in range(len(words))),
+                               key=lambda lists: sum(map(len, lists)))
+                if sum(map(len, postings)) > len(self._ids) // 4:
+                    # Matches are dense: scanning in ID order finds a page sooner than merging
+                    candidates = _after(self._ids, cursor)
+                else:
+                    candidates = heapq.merge(*(_after(ids, cursor) for ids in postings))
+            results = []
+            last = None
+            for book_id in candidates:
+                if book_id == last:
+                    continue
+                last = book_id
+                title, lowered, topic = self._books[book_id]
+                if query in lowered:
+                    results.append((book_id, title, topic))
+                    if len(results) == limit:
+                        break
+            return results
@@ -0,0 +1,56 @@
+import pytest
+
+import app as catalog
+import database
+import db_pool
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    path = str(tmp_path / 'catalog.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    monkeypatch.setattr(catalog, 'DATABASE', path)
+    database.init_db()
+    return catalog.app.test_client()
+
+
+def quantities():
+    with db_pool.connection(catalog.DATABASE) as conn:
+        return dict(conn.execute('SELECT id, quantity FROM books'))
+
+
+def test_multi_get_answers_found_and_missing_books(client):
+    body = client.get('/info?ids=2,9,1,2').get_json()
+    assert set(body['items']) == {'1', '2'}
+    assert body['items']['1'] == {'title': 'How to get a good grade in DOS in 40 minutes a day',
+                                  'quantity': 10, 'price': 50.0}
+    assert body['missing'] == [9]
+
+
+@pytest.mark.parametrize('ids', ['', '1,x', ','.join(map(str, range(catalog.MAX_BATCH_ITEMS + 1)))])
+def test_multi_get_rejects_invalid_ids(client, ids):
+    assert client.get(f'/info?ids={ids}').status_code == 400
+
+
+def test_batch_decrement_takes_every_book(client):
+    resp = client.put('/decrement', json={'items': {'1': 2, '3': 10}})
+    assert resp.status_code == 200
+    assert resp.get_json()['quantities'] == {'1': 8, '3': 0}
+    assert quantities() == {1: 8, 2: 10, 3: 0, 4: 10}
+
+
+def test_batch_decrement_takes_nothing_if_one_book_fails(client):
+    resp = client.put('/decrement', json={'items': {'1': 2, '3': 11}})
+    assert resp.status_code == 409 and resp.get_json()['item_id'] == 3
+    resp = client.put('/decrement', json={'items': {'1': 2, '9': 1}})
+    assert resp.status_code == 404 and resp.get_json()['item_id'] == 9
+    assert quantities() == {1: 10, 2: 10, 3: 10, 4: 10}
+
+
+@pytest.mark.parametrize('payload', [
+    None, {'items': {}}, {'items': [1, 2]}, {'items': {'1': True}}, {'items': {'1': 0}},
+    {'items': {'x': 1}}, {'items': {'1': 1.5}},
+])
+def test_batch_decrement_rejects_invalid_payloads(client, payload):
+    assert client.put('/decrement', json=payload).status_code == 400
+    assert quantities() == {1: 10, 2: 10, 3: 10, 4: 10}
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import app as catalog
+import database
+import db_pool
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    path = str(tmp_path / 'catalog.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    monkeypatch.setattr(catalog, 'DATABASE', path)
+    database.init_db()
+    return catalog.app.test_client()
+
+
+def quantity(book_id):
+    with db_pool.connection(catalog.DATABASE) as conn:
+        return conn.execute('SELECT quantity FROM books WHERE id = ?', (book_id,)).fetchone()[0]
+
+
+def test_decrement_returns_the_remaining_stock(client):
+    resp = client.put('/decrement/1')
+    assert resp.status_code == 200 and resp.get_json()['quantity'] == 9
+    assert client.put('/decrement/1?n=4').get_json()['quantity'] == 5
+    assert quantity(1) == 5
+
+
+def test_decrement_never_oversells(client):
+    resp = client.put('/decrement/1?n=11')
+    assert resp.status_code == 409 and resp.get_json()['quantity'] == 10
+    assert client.put('/decrement/99').status_code == 404
+    assert quantity(1) == 10
+
+
+@pytest.mark.parametrize('n', ['0', '-1', 'two'])
+def test_invalid_counts_are_rejected(client, n):
+    assert client.put(f'/decrement/1?n={n}').status_code == 400
+
+
+def test_concurrent_buyers_get_exactly_the_stock(client):
+    statuses = []
+
+    def buy():
+        statuses.append(catalog.app.test_client().put('/decrement/2').status_code)
+
+    threads = [threading.Thread(target=buy) for _ in range(25)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(statuses) == [200] * 10 + [409] * 15
+    assert quantity(2) == 0
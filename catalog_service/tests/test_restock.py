@@ -0,0 +1,70 @@
+import pytest
+
+import database
+import db_pool
+import restock
+from restock import RestockScheduler
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    path = str(tmp_path / 'catalog.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    database.init_db()
+    return RestockScheduler(path)
+
+
+def set_quantities(scheduler, quantities):
+    with db_pool.connection(scheduler.database) as conn:
+        conn.executemany('UPDATE books SET quantity = ? WHERE id = ?',
+                         [(quantity, book_id) for book_id, quantity in quantities.items()])
+
+
+def quantities(scheduler):
+    with db_pool.connection(scheduler.database) as conn:
+        return dict(conn.execute('SELECT id, quantity FROM books'))
+
+
+def test_only_low_books_are_restocked(scheduler):
+    set_quantities(scheduler, {1: 4, 2: 5, 3: 0})
+    assert scheduler.restock_due() == 2
+    assert quantities(scheduler) == {1: 10, 2: 5, 3: 10, 4: 10}
+    events = scheduler.events()
+    assert [(e['seq'], e['id'], e['added'], e['quantity']) for e in events] == [(1, 1, 6, 10), (2, 3, 10, 10)]
+    assert [e['id'] for e in scheduler.events(cursor=1)] == [3]
+
+
+def test_a_book_is_restocked_once_per_interval(scheduler):
+    set_quantities(scheduler, {1: 0})
+    assert scheduler.restock_due() == 1
+    set_quantities(scheduler, {1: 0})
+    assert scheduler.restock_due() == 0
+    # Due again once its interval has passed
+    assert [row[0] for row in scheduler.due(now=scheduler.events()[0]['time'] + restock.DEFAULT_INTERVAL + 1)] == [1]
+
+
+def test_books_follow_their_own_policy(scheduler):
+    scheduler.set_policy(2, threshold=8, target=20, interval=0)
+    assert scheduler.policy(2) == {'threshold': 8, 'target': 20, 'interval': 0, 'default': False}
+    set_quantities(scheduler, {1: 7, 2: 7})
+    assert scheduler.restock_due() == 1
+    assert quantities(scheduler)[2] == 20 and quantities(scheduler)[1] == 7
+    scheduler.reset_policy(2)
+    assert scheduler.policy(2)['default']
+
+
+def test_chunks_and_purchases_in_between(scheduler, monkeypatch):
+    monkeypatch.setattr(restock, 'CHUNK_SIZE', 1)
+    set_quantities(scheduler, {1: 0, 2: 0})
+    due = scheduler.due()
+    # A purchase restocked the book in the meantime: it is not written again
+    set_quantities(scheduler, {2: 9})
+    assert scheduler._restock(due[:1]) + scheduler._restock(due[1:]) == 1
+    assert quantities(scheduler)[2] == 9
+
+
+def test_the_event_log_is_bounded(scheduler, monkeypatch):
+    monkeypatch.setattr(restock, 'EVENTS_RETAIN', 2)
+    set_quantities(scheduler, {1: 0, 2: 0, 3: 0, 4: 0})
+    scheduler.restock_due()
+    assert [e['seq'] for e in scheduler.events()] == [3, 4]
@@ -0,0 +1,91 @@
+import random
+import sqlite3
+
+import pytest
+
+import database
+import search_index
+from search_index import CatalogIndex
+
+WORDS = ['distributed', 'systems', 'rpc', 'rpcs', 'noobs', 'xen', 'art', 'cooking', 'impatient',
+         'undergrad', 'undergraduate', 'school', 'a', 'to', 'tor', 'stor', 'torrent']
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'catalog.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    monkeypatch.setattr(search_index, 'REFRESH_INTERVAL', 0)
+    database.init_db()
+    return path
+
+
+def write(db, sql, params=()):
+    conn = sqlite3.connect(db)
+    with conn:
+        conn.execute(sql, params)
+    conn.close()
+
+
+def titles(db):
+    conn = sqlite3.connect(db)
+    rows = conn.execute('SELECT id, title FROM books ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+
+def scan(db, query):
+    return [book_id for book_id, title in titles(db) if query.lower() in title.lower()]
+
+
+def queries(db):
+    # Whole and partial words, single and several, including ones spanning two titles' words
+    found = set()
+    for _, title in titles(db):
+        lowered = title.lower()
+        for _ in range(10):
+            i = random.randrange(len(lowered))
+            found.add(lowered[i:i + random.randint(1, 12)])
+    return found | {'to', 'tor', 'ST', 'rpc', 'S SCH', 'l of th', 'missing'}
+
+
+def test_title_search_matches_a_scan(db):
+    random.seed(1)
+    for book_id in range(5, 300):
+        title = ' '.join(random.choice(WORDS) for _ in range(random.randint(1, 5))).title()
+        write(db, 'INSERT INTO books VALUES (?, ?, ?, 1, 1.0)', (book_id, title, 'topic'))
+    index = CatalogIndex(db)
+    for query in queries(db):
+        assert [row[0] for row in index.search_title(query, limit=None)] == scan(db, query), query
+
+
+def test_title_changes_are_applied(db):
+    index = CatalogIndex(db)
+    index.load()
+    assert [row[0] for row in index.search_title('noob')] == [2]
+    write(db, "UPDATE books SET title = 'Stubs for Experts' WHERE id = 2")
+    write(db, "INSERT INTO books VALUES (5, 'Noobish Torrents', 'topic', 1, 1.0)")
+    write(db, 'DELETE FROM books WHERE id = 3')
+    for query in ['noob', 'stub', 'xen', 'ents', 'torrents', 'ish tor', 'for']:
+        assert [row[0] for row in index.search_title(query)] == scan(db, query), query
+    # Tokens no book has any more are gone from the vocabulary
+    assert 'xen' not in index._tokens and 'noobs' not in index._by_token
+
+
+def test_pagination(db):
+    index = CatalogIndex(db)
+    assert index.search_title('o', cursor=0, limit=2) == [
+        (1, 'How to get a good grade in DOS in 40 minutes a day', 'distributed systems'),
+        (2, 'RPCs for Noobs', 'distributed systems'),
+    ]
+    assert [row[0] for row in index.search_title('o', cursor=2)] == [3, 4]
+
+
+def test_changes_are_checked_for_at_most_once_per_interval(db, monkeypatch):
+    monkeypatch.setattr(search_index, 'REFRESH_INTERVAL', 60)
+    index = CatalogIndex(db)
+    index.load()
+    write(db, "INSERT INTO books VALUES (5, 'Late Arrivals', 'topic', 1, 1.0)")
+    assert index.search_title('late') == []
+    index._checked -= 60
+    assert [row[0] for row in index.search_title('late')] == [5]
@@ -0,0 +1,278 @@
+"""
+admission.py
+
+This module implements admission control for the threaded Bazar.com frontend: it bounds how much
+of the frontend a slow upstream or a burst of one kind of request can take up, and sheds the
+excess right away instead of letting it queue.
+
+Every request gets a deadline: the time its client allows in the X-Request-Timeout header, at
+most REQUEST_TIMEOUT seconds (see http_client.py). Upstream calls made while serving it shorten
+their timeouts to the time left and pass the rest on, so the catalog and order services stop
+working on answers nobody waits for any more.
+
+Requests are admitted through limits, each of which allows a number of requests at a time and
+lets a bounded number more wait for a slot:
+- one per class of route: 'purchase' (/purchase...), 'browse' (/info..., /search...) and
+  'orders' (/orders), taken for the whole request;
+- one per upstream service, 'catalog' and 'order', taken for every call to it (see limit()),
+  and until the whole body has been sent for a response streamed from it (see hold()).
+Cache hits never call an upstream, so a slow catalog only fills up the 'catalog' limit, and
+/info and /search keep being answered from the cache while the misses are shed.
+
+A request that finds a limit and its queue full, or waits longer than ADMISSION_QUEUE_TIMEOUT
+seconds (or its deadline) for a slot, is answered 503 with a Retry-After header. Purchases have
+priority over the other requests: they are handed free slots first, and the last 'reserved'
+slots of a limit are kept for them.
+
+Environment Variables:
+- REQUEST_TIMEOUT: Seconds a request may take at most. Defaults to 10.
+- ADMISSION_LIMITS: Limits to change, as 'name=concurrency:queue[:reserved],...', e.g.
+                    'catalog=16:8,order=16:8:4'. The defaults are fractions of THREADS (see
+                    DEFAULT_LIMITS).
+- ADMISSION_QUEUE_TIMEOUT: Seconds a request waits for a slot at most. Defaults to 0.1.
+- ADMISSION_RETRY_AFTER: Seconds sent in the Retry-After header of a shed request. Defaults to 1.
+"""
+
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+from contextlib import contextmanager
+
+import http_client
+import metrics
+
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 10))
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 0.1))
+RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+# Priorities; lower is served first
+HIGH, LOW = 0, 1
+
+# Route prefix -> (limit, priority)
+ROUTES = (
+    ('/purchase', 'purchase', HIGH),
+    ('/info', 'browse', LOW),
+    ('/search', 'browse', LOW),
+    ('/orders', 'orders', LOW),
+)
+
+# Request threads per worker process (as in gunicorn.conf.py); the default limits share them out
+THREADS = int(os.environ.get('THREADS', 8))
+
+# name -> (concurrency, queue, reserved). Calls to the catalog never take more than half of
+# the threads, so purchases and cache hits always find one; /orders streams are long, and few
+# run at a time.
+DEFAULT_LIMITS = {
+    'purchase': (THREADS, THREADS, 0),
+    'browse': (THREADS, THREADS, 0),
+    'orders': (max(1, THREADS // 4), 0, 0),
+    'catalog': (max(1, THREADS // 2), THREADS // 4, 0),
+    'order': (max(1, THREADS - THREADS // 4), THREADS // 4, THREADS // 4),
+}
+
+SHED = metrics.counter('admission_shed_total', 'Requests shed by admission control, by limit and reason.',
+                       ('limit', 'reason'))
+
+_priority = contextvars.ContextVar('admission_priority', default=LOW)
+
+
+class Shed(Exception):
+    """
+    Raised when a limit does not admit the current request.
+    """
+
+    def __init__(self, limit, reason):
+        super().__init__(f"{limit} limit: {reason}")
+        self.limit = limit
+        self.reason = reason
+
+
+class Limiter:
+    """
+    Admits up to 'concurrency' holders at a time and lets up to 'queue' more wait, by priority
+    and then in order of arrival. Only HIGH priority holders get the last 'reserved' slots.
+    """
+
+    def __init__(self, name, concurrency, queue=0, reserved=0):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.reserved = min(reserved, concurrency - 1)
+        self.in_flight = 0
+        self._waiters = []  # heap of [priority, arrival, event, admitted]
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, priority=LOW, timeout=None):
+        """
+        Takes a slot, waiting up to 'timeout' seconds for one; raises Shed if it gets none.
+        """
+        with self._lock:
+            # Waiters that came first, or matter more, are served first
+            if (not self._waiters or self._waiters[0][0] > priority) and self._room(priority):
+                self.in_flight += 1
+                return
+            if len(self._waiters) >= self.queue or (timeout is not None and timeout <= 0):
+                raise self._shed('full')
+            waiter = [priority, next(self._arrivals), threading.Event(), False]
+            heapq.heappush(self._waiters, waiter)
+        waiter[2].wait(timeout)
+        with self._lock:
+            if waiter[3]:
+                return
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+            raise self._shed('timeout')
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            # Hand the free slots over, best waiter first
+            while self._waiters and self._room(self._waiters[0][0]):
+                waiter = heapq.heappop(self._waiters)
+                waiter[3] = True
+                self.in_flight += 1
+                waiter[2].set()
+
+    def queued(self):
+        return len(self._waiters)
+
+    def _room(self, priority):
+        return self.in_flight < self.concurrency - (0 if priority == HIGH else self.reserved)
+
+    def _shed(self, reason):
+        SHED.inc((self.name, reason))
+        return Shed(self.name, reason)
+
+
+def parse_limits(text):
+    """
+    Returns {name: (concurrency, queue, reserved)} from a 'name=concurrency:queue[:reserved],...' string.
+
+    Raises ValueError if a limit is malformed.
+    """
+    limits = {}
+    for part in filter(None, (part.strip() for part in (text or '').split(','))):
+        name, _, values = part.partition('=')
+        numbers = [int(value) for value in values.split(':')]
+        if not name.strip() or len(numbers) not in (2, 3) or numbers[0] < 1 or min(numbers) < 0:
+            raise ValueError(f'invalid admission limit {part!r}, expected name=concurrency:queue[:reserved]')
+        limits[name.strip()] = tuple(numbers) + (0,) * (3 - len(numbers))
+    return limits
+
+
+limiters = {name: Limiter(name, *values)
+            for name, values in dict(DEFAULT_LIMITS, **parse_limits(os.environ.get('ADMISSION_LIMITS'))).items()}
+
+metrics.callback('admission_in_flight', 'Requests holding a slot of an admission limit.', ('limit',),
+                 lambda: {(name,): limiter.in_flight for name, limiter in limiters.items()})
+metrics.callback('admission_queued', 'Requests waiting for a slot of an admission limit.', ('limit',),
+                 lambda: {(name,): limiter.queued() for name, limiter in limiters.items()})
+
+
+def _wait():
+    # A request waits for a slot no longer than its deadline allows
+    left = http_client.remaining()
+    return QUEUE_TIMEOUT if left is None else min(QUEUE_TIMEOUT, left)
+
+
+def hold(name):
+    """
+    Takes a slot of the named limit, at the current request's priority, for a caller that gives
+    it back later, e.g. once a streamed response has been sent; raises Shed if it gets none in
+    time. Returns the function that releases the slot, which does so only once.
+    """
+    limiter = limiters[name]
+    limiter.acquire(_priority.get(), _wait())
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            limiter.release()
+    return release
+
+
+@contextmanager
+def limit(name):
+    """
+    Runs the block holding a slot of the named limit, at the current request's priority;
+    raises Shed if it gets none in time.
+    """
+    release = hold(name)
+    try:
+        yield
+    finally:
+        release()
+
+
+def classify(path):
+    """
+    Returns (limit name, priority) of a route, or (None, LOW) for routes without a limit.
+    """
+    for prefix, name, priority in ROUTES:
+        if path.startswith(prefix):
+            return name, priority
+    return None, LOW
+
+
+def shed_response(error):
+    from flask import jsonify
+    response = jsonify({'error': 'Service overloaded, retry later', 'limit': error.limit})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
+
+
+def instrument_flask(app):
+    """
+    Gives every request of a Flask app its deadline and priority, admits it through the limit
+    of its route and answers requests shed anywhere (see Shed) with a 503.
+    """
+    from flask import g, request
+
+    http_client.instrument_flask(app, REQUEST_TIMEOUT)
+
+    @app.before_request
+    def _admit():
+        name, priority = classify(request.path)
+        g.priority_token = _priority.set(priority)
+        if name is None:
+            return None
+        limiter = limiters[name]
+        try:
+            limiter.acquire(priority, _wait())
+        except Shed as e:
+            return shed_response(e)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                limiter.release()
+        g.admission_release = release
+        return None
+
+    @app.after_request
+    def _hold_while_streaming(response):
+        # A streamed body (e.g. /orders) keeps its slot until it has been sent
+        release = g.pop('admission_release', None)
+        if release is not None:
+            response.call_on_close(release)
+        return response
+
+    @app.teardown_request
+    def _leave(error):
+        release = g.pop('admission_release', None)
+        if release is not None:
+            release()
+        token = g.pop('priority_token', None)
+        if token is not None:
+            try:
+                _priority.reset(token)
+            except ValueError:
+                pass
+
+    app.register_error_handler(Shed, shed_response)
@@ -0,0 +1,454 @@
+"""
+cache.py
+
+This module implements the read-through cache used by the Bazar.com frontend.
+
+The cache is a thread-safe LRU keyed by request (e.g. ('info', 3) or ('search', 'travel')).
+Entries expire after a per-entry TTL, and the cache is bounded both by number of entries and,
+optionally, by the approximate size of the cached payloads in bytes. 404 responses are cached
+for a much shorter time (negative caching) so that repeated lookups of a missing book do not
+reach the catalog, while a book that is added later still becomes visible quickly.
+
+A successful response expires in two steps. Once its TTL is over it is no longer fresh, but it
+is kept CACHE_STALE_IF_ERROR seconds longer (its hard expiry):
+- for the first CACHE_STALE_WHILE_REVALIDATE of these seconds, lookup() reports it as to be
+  revalidated: the caller answers with it right away and refreshes it in the background
+  (see SingleFlight.start());
+- until its hard expiry, get_stale() returns it, for callers whose upstream failed; while the
+  upstream keeps failing, it is then revalidated in the background like above.
+Responses answered from a stale entry carry a Warning header (STALE or REVALIDATION_FAILED).
+Entries removed with invalidate() are known to be wrong and are never served stale; expire()
+keeps the entries, for get_stale() only.
+
+Responses are cached as (payload, status, body) where 'body' is the encoded JSON response for
+clients, if the caller has it, so that a hit can be sent without encoding the payload again.
+
+SingleFlight collapses concurrent cache misses for the same key into one upstream fetch whose
+result is shared by every waiting request.
+
+save_snapshot() writes the most recently used successful responses of a cache to a file, e.g.
+when a server process exits, and load_snapshot() puts them back into a new cache, so that a
+restarted frontend does not start cold. Restored entries keep their age: one that was fresh for
+another 10 seconds when it was saved, 4 seconds before it is restored, is fresh for 6 more.
+
+export_metrics() publishes a cache's counters and occupancy through metrics.py.
+
+Environment Variables:
+- CACHE_MAX_ENTRIES: Maximum number of cached entries. Defaults to 1024.
+- CACHE_MAX_BYTES: Maximum total payload size in bytes, 0 for no limit. Defaults to 0.
+- CACHE_TTL: Lifetime of a cached successful response in seconds. Defaults to 30.
+- CACHE_NEGATIVE_TTL: Lifetime of a cached 404 response in seconds. Defaults to 2.
+- CACHE_STALE_WHILE_REVALIDATE: Seconds after its TTL during which an entry is answered with
+                                while it is refreshed. Defaults to 10.
+- CACHE_STALE_IF_ERROR: Seconds after its TTL during which an entry is answered with if the
+                        upstream fails. Defaults to 300.
+- CACHE_SNAPSHOT_ENTRIES: Most entries save_snapshot() writes. Defaults to 512.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 0))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 30))
+CACHE_NEGATIVE_TTL = float(os.environ.get('CACHE_NEGATIVE_TTL', 2))
+CACHE_STALE_WHILE_REVALIDATE = float(os.environ.get('CACHE_STALE_WHILE_REVALIDATE', 10))
+CACHE_STALE_IF_ERROR = float(os.environ.get('CACHE_STALE_IF_ERROR', 300))
+CACHE_SNAPSHOT_ENTRIES = int(os.environ.get('CACHE_SNAPSHOT_ENTRIES', 512))
+
+# Invalidated keys remembered for put()'s generation check; a fill that started before the
+# oldest of them is dropped whatever its key
+INVALIDATIONS_TRACKED = 4096
+
+# States of a cached entry, see lookup()
+FRESH, REVALIDATE, STALE = 'fresh', 'revalidate', 'stale'
+
+# Warning header values of responses answered from a stale entry: while it is being refreshed,
+# and because the upstream failed
+STALE_WARNING = '110 - "Response is Stale"'
+REVALIDATION_FAILED_WARNING = '111 - "Revalidation Failed"'
+
+logger = logging.getLogger(__name__)
+
+
+def _payload_size(value):
+    """
+    Returns the approximate size of a cached value in bytes (its JSON encoding).
+    """
+    return len(json.dumps(value, separators=(',', ':'), default=str))
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache with per-entry expiry and entry/byte capacity limits.
+
+    Hits, stale hits (entries answered with after their TTL), misses, evictions (capacity) and
+    expirations (hard expiry) are counted and reported by stats().
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL,
+                 stale_while_revalidate=CACHE_STALE_WHILE_REVALIDATE, stale_if_error=CACHE_STALE_IF_ERROR):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        # key -> (value, size, fresh_until, revalidate_until, expires_at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # Bumped on every invalidation; see put(). key -> generation of its last invalidation,
+        # oldest first, and the generation before which every fill is dropped
+        self.generation = 0
+        self._invalidated = OrderedDict()
+        self._horizon = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None if it is missing or not fresh.
+        """
+        cached = self.lookup(key)
+        if cached is None or cached[1] != FRESH:
+            return None
+        return cached[0]
+
+    def lookup(self, key):
+        """
+        Returns (value, state) for key, or None if it is missing or expired for good.
+
+        The state is FRESH within the entry's TTL, REVALIDATE for CACHE_STALE_WHILE_REVALIDATE
+        seconds after it (the value may be answered with while it is refreshed; counted as a
+        stale hit) and STALE after that (counted as a miss; see get_stale()).
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, _, fresh_until, revalidate_until, _ = entry
+            self._entries.move_to_end(key)
+            if fresh_until > now:
+                self.hits += 1
+                return value, FRESH
+            if revalidate_until > now:
+                self.stale_hits += 1
+                return value, REVALIDATE
+            self.misses += 1
+            return value, STALE
+
+    def get_stale(self, key, revalidate=False):
+        """
+        Returns the cached value for key, fresh or not, or None if it is missing or expired for
+        good; for answering with when the upstream failed.
+
+        If 'revalidate' is true, lookup() reports the entry as to be revalidated for another
+        CACHE_STALE_WHILE_REVALIDATE seconds (at most until its hard expiry), so that while the
+        upstream keeps failing requests are answered right away and only refreshes wait for it.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                return None
+            value, size, fresh_until, revalidate_until, expires_at = entry
+            if revalidate:
+                revalidate_until = max(revalidate_until, min(now + self.stale_while_revalidate, expires_at))
+                self._entries[key] = (value, size, fresh_until, revalidate_until, expires_at)
+            self.stale_hits += 1
+            return value
+
+    def put(self, key, value, ttl=None, generation=None, size=None, stale=True):
+        """
+        Stores value under key for ttl seconds (the cache default if not given), and unless
+        'stale' is false keeps it for the stale windows after that.
+
+        If 'generation' is given (the value of self.generation read before the value was fetched
+        upstream) and key was invalidated since (or the whole cache was, see expire() and
+        clear()), the value may predate that and is dropped. Invalidations of other keys do not
+        affect it.
+        'size' is the value's size in bytes if the caller knows it.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._store(key, value, time.monotonic() + ttl, stale, generation, size)
+
+    def restore(self, key, value, fresh_for, size=None):
+        """
+        Stores a value saved by snapshot() that stays fresh for 'fresh_for' more seconds; if
+        that is negative, it is past its TTL already and only kept for the stale windows.
+        """
+        now = time.monotonic()
+        fresh_until = now + fresh_for
+        if self.ttl <= 0 or fresh_until + max(self.stale_while_revalidate, self.stale_if_error) <= now:
+            return
+        self._store(key, value, fresh_until, True, None, size)
+
+    def snapshot(self, limit):
+        """
+        Returns [(key, value, fresh_for), ...] for up to 'limit' entries that have not expired
+        for good, most recently used first; 'fresh_for' is the number of seconds the entry stays
+        fresh, negative once it is past its TTL.
+        """
+        now = time.monotonic()
+        entries = []
+        with self._lock:
+            for key in reversed(self._entries):
+                if len(entries) >= limit:
+                    break
+                value, _, fresh_until, _, expires_at = self._entries[key]
+                if expires_at > now:
+                    entries.append((key, value, fresh_until - now))
+        return entries
+
+    def _store(self, key, value, fresh_until, stale, generation, size):
+        if not self.max_bytes:
+            size = 0
+        elif size is None:
+            size = _payload_size(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and (generation < self._horizon
+                                           or self._invalidated.get(key, -1) > generation):
+                return
+            if key in self._entries:
+                self._remove(key)
+            if stale:
+                self._entries[key] = (value, size, fresh_until, fresh_until + self.stale_while_revalidate,
+                                      fresh_until + max(self.stale_while_revalidate, self.stale_if_error))
+            else:
+                self._entries[key] = (value, size, fresh_until, fresh_until, fresh_until)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def put_response(self, key, payload, status, generation=None, body=None):
+        """
+        Caches an upstream response as (payload, status, body): 200s for the normal TTL, 404s
+        for the negative TTL and never stale.
+
+        Any other status (errors, redirects, ...) is not cached. See put() for 'generation'.
+        """
+        size = len(body) if body is not None else None
+        if status == 200:
+            self.put(key, (payload, status, body), generation=generation, size=size)
+        elif status == 404:
+            self.put(key, (payload, status, body), ttl=self.negative_ttl, generation=generation, size=size,
+                     stale=False)
+
+    def invalidate(self, key):
+        """
+        Removes key from the cache if present.
+        """
+        with self._lock:
+            self.generation += 1
+            self._invalidated[key] = self.generation
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > INVALIDATIONS_TRACKED:
+                # Fills older than the forgotten invalidation can no longer be checked per key
+                self._horizon = self._invalidated.popitem(last=False)[1]
+            if key in self._entries:
+                self._remove(key)
+
+    def expire(self):
+        """
+        Ends the freshness of every entry, e.g. after invalidations may have been missed: none is
+        answered with or revalidated in the background any more, but get_stale() still returns
+        them until their hard expiry.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.generation += 1
+            self._horizon = self.generation
+            for key, (value, size, fresh_until, revalidate_until, expires_at) in list(self._entries.items()):
+                self._entries[key] = (value, size, min(fresh_until, now), min(revalidate_until, now), expires_at)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self.generation += 1
+            self._horizon = self.generation
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns the cache counters and current occupancy as a dict.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _live(self, key, now):
+        # The entry of key unless it is missing or past its hard expiry; caller must hold the lock
+        entry = self._entries.get(key)
+        if entry is not None and entry[4] <= now:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key):
+        # Caller must hold the lock
+        size = self._entries.pop(key)[1]
+        self._bytes -= size
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it is in flight block
+    until it finishes and receive the same result (or exception). start() runs a call in the
+    background instead, e.g. to refresh a stale cache entry; callers of do() join it as well.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, fn):
+        """
+        Runs fn() once per key among concurrent callers and returns its result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        return self._run(key, call, fn)
+
+    def start(self, key, fn):
+        """
+        Runs fn() in a background thread, unless a call for key is in flight already.
+
+        The thread starts without the caller's context variables (deadline, trace, ...).
+        Returns True if it started one.
+        """
+        with self._lock:
+            if key in self._calls:
+                return False
+            call = self._calls[key] = _Call()
+        threading.Thread(target=self._run_in_background, args=(key, call, fn), daemon=True).start()
+        return True
+
+    def _run(self, key, call, fn):
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run_in_background(self, key, call, fn):
+        try:
+            self._run(key, call, fn)
+        except Exception as e:
+            logger.warning("Background call for %r failed: %s", key, e)
+
+
+def save_snapshot(cache, path, state=None, limit=CACHE_SNAPSHOT_ENTRIES):
+    """
+    Writes the most recently used successful responses of a cache, at most 'limit', to 'path'
+    as JSON; 'state' is any JSON-serializable data to save with them (see load_snapshot()).
+
+    The file is replaced atomically, so of several processes saving to the same path the last
+    one wins, and a reader never sees a partial snapshot. Returns the number of entries written.
+    """
+    entries = [[list(key), value[0], round(fresh_for, 3)]
+               for key, value, fresh_for in cache.snapshot(limit) if value[1] == 200]
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'saved_at': time.time(), 'state': state, 'entries': entries}, f, separators=(',', ':'))
+    os.replace(tmp, path)
+    return len(entries)
+
+
+def load_snapshot(cache, path):
+    """
+    Puts the responses saved by save_snapshot() back into a cache, as (payload, 200, None),
+    aged by the time since they were saved.
+
+    Returns:
+        tuple: (number of entries restored, the saved state), or (0, None) if there is no
+               snapshot at 'path' or it cannot be read.
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        elapsed = max(0.0, time.time() - snapshot['saved_at'])
+        entries = snapshot['entries']
+    except FileNotFoundError:
+        return 0, None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning("Cache snapshot %s cannot be read: %s", path, e)
+        return 0, None
+    # Least recently used first, so the order of the LRU is kept
+    for key, payload, fresh_for in reversed(entries):
+        cache.restore(tuple(key), (payload, 200, None), fresh_for - elapsed)
+    return len(entries), snapshot.get('state')
+
+
+def export_metrics(cache):
+    """
+    Publishes the counters and occupancy of a cache as metrics, read when they are collected.
+    """
+    metrics.callback('cache_lookups_total', 'Cache lookups, by result.', ('result',),
+                     lambda: {('hit',): cache.hits, ('stale',): cache.stale_hits, ('miss',): cache.misses},
+                     kind='counter')
+    metrics.callback('cache_removals_total', 'Entries removed to make room (eviction) or on hard expiry.',
+                     ('reason',),
+                     lambda: {('eviction',): cache.evictions, ('expiration',): cache.expirations},
+                     kind='counter')
+    metrics.callback('cache_entries', 'Entries in the cache.', (), lambda: {(): len(cache._entries)})
+    metrics.callback('cache_bytes', 'Approximate size of the cached payloads (if bounded by size).', (),
+                     lambda: {(): cache._bytes})
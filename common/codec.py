@@ -0,0 +1,77 @@
+"""
+codec.py
+
+This module negotiates the encoding of the responses the Bazar.com services send each other.
+
+External clients always get JSON. A service calling another one may ask for MessagePack instead,
+which is more compact and much cheaper to decode: it sends ACCEPT as its Accept header, and a
+service that ran install() then answers every jsonify()'d response in MessagePack. The caller
+decodes a response by its Content-Type with decode(), so either side may run without MessagePack
+support and the two simply fall back to JSON.
+
+msgpack is an optional dependency. Without it, ACCEPT asks for JSON only and install() leaves
+the app's responses unchanged.
+
+Environment Variables:
+- INTERNAL_ENCODING: Encoding asked for in calls to other services, 'msgpack' or 'json'.
+                     Defaults to 'msgpack' (if the msgpack package is installed).
+"""
+
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+
+INTERNAL_ENCODING = os.environ.get('INTERNAL_ENCODING', 'msgpack')
+ACCEPT = f'{MSGPACK}, {JSON};q=0.5' if msgpack is not None and INTERNAL_ENCODING == 'msgpack' else JSON
+
+
+def is_msgpack(content_type):
+    return bool(content_type) and content_type.split(';', 1)[0].strip().lower() == MSGPACK
+
+
+def is_json(content_type):
+    return bool(content_type) and content_type.split(';', 1)[0].strip().lower() == JSON
+
+
+def decode(body, content_type):
+    """
+    Returns the payload of a response body: MessagePack if its Content-Type says so, else JSON.
+
+    Raises ValueError if the body cannot be decoded.
+    """
+    if not is_msgpack(content_type):
+        return json.loads(body)
+    if msgpack is None:
+        raise ValueError('MessagePack response, but msgpack is not installed')
+    try:
+        return msgpack.unpackb(body)
+    except Exception as e:
+        # msgpack raises several exception types for malformed input
+        raise ValueError(f'invalid MessagePack body: {e}') from e
+
+
+def install(app):
+    """
+    Makes a Flask app answer jsonify() (and dicts returned by views) in MessagePack for requests
+    that prefer it, e.g. those sent with ACCEPT.
+    """
+    if msgpack is None:
+        return
+    from flask import has_request_context, request
+    from flask.json.provider import DefaultJSONProvider
+
+    class NegotiatingProvider(DefaultJSONProvider):
+        def response(self, *args, **kwargs):
+            if has_request_context() and request.accept_mimetypes.best_match((JSON, MSGPACK)) == MSGPACK:
+                payload = self._prepare_response_obj(args, kwargs)
+                return self._app.response_class(msgpack.packb(payload, default=self.default), mimetype=MSGPACK)
+            return super().response(*args, **kwargs)
+
+    app.json = NegotiatingProvider(app)
@@ -0,0 +1,209 @@
+"""
+db_pool.py
+
+This module provides a small pool of long-lived SQLite connections shared by the handlers of a
+Bazar.com service.
+
+Every connection is opened once and configured with:
+- WAL journal mode, so readers no longer block behind writers (e.g. the restocking thread).
+- A tunable 'synchronous' level and page cache size.
+- A busy timeout instead of failing immediately when the database is locked.
+- A per-connection prepared statement cache, which is only useful because connections are reused.
+
+The time spent waiting for a connection, inside each transaction and committing it, and the
+number of connections in use are exported as metrics (see metrics.py). Each transaction of a
+traced request is recorded as a span (see tracing.py).
+
+Environment Variables:
+- SQLITE_POOL_SIZE: Maximum number of connections per database file. Defaults to 8.
+- SQLITE_JOURNAL_MODE: Journal mode pragma. Defaults to 'WAL'.
+- SQLITE_SYNCHRONOUS: Synchronous pragma. Defaults to 'NORMAL'.
+- SQLITE_CACHE_SIZE_KB: Page cache size per connection in KiB. Defaults to 8192.
+- SQLITE_BUSY_TIMEOUT_MS: How long to wait on a locked database. Defaults to 5000.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import tracing
+
+POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 8192))
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+STATEMENT_CACHE_SIZE = 256
+
+POOL_WAIT = metrics.histogram('sqlite_pool_wait_seconds', 'Time spent waiting for a pooled connection.',
+                              ('database',))
+TRANSACTION_TIME = metrics.histogram('sqlite_transaction_duration_seconds',
+                                     'Time a pooled connection is held, from its first query to commit or rollback.',
+                                     ('database',))
+COMMIT_TIME = metrics.histogram('sqlite_commit_duration_seconds', 'Time spent committing transactions.',
+                                ('database',))
+
+
+class ConnectionPool:
+    """
+    A bounded pool of SQLite connections for a single database file.
+
+    Connections are created lazily up to 'size' and handed out in LIFO order so that the most
+    recently used (and therefore warmest) connection is reused first. Callers that find the
+    pool exhausted block until a connection is released, or discarded (which frees its slot for
+    a new one).
+    """
+
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.size = size
+        self.label = (os.path.basename(database),)
+        self.pid = os.getpid()
+        self._idle = []
+        self._created = 0
+        # Notified whenever a connection is released or a slot freed
+        self._available = threading.Condition()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute(f'PRAGMA journal_mode={JOURNAL_MODE}')
+        conn.execute(f'PRAGMA synchronous={SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        return conn
+
+    def acquire(self):
+        """
+        Returns an idle connection, opening a new one if the pool has not reached its size.
+        """
+        with self._available:
+            while not self._idle and self._created >= self.size:
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self._connect()
+        except sqlite3.Error:
+            self._free_slot()
+            raise
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool.
+        """
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    def discard(self, conn):
+        """
+        Closes a connection that should not be reused and frees its slot.
+        """
+        try:
+            conn.close()
+        finally:
+            self._free_slot()
+
+    def _free_slot(self):
+        # A waiter may open a new connection in its place
+        with self._available:
+            self._created -= 1
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager yielding a pooled connection.
+
+        The transaction is committed when the block exits normally and rolled back if it raises.
+        """
+        with tracing.span('sqlite transaction', database=self.label[0]) as span:
+            start = time.perf_counter()
+            conn = self.acquire()
+            acquired = time.perf_counter()
+            POOL_WAIT.observe(self.label, acquired - start)
+            span.set('pool_wait_ms', round((acquired - start) * 1000, 3))
+            try:
+                yield conn
+                committing = time.perf_counter()
+                conn.commit()
+                COMMIT_TIME.observe(self.label, time.perf_counter() - committing)
+                TRANSACTION_TIME.observe(self.label, time.perf_counter() - acquired)
+            except BaseException:
+                TRANSACTION_TIME.observe(self.label, time.perf_counter() - acquired)
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    # The connection is unusable; drop it rather than hand it to the next caller
+                    self.discard(conn)
+                    raise
+                self.release(conn)
+                raise
+            else:
+                self.release(conn)
+
+    def usage(self):
+        """
+        Returns (connections in use, idle connections).
+        """
+        with self._available:
+            idle = len(self._idle)
+            return self._created - idle, idle
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self.discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database):
+    """
+    Returns the process-wide pool for a database file, creating it on first use.
+
+    Pools are never shared across a fork: a child process gets its own connections.
+    """
+    pool = _pools.get(database)
+    if pool is None or pool.pid != os.getpid():
+        with _pools_lock:
+            pool = _pools.get(database)
+            if pool is None or pool.pid != os.getpid():
+                pool = ConnectionPool(database)
+                _pools[database] = pool
+    return pool
+
+
+def connection(database):
+    """
+    Shortcut for get_pool(database).connection().
+    """
+    return get_pool(database).connection()
+
+
+def _usage():
+    values = {}
+    for pool in list(_pools.values()):
+        if pool.pid == os.getpid():
+            in_use, idle = pool.usage()
+            values[(pool.label[0], 'in_use')] = in_use
+            values[(pool.label[0], 'idle')] = idle
+    return values
+
+
+metrics.callback('sqlite_pool_connections', 'Open pooled connections, in use or idle.',
+                 ('database', 'state'), _usage)
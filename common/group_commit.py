@@ -0,0 +1,135 @@
+"""
+group_commit.py
+
+This module batches the small write transactions of concurrent requests into shared ones
+("group commit").
+
+Committing a transaction costs a disk sync, however few rows it writes, so a burst of requests
+that each insert one row and commit spends most of its time waiting on the disk. Instead, the
+requests of a Bazar.com service hand their statements to a single writer thread per process.
+The writer collects the statements of every request that arrives within GROUP_COMMIT_MAX_DELAY
+seconds of the first one (or until GROUP_COMMIT_MAX_ROWS statements are waiting), writes them in
+one transaction with one executemany() per distinct statement, and only then wakes the requests
+up. A request therefore returns exactly when its rows are committed, as before, but a single
+commit now covers a whole group of requests.
+
+The statements of one request are always committed together. If a group fails, its requests
+are retried one by one, so an error only reaches the request that caused it. In a traced request
+(see tracing.py), the wait for the commit is a span that records how many requests shared it.
+
+Environment Variables:
+- GROUP_COMMIT_MAX_DELAY: Seconds the writer waits for more requests before committing.
+                          Defaults to 0.002.
+- GROUP_COMMIT_MAX_ROWS: Statements per transaction at most. Defaults to 500.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+import db_pool
+import metrics
+import tracing
+
+MAX_DELAY = float(os.environ.get('GROUP_COMMIT_MAX_DELAY', 0.002))
+MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 500))
+
+logger = logging.getLogger(__name__)
+
+BATCH_REQUESTS = metrics.histogram('group_commit_batch_requests', 'Requests committed together by one group commit.',
+                                   buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+class _Request:
+    __slots__ = ('statements', 'done', 'error', 'batch')
+
+    def __init__(self, statements):
+        self.statements = statements
+        self.done = threading.Event()
+        self.error = None
+        self.batch = 0
+
+
+class GroupCommit:
+    """
+    Commits the writes of concurrent callers to one database file in shared transactions.
+
+    The writer thread is started on first use in every process, so an instance can be created
+    before a server forks its workers.
+    """
+
+    def __init__(self, database, max_rows=MAX_ROWS, max_delay=MAX_DELAY):
+        self.database = database
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def execute(self, *statements):
+        """
+        Writes (sql, params) statements in one transaction, shared with other callers.
+
+        Blocks until the transaction has committed, and raises the error that made it fail.
+        """
+        request = _Request(statements)
+        with tracing.span('group commit', statements=len(statements)) as span:
+            self._writer_queue().put(request)
+            request.done.wait()
+            span.set('batch_requests', request.batch)
+        if request.error is not None:
+            raise request.error
+
+    def _writer_queue(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Never rely on a writer thread (or queue) inherited from a parent process
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _run(self, requests):
+        while True:
+            batch = [requests.get()]
+            rows = len(batch[0].statements)
+            deadline = time.monotonic() + self.max_delay
+            while rows < self.max_rows:
+                timeout = deadline - time.monotonic()
+                try:
+                    request = requests.get(timeout=timeout) if timeout > 0 else requests.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(request)
+                rows += len(request.statements)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        BATCH_REQUESTS.observe((), len(batch))
+        try:
+            self._write(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                logger.warning("Group commit of %d requests failed (%s); retrying them one by one", len(batch), e)
+                for request in batch:
+                    try:
+                        self._write([request])
+                    except Exception as e:
+                        request.error = e
+        for request in batch:
+            request.batch = len(batch)
+            request.done.set()
+
+    def _write(self, batch):
+        groups = {}
+        for request in batch:
+            for sql, params in request.statements:
+                groups.setdefault(sql, []).append(params)
+        with db_pool.connection(self.database) as conn:
+            for sql, rows in groups.items():
+                conn.executemany(sql, rows)
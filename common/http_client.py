@@ -0,0 +1,203 @@
+"""
+http_client.py
+
+This module provides the HTTP client used for calls between Bazar.com services.
+
+Instead of the module-level requests.get/put/post helpers, which open a new TCP connection for
+every call, each upstream (scheme://host:port) gets its own long-lived requests.Session whose
+connection pool keeps connections alive between calls. Every call gets separate connect and read
+timeouts, and idempotent calls (GET/HEAD/OPTIONS) are retried with exponential backoff on
+connection errors and 502/503/504 responses. Other methods are only retried when the connection
+could not be established, i.e. when the request never reached the upstream. Callers that do
+their own failover (e.g. across replicas) can turn retries off per call. The duration of every
+call is recorded per upstream in the 'upstream_request_duration_seconds' metric (see metrics.py),
+and every call carries the trace context of the request that makes it (see tracing.py).
+
+Calls also respect the deadline of the request that makes them. A service that ran
+instrument_flask() takes the time its caller allows from the DEADLINE_HEADER of every request
+(or gives each request a default budget). Calls made while serving the request then shorten
+their timeouts to the time left, pass the rest on in the same header, and fail with
+DeadlineExceeded, without being sent, once none is left.
+
+Environment Variables:
+- HTTP_POOL_SIZE: Connections kept alive per upstream. Defaults to 20.
+- HTTP_CONNECT_TIMEOUT: Connect timeout in seconds. Defaults to 1.
+- HTTP_READ_TIMEOUT: Read timeout in seconds. Defaults to 5.
+- HTTP_RETRIES: Number of retries for idempotent calls. Defaults to 2.
+- HTTP_BACKOFF: Backoff factor in seconds between retries. Defaults to 0.1.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import tracing
+
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 1))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 5))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.1))
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# Seconds the caller of a request still waits for its answer
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+_deadline = contextvars.ContextVar('http_client_deadline', default=None)
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised instead of sending a call once the request that makes it has no time left.
+    """
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def _new_session(retries):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=BACKOFF,
+        allowed_methods=IDEMPOTENT_METHODS,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(url, retry=True):
+    """
+    Returns the pooled session for the upstream that 'url' points to.
+    """
+    global _pid
+    parts = urlsplit(url)
+    key = (f"{parts.scheme}://{parts.netloc}", retry)
+    session = _sessions.get(key)
+    if session is None or _pid != os.getpid():
+        with _sessions_lock:
+            if _pid != os.getpid():
+                # Never share sockets with a parent process after a fork
+                _sessions.clear()
+                _pid = os.getpid()
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _new_session(RETRIES if retry else 0)
+    return session
+
+
+def request(method, url, timeout=None, retry=True, **kwargs):
+    """
+    Sends a request through the upstream's pooled session.
+
+    'timeout' is either a single number applied to both phases or a (connect, read) tuple;
+    it defaults to (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), and is shortened to the time left
+    before the current deadline. 'retry=False' sends the request exactly once.
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    headers = kwargs.pop('headers', None)
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded(f"no time left for {method} {url}")
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        timeout = (min(connect, left), min(read, left))
+        headers = dict(headers or {}, **{DEADLINE_HEADER: f"{left:.3f}"})
+    parts = urlsplit(url)
+    upstream = f"{parts.scheme}://{parts.netloc}"
+    outcome = 'error'
+    start = time.perf_counter()
+    with tracing.span(f"{method} {upstream}{parts.path}", kind='client') as span:
+        try:
+            resp = get_session(url, retry).request(method, url, timeout=timeout,
+                                                   headers=tracing.headers(headers), **kwargs)
+            outcome = f'{resp.status_code // 100}xx'
+            span.set('status', resp.status_code)
+            return resp
+        finally:
+            metrics.UPSTREAM_LATENCY.observe((upstream, method, outcome), time.perf_counter() - start)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def remaining():
+    """
+    Returns the seconds left before the current deadline, or None if there is none.
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Calls made in the block must finish within 'seconds' (or the enclosing deadline, if sooner).
+    """
+    token = _set_deadline(seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _set_deadline(seconds):
+    current = _deadline.get()
+    deadline = time.monotonic() + seconds
+    return _deadline.set(deadline if current is None else min(current, deadline))
+
+
+def instrument_flask(app, default_timeout=None):
+    """
+    Gives every request of a Flask app the deadline its caller sent in DEADLINE_HEADER, or
+    'default_timeout' seconds if it sent none (or asked for more).
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _begin_deadline():
+        try:
+            seconds = float(request.headers[DEADLINE_HEADER])
+        except (KeyError, ValueError):
+            seconds = None
+        if default_timeout is not None and (seconds is None or seconds > default_timeout):
+            seconds = default_timeout
+        if seconds is not None:
+            g.deadline_token = _set_deadline(seconds)
+
+    @app.teardown_request
+    def _end_deadline(error):
+        token = g.pop('deadline_token', None)
+        if token is not None:
+            try:
+                _deadline.reset(token)
+            except ValueError:
+                # Ended from another context than it began in; that context is going away anyway
+                pass
@@ -0,0 +1,307 @@
+"""
+metrics.py
+
+This module collects the metrics of a Bazar.com service and renders them in the Prometheus text
+exposition format for its /metrics endpoint.
+
+Counters and histograms are plain dictionaries updated under one lock per metric, so recording a
+sample costs a few microseconds and instrumentation can stay on under full load. Values that
+other code already keeps (cache counters, pool occupancy, replication positions) are not copied
+on every change: they are registered as callbacks and read when the metrics are collected.
+
+Under gunicorn every worker process has its own metrics. Each worker writes a snapshot of them
+to a file in METRICS_DIR every METRICS_FLUSH_INTERVAL seconds (and when it exits), and /metrics,
+whichever worker serves it, adds up the snapshots of all workers and its own current values.
+Counters and histograms of workers that have exited are kept, so totals never go backwards;
+their gauges are dropped. Callbacks registered with scope='global' describe shared state (e.g.
+rows in the database) rather than the process: they are only evaluated by the process that
+renders the metrics, and not summed up.
+
+Environment Variables:
+- METRICS_DIR: Directory the worker processes share their metrics through. Unset (e.g. under
+               the development server), /metrics reports the serving process only.
+- METRICS_FLUSH_INTERVAL: Seconds between snapshots of a worker's metrics. Defaults to 1.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; suits both in-process work (SQLite) and calls to other services
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric):
+    with _registry_lock:
+        existing = _metrics.get(metric.name)
+        if existing is not None:
+            # Modules reloaded or imported under two names share the first registration
+            return existing
+        _metrics[metric.name] = metric
+        return metric
+
+
+class Counter:
+    """
+    A monotonically increasing count per combination of label values.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    """
+    Observations per combination of label values, counted in cumulative buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count per bucket (non-cumulative) ..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def collect(self):
+        with self._lock:
+            return {labels: list(counts) for labels, counts in self._values.items()}
+
+
+class Callback:
+    """
+    A metric whose values are read from a function when the metrics are collected.
+
+    'fn' returns {label values: value}. 'kind' is 'counter' or 'gauge'; gauges of several
+    processes are combined with 'aggregate' ('sum' or 'max').
+    """
+
+    def __init__(self, name, documentation, labelnames, fn, kind='gauge', aggregate='sum', scope='process'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self.type = kind
+        self.aggregate = aggregate
+        self.scope = scope
+
+    def collect(self):
+        try:
+            return {tuple(map(str, labels)): value for labels, value in self.fn().items()}
+        except Exception:
+            # A failing callback must not break the whole endpoint
+            return {}
+
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback(name, documentation, labelnames, fn, kind='gauge', aggregate='sum', scope='process'):
+    """
+    Registers a Callback metric; see Callback for the parameters.
+    """
+    return _register(Callback(name, documentation, labelnames, fn, kind, aggregate, scope))
+
+
+def _snapshot():
+    # The values of this process, as stored in its METRICS_DIR file
+    return {name: [[list(labels), value] for labels, value in metric.collect().items()]
+            for name, metric in list(_metrics.items())
+            if getattr(metric, 'scope', 'process') == 'process'}
+
+
+def flush():
+    """
+    Writes this process's snapshot to METRICS_DIR, if set.
+    """
+    directory = os.environ.get('METRICS_DIR')
+    if not directory:
+        return
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(_snapshot(), f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def clear():
+    """
+    Removes the snapshots of a previous run from METRICS_DIR; call before workers start.
+    """
+    directory = os.environ.get('METRICS_DIR')
+    if not directory or not os.path.isdir(directory):
+        return
+    for entry in os.listdir(directory):
+        if entry.endswith('.json'):
+            os.remove(os.path.join(directory, entry))
+
+
+def start():
+    """
+    Starts writing this process's snapshot every FLUSH_INTERVAL seconds (worker processes only).
+    """
+    if not os.environ.get('METRICS_DIR'):
+        return
+
+    def run():
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                flush()
+            except OSError:
+                pass
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _others():
+    # Snapshots of the other processes: [(alive, snapshot), ...]
+    directory = os.environ.get('METRICS_DIR')
+    if not directory or not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for entry in os.listdir(directory):
+        name, ext = os.path.splitext(entry)
+        if ext != '.json' or not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(directory, entry)) as f:
+                snapshots.append((_alive(int(name)), json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(metric, target, values):
+    for labels, value in values:
+        labels = tuple(labels)
+        current = target.get(labels)
+        if current is None:
+            target[labels] = list(value) if isinstance(value, list) else value
+        elif metric.type == 'histogram':
+            target[labels] = [a + b for a, b in zip(current, value)]
+        elif metric.type == 'gauge' and metric.aggregate == 'max':
+            target[labels] = max(current, value)
+        else:
+            target[labels] = current + value
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Returns every metric, of all worker processes, in the Prometheus text format.
+    """
+    others = _others()
+    lines = []
+    for name, metric in sorted(_metrics.items()):
+        values = {}
+        _merge(metric, values, metric.collect().items())
+        if getattr(metric, 'scope', 'process') == 'process':
+            for alive, snapshot in others:
+                if metric.type == 'gauge' and not alive:
+                    continue
+                _merge(metric, values, snapshot.get(name, ()))
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        for labels, value in sorted(values.items()):
+            if metric.type == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(metric.labelnames, labels, [("le", _format_value(bound))])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(metric.labelnames, labels)} {_format_value(value[-1])}')
+                lines.append(f'{name}_count{_format_labels(metric.labelnames, labels)} {cumulative}')
+            else:
+                lines.append(f'{name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = counter('http_requests_total', 'HTTP requests served, by route, method and status.',
+                   ('route', 'method', 'status'))
+REQUEST_LATENCY = histogram('http_request_duration_seconds',
+                            'Time to produce the response to an HTTP request (headers for streamed responses).',
+                            ('route', 'method'))
+UPSTREAM_LATENCY = histogram('upstream_request_duration_seconds',
+                             'Duration of calls to other services, by target and outcome, including retries.',
+                             ('upstream', 'method', 'outcome'))
+
+
+def instrument_flask(app):
+    """
+    Counts and times every request of a Flask app, per route (URL rule) and method.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            REQUEST_LATENCY.observe((route, request.method), time.perf_counter() - start)
+            REQUESTS.inc((route, request.method, str(response.status_code)))
+        return response
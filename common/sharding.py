@@ -0,0 +1,303 @@
+"""
+sharding.py
+
+This module partitions the books of the replicated Bazar.com catalog across shard groups.
+
+A shard group is a set of catalog replicas that replicate to each other (see replication.py) and
+hold only the books the group owns, so every group carries its own share of the writes and each
+group added adds write capacity. Ownership follows a consistent-hash ring: every group is placed
+at SHARD_VNODES points of a 64-bit ring, and a book belongs to the group at the first point after
+the hash of its ID. A group added to N others takes over about 1/(N+1) of the books, all of them
+from the existing groups, and no book moves between the existing groups.
+
+The shard map names the groups and lists their replicas; the first replica of a group is its
+primary, which takes the group's writes. The catalogs store the map with an epoch number and serve
+it at /shards, and the frontends and order services route every request for a book to its group
+by the newest map any catalog reports (see ShardRouter). While books are being moved after a
+change, the map also holds the previous groups, and a book its new group does not have yet is
+looked up at its previous one.
+
+Adding a group, online:
+1. Start its replicas with SHARD_NAME set and CATALOG_SHARDS unset: they start without books.
+2. Run 'python sharding.py reshard "<new map>"' with the map of every group, old and new. It
+   installs the map on every catalog, the primary of each group hands the books it no longer owns
+   over to their new group (see rebalance.py in the catalog service), and once every replica
+   reports that it is done the tool installs the map again, without the previous groups.
+
+Without CATALOG_SHARDS, frontends and order services treat their catalog replicas as one group.
+
+Environment Variables:
+- CATALOG_SHARDS: The shard map, as 'name=url,url;name=url,url'. Unset, the catalog is not sharded.
+- SHARD_VNODES: Points per group on the hash ring. Defaults to 64.
+- SHARD_REFRESH_INTERVAL: Seconds between two polls of the catalogs' shard maps. Defaults to 5.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import http_client
+
+VNODES = int(os.environ.get('SHARD_VNODES', 64))
+REFRESH_INTERVAL = float(os.environ.get('SHARD_REFRESH_INTERVAL', 5))
+
+# Answer of a catalog asked for a book that has moved to another group
+MISDIRECTED = 421
+
+
+def parse_shards(text):
+    """
+    Returns {group name: [replica URL, ...]} from a 'name=url,url;name=url,url' string.
+
+    Raises ValueError if a group has no name or no replicas.
+    """
+    shards = {}
+    for group in filter(None, (part.strip() for part in (text or '').split(';'))):
+        name, _, urls = group.partition('=')
+        urls = [url.strip().rstrip('/') for url in urls.split(',') if url.strip()]
+        if not name.strip() or not urls:
+            raise ValueError(f'invalid shard group {group!r}, expected name=url,url')
+        shards[name.strip()] = urls
+    return shards
+
+
+def format_shards(shards):
+    return ';'.join(f"{name}={','.join(urls)}" for name, urls in shards.items())
+
+
+def _hash(key):
+    # Must be the same in every process and service, so not the built-in hash()
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent-hash ring over group names, with 'vnodes' points per group.
+    """
+
+    def __init__(self, names, vnodes=VNODES):
+        points = sorted((_hash(f'{name}#{i}'), name) for name in names for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, book_id):
+        """
+        Returns the name of the group that owns a book, or None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        i = bisect.bisect_right(self._points, _hash(book_id))
+        return self._names[i % len(self._names)]
+
+
+class ShardMap:
+    """
+    One epoch of the shard map: the groups and, while books move, the previous groups.
+    """
+
+    def __init__(self, shards, epoch=0, previous=None):
+        self.shards = dict(shards)
+        self.epoch = epoch
+        self.previous = dict(previous) if previous else None
+        self._ring = HashRing(self.shards)
+        self._previous_ring = HashRing(self.previous) if self.previous else None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('shards') or {}, data.get('epoch', 0), data.get('previous'))
+
+    def to_dict(self):
+        return {'epoch': self.epoch, 'shards': self.shards, 'previous': self.previous}
+
+    @property
+    def rebalancing(self):
+        return self.previous is not None
+
+    def owner(self, book_id):
+        return self._ring.owner(book_id)
+
+    def owners(self, book_id):
+        """
+        Returns the groups to ask for a book, in order: its owner, then (while books move)
+        its previous owner if that is another group.
+        """
+        owners = [self._ring.owner(book_id)]
+        if self._previous_ring is not None:
+            previous = self._previous_ring.owner(book_id)
+            if previous not in owners:
+                owners.append(previous)
+        return owners
+
+    def group(self, name):
+        """
+        Returns the replica URLs of a current or previous group.
+        """
+        urls = self.shards.get(name)
+        if urls is None and self.previous:
+            urls = self.previous.get(name)
+        return urls or []
+
+    def names(self):
+        """
+        Returns the names of the current groups and of the previous ones.
+        """
+        return list(dict.fromkeys(list(self.shards) + list(self.previous or ())))
+
+    def urls(self):
+        return list(dict.fromkeys(url for name in self.names() for url in self.group(name)))
+
+
+class ShardRouter:
+    """
+    A frontend's or order service's copy of the shard map, refreshed from the catalogs.
+
+    The map starts out as CATALOG_SHARDS, or as a single group of 'default_urls', and is
+    replaced whenever a catalog reports a newer epoch. Functions passed to subscribe() are
+    called with every new map.
+    """
+
+    def __init__(self, default_urls):
+        shards = parse_shards(os.environ.get('CATALOG_SHARDS')) or {'catalog': list(default_urls)}
+        self.map = ShardMap(shards)
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, fn):
+        self._subscribers.append(fn)
+
+    def start(self, interval=REFRESH_INTERVAL):
+        threading.Thread(target=self._refresh_loop, args=(interval,), daemon=True).start()
+
+    def refresh(self):
+        """
+        Asks every known catalog for its map and adopts the newest one.
+
+        Returns True if the map changed.
+        """
+        newest = None
+        for url in self.map.urls():
+            try:
+                resp = http_client.get(f'{url}/shards', retry=False,
+                                       timeout=(http_client.CONNECT_TIMEOUT, 1))
+                resp.raise_for_status()
+                data = resp.json()
+            except Exception:
+                continue
+            if data.get('shards') and (newest is None or data['epoch'] > newest['epoch']):
+                newest = data
+        with self._lock:
+            if newest is None or newest['epoch'] <= self.map.epoch:
+                return False
+            self.map = ShardMap.from_dict(newest)
+            logging.info(f"Shard map epoch {self.map.epoch}: {format_shards(self.map.shards)}")
+        for fn in self._subscribers:
+            fn(self.map)
+        return True
+
+    def _refresh_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+    def route(self, book_id, send):
+        """
+        Calls send(group name) for the group that owns a book and returns its response.
+
+        While books are moving, a 404 from the owner is followed by a call to the previous
+        owner. A 421 (the book has moved away) refreshes the map and tries once more; if it is
+        returned from here, the book is being moved right now.
+        """
+        for _ in range(2):
+            resp = None
+            for name in self.map.owners(book_id):
+                resp = send(name)
+                if resp.status_code not in (404, MISDIRECTED):
+                    return resp
+            if resp.status_code != MISDIRECTED or not self.refresh():
+                return resp
+        return resp
+
+
+def _fetch(url):
+    resp = http_client.get(f'{url}/shards')
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _install(shard_map, urls):
+    for url in urls:
+        while True:
+            try:
+                resp = http_client.put(f'{url}/shards', json=shard_map.to_dict())
+                # 409: the replica already has this epoch (or a newer one)
+                if resp.status_code in (200, 409):
+                    break
+                resp.raise_for_status()
+            except Exception as e:
+                print(f'installing epoch {shard_map.epoch} on {url} failed, retrying: {e}')
+                time.sleep(1)
+
+
+def reshard(shards, poll_interval=1.0):
+    """
+    Moves the catalog to a new shard map, online; 'shards' must keep every current group.
+    """
+    states = {url: _fetch(url) for url in dict.fromkeys(url for urls in shards.values() for url in urls)}
+    current = ShardMap.from_dict(max(states.values(), key=lambda state: state['epoch']))
+    urls = list(dict.fromkeys(list(states) + current.urls()))
+    if current.rebalancing:
+        # An interrupted run: finish it
+        if current.shards != shards:
+            raise ValueError(f'epoch {current.epoch} is still being rebalanced; rerun with its map to finish it')
+        target = current
+    else:
+        removed = set(current.shards) - set(shards)
+        if removed:
+            raise ValueError(f'groups can only be added, not removed: {sorted(removed)}')
+        target = ShardMap(shards, current.epoch + 1, previous=current.shards or None)
+    _install(target, urls)
+    print(f'epoch {target.epoch} installed on {len(urls)} catalog replicas, moving books')
+    while True:
+        waiting = []
+        for url in urls:
+            try:
+                state = _fetch(url)
+            except Exception:
+                state = {}
+            if state.get('rebalanced', 0) < target.epoch:
+                waiting.append(url)
+        if not waiting:
+            break
+        print(f"waiting for {', '.join(waiting)}")
+        time.sleep(poll_interval)
+    final = ShardMap(shards, target.epoch + 1)
+    _install(final, urls)
+    print(f'epoch {final.epoch} installed, rebalancing done')
+    return final
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Show or change the shard map of the catalog.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('show', help="print a catalog replica's shard map")
+    show.add_argument('url', help='catalog replica, e.g. http://catalog_service_1:5000')
+    change = commands.add_parser('reshard', help='install a map with added groups and move the books')
+    change.add_argument('shards', help="every group, old and new: 'name=url,url;name=url,url'")
+    args = parser.parse_args(argv)
+    if args.command == 'show':
+        state = _fetch(args.url.rstrip('/'))
+        print(f"epoch {state['epoch']} (rebalanced: {state.get('rebalanced')}), this replica: {state.get('name')}")
+        for title, shards in (('groups', state.get('shards')), ('previous groups', state.get('previous'))):
+            if shards:
+                print(f'{title}: {format_shards(shards)}')
+        return 0
+    reshard(parse_shards(args.shards))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
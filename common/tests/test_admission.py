@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+from flask import Flask, Response, jsonify
+
+import admission
+from admission import HIGH, LOW, Limiter, Shed
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def acquire_in_thread(limiter, priority, order):
+    def acquire():
+        limiter.acquire(priority, timeout=5)
+        order.append(priority)
+    thread = threading.Thread(target=acquire, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_full_limiter_sheds_at_once():
+    limiter = Limiter('test', 1)
+    limiter.acquire()
+    with pytest.raises(Shed) as e:
+        limiter.acquire(timeout=5)
+    assert (e.value.limit, e.value.reason) == ('test', 'full')
+    limiter.release()
+    limiter.acquire()
+
+
+def test_queued_request_is_shed_after_its_timeout():
+    limiter = Limiter('test', 1, queue=1)
+    limiter.acquire()
+    with pytest.raises(Shed) as e:
+        limiter.acquire(timeout=0.01)
+    assert e.value.reason == 'timeout' and limiter.queued() == 0
+
+
+def test_reserved_slots_are_kept_for_purchases():
+    limiter = Limiter('test', 2, reserved=1)
+    limiter.acquire(LOW)
+    with pytest.raises(Shed):
+        limiter.acquire(LOW)
+    limiter.acquire(HIGH)
+    assert limiter.in_flight == 2
+
+
+def test_freed_slots_go_to_purchases_first():
+    limiter = Limiter('test', 1, queue=3)
+    limiter.acquire()
+    order = []
+    threads = [acquire_in_thread(limiter, LOW, order)]
+    wait_for(lambda: limiter.queued() == 1)
+    threads.append(acquire_in_thread(limiter, HIGH, order))
+    wait_for(lambda: limiter.queued() == 2)
+    limiter.release()
+    wait_for(lambda: order == [HIGH])
+    limiter.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == [HIGH, LOW]
+
+
+def test_limits_are_parsed():
+    assert admission.parse_limits('catalog=16:8, order=16:8:4') == {'catalog': (16, 8, 0), 'order': (16, 8, 4)}
+    for text in ('catalog=16', 'catalog=0:1', 'catalog=1:-1', '=1:1', 'catalog=a:b'):
+        with pytest.raises(ValueError):
+            admission.parse_limits(text)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(admission, 'limiters', {
+        'purchase': Limiter('purchase', 1), 'browse': Limiter('browse', 4),
+        'orders': Limiter('orders', 1), 'catalog': Limiter('catalog', 1),
+    })
+    app = Flask(__name__)
+    admission.instrument_flask(app)
+    app.release = threading.Event()
+
+    @app.route('/purchase/<int:book_id>', methods=['POST'])
+    def purchase(book_id):
+        app.release.wait(5)
+        return jsonify(bought=book_id)
+
+    @app.route('/info/<int:book_id>')
+    def info(book_id):
+        with admission.limit('catalog'):
+            return jsonify(id=book_id)
+
+    @app.route('/orders')
+    def orders():
+        return Response(iter(['[', ']']), mimetype='application/json')
+
+    return app
+
+
+def test_requests_over_the_limit_get_503_with_retry_after(app):
+    client = app.test_client()
+    # Buffered responses are closed, as the WSGI server closes them, which gives their slots back
+    thread = threading.Thread(target=lambda: client.post('/purchase/1', buffered=True), daemon=True)
+    thread.start()
+    wait_for(lambda: admission.limiters['purchase'].in_flight == 1)
+    resp = client.post('/purchase/2')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == str(admission.RETRY_AFTER)
+    assert resp.get_json()['limit'] == 'purchase'
+    # Other routes are admitted through their own limits
+    assert client.get('/info/1', buffered=True).status_code == 200
+    app.release.set()
+    thread.join(5)
+    assert admission.limiters['purchase'].in_flight == 0
+
+
+def test_slow_upstream_sheds_only_its_callers(app):
+    admission.limiters['catalog'].acquire()
+    resp = app.test_client().get('/info/1', buffered=True)
+    assert resp.status_code == 503 and resp.get_json()['limit'] == 'catalog'
+    assert admission.limiters['browse'].in_flight == 0
+
+
+def test_streamed_response_holds_its_slot_until_sent(app):
+    client = app.test_client()
+    resp = client.get('/orders', buffered=False)
+    assert admission.limiters['orders'].in_flight == 1
+    assert client.get('/orders', buffered=True).status_code == 503
+    resp.close()
+    assert admission.limiters['orders'].in_flight == 0
@@ -0,0 +1,183 @@
+import pytest
+
+import cache
+from cache import FRESH, REVALIDATE, STALE, SingleFlight, TTLCache, load_snapshot, save_snapshot
+
+
+class Clock:
+    """
+    Stands in for the time module in cache.py, so that entries age without sleeping
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    return clock
+
+
+def new_cache(**kwargs):
+    return TTLCache(**dict({'ttl': 10, 'negative_ttl': 1, 'stale_while_revalidate': 5, 'stale_if_error': 60},
+                           **kwargs))
+
+
+def test_entry_ages_from_fresh_to_revalidate_to_stale(clock):
+    c = new_cache()
+    c.put_response(('info', 1), {'title': 'a'}, 200)
+    assert c.lookup(('info', 1)) == (({'title': 'a'}, 200, None), FRESH)
+    clock.now += 12
+    assert c.lookup(('info', 1))[1] == REVALIDATE
+    assert c.get(('info', 1)) is None
+    clock.now += 10
+    assert c.lookup(('info', 1))[1] == STALE
+    assert c.get_stale(('info', 1)) == ({'title': 'a'}, 200, None)
+    clock.now += 50
+    assert c.lookup(('info', 1)) is None
+    assert c.get_stale(('info', 1)) is None
+    assert c.expirations == 1
+
+
+def test_get_stale_revalidates_while_the_upstream_fails(clock):
+    c = new_cache()
+    c.put_response(('info', 1), {'title': 'a'}, 200)
+    clock.now += 30
+    assert c.get_stale(('info', 1), revalidate=True) is not None
+    assert c.lookup(('info', 1))[1] == REVALIDATE
+    clock.now += 6
+    assert c.lookup(('info', 1))[1] == STALE
+
+
+def test_not_found_is_cached_briefly_and_never_stale(clock):
+    c = new_cache()
+    c.put_response(('info', 9), {'error': 'Item not found'}, 404)
+    assert c.get(('info', 9))[1] == 404
+    clock.now += 2
+    assert c.get_stale(('info', 9)) is None
+    c.put_response(('info', 9), {'error': 'boom'}, 500)
+    assert c.lookup(('info', 9)) is None
+
+
+def test_invalidated_entry_is_never_served_stale(clock):
+    c = new_cache()
+    c.put_response(('info', 1), {'title': 'a'}, 200)
+    c.invalidate(('info', 1))
+    assert c.get_stale(('info', 1)) is None
+
+
+def test_expire_keeps_entries_for_errors_only(clock):
+    c = new_cache()
+    c.put_response(('info', 1), {'title': 'a'}, 200)
+    c.expire()
+    assert c.lookup(('info', 1))[1] == STALE
+    assert c.get_stale(('info', 1)) is not None
+
+
+def test_put_fetched_before_an_invalidation_is_dropped(clock):
+    c = new_cache()
+    generation = c.generation
+    # The catalog answered with the old value; meanwhile the book changed and was invalidated
+    c.invalidate(('info', 1))
+    c.put_response(('info', 1), {'quantity': 5}, 200, generation)
+    assert c.lookup(('info', 1)) is None
+    c.put_response(('info', 1), {'quantity': 4}, 200, c.generation)
+    assert c.get(('info', 1)) == ({'quantity': 4}, 200, None)
+
+
+def test_invalidating_other_keys_keeps_the_put(clock):
+    c = new_cache()
+    generation = c.generation
+    # Purchases of other books while this one was fetched
+    for book_id in range(2, 50):
+        c.invalidate(('info', book_id))
+    c.put_response(('info', 1), {'quantity': 5}, 200, generation)
+    assert c.get(('info', 1)) == ({'quantity': 5}, 200, None)
+
+
+def test_expire_and_clear_drop_every_fill_started_before_them(clock):
+    c = new_cache()
+    generation = c.generation
+    c.expire()
+    c.put_response(('info', 1), {'quantity': 5}, 200, generation)
+    assert c.lookup(('info', 1)) is None
+    generation = c.generation
+    c.clear()
+    c.put_response(('info', 1), {'quantity': 5}, 200, generation)
+    assert c.lookup(('info', 1)) is None
+
+
+def test_fill_older_than_the_tracked_invalidations_is_dropped(clock, monkeypatch):
+    monkeypatch.setattr(cache, 'INVALIDATIONS_TRACKED', 2)
+    c = new_cache()
+    generation = c.generation
+    c.invalidate(('info', 1))
+    c.invalidate(('info', 2))
+    c.invalidate(('info', 3))
+    # The invalidation of book 1 is forgotten, so any fill that may predate it is dropped
+    c.put_response(('info', 9), {'quantity': 5}, 200, generation)
+    assert c.lookup(('info', 9)) is None
+    c.put_response(('info', 9), {'quantity': 5}, 200, c.generation)
+    assert c.get(('info', 9)) is not None
+
+
+def test_fetch_in_flight_during_an_invalidation_is_not_cached(clock):
+    c = new_cache()
+    inflight = SingleFlight()
+
+    def fetch():
+        generation = c.generation
+        c.invalidate(('info', 1))
+        c.put_response(('info', 1), {'quantity': 5}, 200, generation)
+        return {'quantity': 5}
+    # The caller still gets its answer, only the cache does not keep it
+    assert inflight.do(('info', 1), fetch) == {'quantity': 5}
+    assert c.lookup(('info', 1)) is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    c = new_cache(max_entries=2)
+    c.put(('info', 1), 'a')
+    c.put(('info', 2), 'b')
+    c.get(('info', 1))
+    c.put(('info', 3), 'c')
+    assert c.get(('info', 2)) is None
+    assert c.get(('info', 1)) == 'a'
+    assert c.evictions == 1
+
+
+def test_snapshot_restores_entries_with_their_age(clock, tmp_path):
+    c = new_cache()
+    c.put_response(('info', 1), {'title': 'a'}, 200)
+    c.put_response(('info', 2), {'error': 'Item not found'}, 404)
+    clock.now += 4
+    c.put_response(('search', 'x'), [{'id': 1}], 200)
+    path = str(tmp_path / 'cache.json')
+    assert save_snapshot(c, path, {'cursor': 7}) == 2
+
+    clock.now += 2
+    restored = new_cache()
+    assert load_snapshot(restored, path) == (2, {'cursor': 7})
+    assert restored.get(('search', 'x')) == ([{'id': 1}], 200, None)
+    assert restored.get(('info', 2)) is None
+    # Fresh for 10 seconds from the put, of which 6 are over
+    clock.now += 5
+    assert restored.lookup(('info', 1))[1] == REVALIDATE
+    assert restored.lookup(('search', 'x'))[1] == FRESH
+
+
+def test_missing_or_broken_snapshot_restores_nothing(clock, tmp_path):
+    c = new_cache()
+    assert load_snapshot(c, str(tmp_path / 'missing.json')) == (0, None)
+    broken = tmp_path / 'broken.json'
+    broken.write_text('{"entries": ')
+    assert load_snapshot(c, str(broken)) == (0, None)
+    assert c.stats()['entries'] == 0
@@ -0,0 +1,65 @@
+import pytest
+from flask import Flask, jsonify
+
+import codec
+
+PAYLOAD = {'id': 1, 'title': 'How to get a good grade in DOS in 40 minutes a day', 'cost': 20.5}
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    codec.install(app)
+
+    @app.route('/jsonified')
+    def jsonified():
+        return jsonify(PAYLOAD)
+
+    @app.route('/returned')
+    def returned():
+        return PAYLOAD, 201
+
+    return app.test_client()
+
+
+def body(resp):
+    return codec.decode(resp.get_data(), resp.content_type)
+
+
+@pytest.mark.parametrize('path', ['/jsonified', '/returned'])
+def test_services_get_msgpack_when_they_ask_for_it(client, path):
+    resp = client.get(path, headers={'Accept': codec.ACCEPT})
+    assert codec.is_msgpack(resp.content_type)
+    assert body(resp) == PAYLOAD
+
+
+@pytest.mark.parametrize('accept', [None, '*/*', 'application/json', 'application/x-msgpack;q=0.1, application/json'])
+def test_clients_get_json_by_default(client, accept):
+    resp = client.get('/jsonified', headers={'Accept': accept} if accept else {})
+    assert codec.is_json(resp.content_type)
+    assert resp.get_json() == PAYLOAD
+
+
+def test_without_msgpack_both_sides_fall_back_to_json(monkeypatch):
+    monkeypatch.setattr(codec, 'msgpack', None)
+    app = Flask(__name__)
+    codec.install(app)
+    app.route('/jsonified')(lambda: jsonify(PAYLOAD))
+    resp = app.test_client().get('/jsonified', headers={'Accept': 'application/x-msgpack'})
+    assert codec.is_json(resp.content_type) and body(resp) == PAYLOAD
+    with pytest.raises(ValueError):
+        codec.decode(b'\x81\xa2id\x01', codec.MSGPACK)
+
+
+@pytest.mark.parametrize('data, content_type', [
+    (b'\xc1', codec.MSGPACK), (b'not json', codec.JSON), (b'\x81\xa2id\x01', None),
+])
+def test_undecodable_bodies_raise_value_error(data, content_type):
+    with pytest.raises(ValueError):
+        codec.decode(data, content_type)
+
+
+def test_content_type_parameters_are_ignored():
+    assert codec.is_msgpack('Application/X-MsgPack; charset=binary')
+    assert codec.is_json('application/json; charset=utf-8')
+    assert not codec.is_json(None) and not codec.is_msgpack('text/html')
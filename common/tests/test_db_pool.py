@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+
+import pytest
+
+import db_pool
+from db_pool import ConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1)
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE t (n INTEGER NOT NULL)')
+    yield pool
+    pool.close()
+
+
+def acquire_in_thread(pool):
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()), daemon=True)
+    thread.start()
+    return thread, acquired
+
+
+def test_connection_commits_or_rolls_back(pool):
+    with pool.connection() as conn:
+        conn.execute('INSERT INTO t VALUES (1)')
+    with pytest.raises(sqlite3.IntegrityError):
+        with pool.connection() as conn:
+            conn.execute('INSERT INTO t VALUES (2)')
+            conn.execute('INSERT INTO t VALUES (NULL)')
+    with pool.connection() as conn:
+        assert conn.execute('SELECT n FROM t').fetchall() == [(1,)]
+
+
+def test_connections_are_reused(pool):
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    assert pool.usage() == (1, 0)
+
+
+def test_waiter_gets_a_released_connection(pool):
+    conn = pool.acquire()
+    thread, acquired = acquire_in_thread(pool)
+    thread.join(0.1)
+    assert thread.is_alive()
+    pool.release(conn)
+    thread.join(5)
+    assert acquired == [conn]
+
+
+def test_waiter_gets_a_new_connection_when_one_is_discarded(pool):
+    conn = pool.acquire()
+    thread, acquired = acquire_in_thread(pool)
+    thread.join(0.1)
+    assert thread.is_alive()
+    # E.g. a failed rollback: the slot is freed instead of the connection coming back
+    pool.discard(conn)
+    thread.join(5)
+    assert not thread.is_alive()
+    assert acquired[0] is not conn
+    assert acquired[0].execute('SELECT COUNT(*) FROM t').fetchone() == (0,)
+    pool.release(acquired[0])
+
+
+def test_connections_use_wal(pool):
+    with pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+        # NORMAL
+        assert conn.execute('PRAGMA synchronous').fetchone() == (1,)
+
+
+def test_readers_do_not_wait_for_a_writer(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'wal.db'), size=2)
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE t (n INTEGER NOT NULL)')
+        conn.execute('INSERT INTO t VALUES (1)')
+    writer = pool.acquire()
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute('INSERT INTO t VALUES (2)')
+    # The uncommitted write is neither visible nor in the way
+    with pool.connection() as conn:
+        assert conn.execute('SELECT n FROM t').fetchall() == [(1,)]
+    writer.commit()
+    pool.release(writer)
+    with pool.connection() as conn:
+        assert conn.execute('SELECT n FROM t ORDER BY n').fetchall() == [(1,), (2,)]
+    pool.close()
+
+
+def test_one_pool_per_database_and_process(tmp_path, monkeypatch):
+    path = str(tmp_path / 'shared.db')
+    pool = db_pool.get_pool(path)
+    assert db_pool.get_pool(path) is pool
+    # As seen from a child after a fork, which opens connections of its own
+    monkeypatch.setattr(pool, 'pid', pool.pid + 1)
+    assert db_pool.get_pool(path) is not pool
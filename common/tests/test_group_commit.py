@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+
+import pytest
+
+import db_pool
+from group_commit import GroupCommit
+
+INSERT = 'INSERT INTO t (id, n) VALUES (?, ?)'
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'group_commit.db')
+    with db_pool.connection(path) as conn:
+        conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, n INTEGER NOT NULL CHECK (n >= 0))')
+    return path
+
+
+def rows(database):
+    with db_pool.connection(database) as conn:
+        return sorted(conn.execute('SELECT id, n FROM t').fetchall())
+
+
+def record_batches(writer):
+    # Sizes of the groups handed to the database, failed ones included
+    batches = []
+    write = writer._write
+
+    def _write(batch):
+        batches.append(len(batch))
+        write(batch)
+    writer._write = _write
+    return batches
+
+
+def run_concurrently(writer, requests):
+    # Executes every request from a thread of its own, all released at once; returns their errors
+    start = threading.Barrier(len(requests))
+    errors = [None] * len(requests)
+
+    def execute(i):
+        start.wait()
+        try:
+            writer.execute(*requests[i])
+        except Exception as e:
+            errors[i] = e
+    threads = [threading.Thread(target=execute, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_concurrent_requests_share_one_commit(database):
+    writer = GroupCommit(database, max_delay=0.5)
+    batches = record_batches(writer)
+    errors = run_concurrently(writer, [[(INSERT, (i, i))] for i in range(8)])
+    assert errors == [None] * 8
+    assert rows(database) == [(i, i) for i in range(8)]
+    assert batches == [8]
+
+
+def test_group_is_bounded_by_max_rows(database):
+    writer = GroupCommit(database, max_rows=4, max_delay=0.5)
+    batches = record_batches(writer)
+    run_concurrently(writer, [[(INSERT, (i, i)), (INSERT, (100 + i, i))] for i in range(4)])
+    assert len(rows(database)) == 8
+    assert batches == [2, 2]
+
+
+def test_statements_of_a_request_are_rolled_back_together(database):
+    writer = GroupCommit(database)
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.execute((INSERT, (1, 1)), (INSERT, (2, -1)))
+    assert rows(database) == []
+
+
+def test_failed_group_is_retried_one_request_at_a_time(database):
+    writer = GroupCommit(database, max_delay=0.5)
+    batches = record_batches(writer)
+    requests = [[(INSERT, (i, i))] for i in range(3)] + [[(INSERT, (3, -1))]]
+    errors = run_concurrently(writer, requests)
+    # Only the request that broke the group fails; the others commit on their own
+    assert errors[:3] == [None] * 3
+    assert isinstance(errors[3], sqlite3.IntegrityError)
+    assert rows(database) == [(0, 0), (1, 1), (2, 2)]
+    assert batches == [4, 1, 1, 1, 1]
@@ -0,0 +1,125 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_client
+
+
+class Upstream(ThreadingHTTPServer):
+    """
+    A local upstream that answers with the statuses in 'statuses', in order (200 once they are
+    used up), and records every request as (method, client port, headers).
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.statuses = []
+        self.requests = []
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handle_one_request_as(self, method):
+        self.server.requests.append((method, self.client_address[1], dict(self.headers)))
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def do_GET(self):
+        self.handle_one_request_as('GET')
+
+    def do_POST(self):
+        self.handle_one_request_as('POST')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setattr(http_client, 'BACKOFF', 0)
+    server = Upstream()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_one_session_per_upstream():
+    session = http_client.get_session('http://catalog:5001/info/1')
+    assert http_client.get_session('http://catalog:5001/search/x') is session
+    assert http_client.get_session('http://order:5002/orders') is not session
+    # Calls that do their own failover get a session that never retries
+    assert http_client.get_session('http://catalog:5001/info/1', retry=False) is not session
+
+
+def test_session_is_not_shared_after_a_fork(monkeypatch):
+    session = http_client.get_session('http://catalog:5001/')
+    monkeypatch.setattr(http_client, '_pid', os.getpid() + 1)
+    assert http_client.get_session('http://catalog:5001/') is not session
+
+
+def test_connections_are_kept_alive(upstream):
+    for _ in range(3):
+        assert http_client.get(upstream.url + '/info/1').status_code == 200
+    ports = {port for _, port, _ in upstream.requests}
+    assert len(upstream.requests) == 3 and len(ports) == 1
+
+
+def test_idempotent_call_is_retried_on_unavailable(upstream):
+    upstream.statuses = [503, 502]
+    assert http_client.get(upstream.url + '/info/1').status_code == 200
+    assert [method for method, _, _ in upstream.requests] == ['GET'] * 3
+
+
+def test_retries_are_bounded(upstream):
+    upstream.statuses = [503] * 10
+    resp = http_client.get(upstream.url + '/info/1')
+    assert resp.status_code == 503
+    assert len(upstream.requests) == 1 + http_client.RETRIES
+
+
+def test_other_methods_are_not_retried_once_sent(upstream):
+    upstream.statuses = [503]
+    assert http_client.post(upstream.url + '/decrement', json={}).status_code == 503
+    assert len(upstream.requests) == 1
+
+
+def test_retry_false_sends_once(upstream):
+    upstream.statuses = [503]
+    assert http_client.get(upstream.url + '/info/1', retry=False).status_code == 503
+    assert len(upstream.requests) == 1
+
+
+def test_deadline_is_passed_on(upstream):
+    with http_client.deadline(2):
+        http_client.get(upstream.url + '/info/1')
+    left = float(upstream.requests[0][2][http_client.DEADLINE_HEADER])
+    assert 0 < left <= 2
+
+
+def test_call_without_time_left_is_not_sent(upstream):
+    with http_client.deadline(0):
+        with pytest.raises(http_client.DeadlineExceeded):
+            http_client.get(upstream.url + '/info/1')
+    assert upstream.requests == []
+
+
+def test_inner_deadline_cannot_extend_the_outer_one():
+    with http_client.deadline(1):
+        with http_client.deadline(60):
+            assert http_client.remaining() <= 1
+        assert http_client.remaining() <= 1
+    assert http_client.remaining() is None
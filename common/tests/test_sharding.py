@@ -0,0 +1,90 @@
+import pytest
+
+import sharding
+from sharding import HashRing, ShardMap, ShardRouter
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+def test_shard_map_is_parsed_and_formatted():
+    text = 'a=http://a1:5000/, http://a2:5000;b=http://b1:5000'
+    shards = sharding.parse_shards(text)
+    assert shards == {'a': ['http://a1:5000', 'http://a2:5000'], 'b': ['http://b1:5000']}
+    assert sharding.parse_shards(sharding.format_shards(shards)) == shards
+    assert sharding.parse_shards(None) == {}
+
+
+@pytest.mark.parametrize('text', ['a', 'a=', '=http://a1:5000', 'a=http://a1;b= , '])
+def test_invalid_shard_maps_are_rejected(text):
+    with pytest.raises(ValueError):
+        sharding.parse_shards(text)
+
+
+def test_added_group_only_takes_books_from_the_others():
+    before = HashRing(['a', 'b'])
+    after = HashRing(['a', 'b', 'c'])
+    moved = [book_id for book_id in range(1, 3001) if before.owner(book_id) != after.owner(book_id)]
+    assert all(after.owner(book_id) == 'c' for book_id in moved)
+    assert 0.2 < len(moved) / 3000 < 0.45
+    # Every process places the books the same way
+    assert [HashRing(['b', 'a']).owner(book_id) for book_id in range(1, 100)] == \
+        [before.owner(book_id) for book_id in range(1, 100)]
+    assert HashRing([]).owner(1) is None
+
+
+def test_books_are_looked_up_at_their_previous_group_while_moving():
+    shard_map = ShardMap({'a': ['http://a1'], 'b': ['http://b1']}, 2, previous={'a': ['http://a1']})
+    assert shard_map.rebalancing
+    assert shard_map.owners(1) == ['b', 'a'] and shard_map.owners(2) == ['a']
+    assert shard_map.names() == ['a', 'b']
+    assert shard_map.urls() == ['http://a1', 'http://b1']
+    assert ShardMap.from_dict(shard_map.to_dict()).owners(1) == ['b', 'a']
+    assert not ShardMap(shard_map.shards, 3).rebalancing
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setenv('CATALOG_SHARDS', 'a=http://a1')
+    return ShardRouter(['http://unused'])
+
+
+def test_router_falls_back_to_the_previous_group(router):
+    router.map = ShardMap({'a': ['http://a1'], 'b': ['http://b1']}, 2, previous={'a': ['http://a1']})
+    calls = []
+
+    def send(name):
+        calls.append(name)
+        # Book 1 has not reached group 'b' yet
+        return FakeResponse(404 if name == 'b' else 200)
+
+    assert router.route(1, send).status_code == 200
+    assert calls == ['b', 'a']
+
+
+def test_misdirected_request_refreshes_the_map_and_is_retried(router, monkeypatch):
+    newer = ShardMap({'a': ['http://a1'], 'b': ['http://b1']}, 3).to_dict()
+    monkeypatch.setattr(sharding.http_client, 'get', lambda url, **kwargs: FakeResponse(200, newer))
+    seen = []
+    router.subscribe(seen.append)
+    calls = []
+
+    def send(name):
+        calls.append(name)
+        # Group 'a' handed book 1 over to group 'b'
+        return FakeResponse(sharding.MISDIRECTED if name == 'a' else 200)
+
+    assert router.route(1, send).status_code == 200
+    assert calls == ['a', 'b']
+    assert router.map.epoch == 3 and [m.epoch for m in seen] == [3]
+    # An older or equal epoch is not adopted
+    assert not router.refresh()
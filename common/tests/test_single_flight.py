@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+from cache import SingleFlight
+
+
+def test_single_flight_shares_one_call():
+    inflight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'value'
+    results = []
+    leader = threading.Thread(target=lambda: results.append(inflight.do('k', fetch)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(inflight.do('k', fetch))) for _ in range(4)]
+    for thread in followers:
+        thread.start()
+    while inflight.shared < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert calls == [1]
+    assert results == ['value'] * 5
+
+
+def test_single_flight_shares_the_error():
+    inflight = SingleFlight()
+    with pytest.raises(ValueError):
+        inflight.do('k', lambda: int('x'))
+    # A failed call is not remembered
+    assert inflight.do('k', lambda: 1) == 1
+
+
+def test_single_flight_start_runs_one_background_refresh():
+    inflight = SingleFlight()
+    release, done = threading.Event(), threading.Event()
+    assert inflight.start('k', lambda: release.wait() and done.set())
+    assert not inflight.start('k', lambda: 'again')
+    release.set()
+    done.wait()
+    # Once it has finished, the next refresh starts a new call
+    while not inflight.start('k', lambda: None):
+        time.sleep(0.001)
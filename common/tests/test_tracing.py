@@ -0,0 +1,80 @@
+import os
+
+import pytest
+from flask import Flask, jsonify
+
+import db_pool
+import tracing
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+@pytest.fixture
+def trace_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_DIR', str(tmp_path / 'traces'))
+    # Spans of this test go to a new file
+    monkeypatch.setattr(tracing, '_file', None)
+    return tracing.TRACE_DIR
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = Flask(__name__)
+    tracing.instrument_flask(app)
+    database = str(tmp_path / 'traced.db')
+
+    @app.route('/work')
+    def work():
+        with db_pool.connection(database) as conn:
+            conn.execute('SELECT 1')
+        return jsonify(headers=tracing.headers({'Accept': 'application/json'}))
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize('header', [
+    'garbage', f'00-{TRACE_ID}-{PARENT_ID}', f'ff-{TRACE_ID}-{PARENT_ID}-01',
+    f'00-{"0" * 32}-{PARENT_ID}-01', f'00-{TRACE_ID[:-1]}-{PARENT_ID}-01', f'00-{TRACE_ID}-{"x" * 16}-01',
+])
+def test_malformed_traceparents_are_ignored(header):
+    assert tracing.parse(header) is None
+
+
+def test_traceparent_is_parsed():
+    assert tracing.parse(f'00-{TRACE_ID.upper()}-{PARENT_ID}-01') == (TRACE_ID, PARENT_ID, True)
+    assert tracing.parse(f'00-{TRACE_ID}-{PARENT_ID}-00') == (TRACE_ID, PARENT_ID, False)
+
+
+def test_sampled_request_records_its_spans_in_the_callers_trace(trace_dir, client):
+    resp = client.get('/work', headers={tracing.HEADER: f'00-{TRACE_ID}-{PARENT_ID}-01'})
+    assert resp.headers[tracing.REQUEST_ID_HEADER] == TRACE_ID
+    spans = {s['name']: s for s in tracing.load(trace_dir)}
+    assert set(spans) == {'GET /work', 'sqlite transaction'}
+    server = spans['GET /work']
+    assert server['trace_id'] == TRACE_ID and server['parent_id'] == PARENT_ID
+    assert server['attributes']['status'] == 200
+    assert spans['sqlite transaction']['parent_id'] == server['span_id']
+    # Calls to other services continue the trace below the request's span
+    outgoing = resp.get_json()['headers']
+    assert outgoing['Accept'] == 'application/json'
+    assert tracing.parse(outgoing[tracing.HEADER]) == (TRACE_ID, server['span_id'], True)
+    lines = tracing.timeline(tracing.load(trace_dir), TRACE_ID)
+    assert len(lines) == 2
+    assert '  common: GET /work' in lines[0] and '    common: sqlite transaction' in lines[1]
+
+
+def test_unsampled_request_records_nothing_but_propagates_its_trace(trace_dir, client, monkeypatch):
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 0)
+    resp = client.get('/work')
+    trace_id = resp.headers[tracing.REQUEST_ID_HEADER]
+    assert len(trace_id) == 32
+    assert tracing.parse(resp.get_json()['headers'][tracing.HEADER])[::2] == (trace_id, False)
+    client.get('/work', headers={tracing.HEADER: f'00-{TRACE_ID}-{PARENT_ID}-00'})
+    assert not os.path.exists(trace_dir)
+
+
+def test_no_headers_are_added_outside_of_a_request():
+    assert tracing.current() is None
+    assert tracing.headers() is None
+    assert tracing.headers({'a': 'b'}) == {'a': 'b'}
@@ -0,0 +1,333 @@
+"""
+tracing.py
+
+This module traces requests across the Bazar.com services, so that the latency of a slow request
+can be broken down by service and by hop.
+
+Every incoming request gets a span, and so does every call it makes to another service (see
+http_client.py) and every SQLite transaction it runs (see db_pool.py). Spans form a tree: each
+one knows its trace (the whole request, across services) and its parent. The trace context
+travels between services in the W3C 'traceparent' header, and the trace ID is returned to the
+client as X-Request-ID.
+
+Whether a trace is recorded is decided once, by the first service it reaches, for a fraction
+TRACE_SAMPLE_RATE of requests; the decision travels with the trace context, so a trace is
+either recorded by every service or by none. Clients can ask for a trace by sending a
+traceparent header with the sampled flag set. Spans of unsampled traces cost an ID and a few
+attribute lookups per request and are never written.
+
+Recorded spans are appended as JSON lines to one file per process in TRACE_DIR. When the
+services share that directory (a volume under Docker), 'python tracing.py <trace id>' rebuilds
+the timeline of a request from it, and 'python tracing.py' lists the slowest recent traces.
+
+Environment Variables:
+- TRACE_DIR: Directory the spans are written to. Unset, trace contexts are still propagated
+             but nothing is recorded.
+- TRACE_SAMPLE_RATE: Fraction of requests that are traced. Defaults to 0.01.
+- TRACE_SERVICE: Service name recorded in the spans. Defaults to the module's directory name.
+- TRACE_FILE_MAX_BYTES: Size at which a process's span file is rotated. Defaults to 64 MiB.
+"""
+
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_DIR = os.environ.get('TRACE_DIR')
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+SERVICE = os.environ.get('TRACE_SERVICE', os.path.basename(os.path.dirname(os.path.abspath(__file__))))
+FILE_MAX_BYTES = int(os.environ.get('TRACE_FILE_MAX_BYTES', 64 * 1024 * 1024))
+
+HEADER = 'traceparent'
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+_current = contextvars.ContextVar('trace_span', default=None)
+
+
+class Span:
+    """
+    One timed operation of a trace. Only the spans of sampled traces are written.
+    """
+
+    __slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'sampled', 'attributes',
+                 'start', '_started')
+
+    def __init__(self, name, kind, trace_id, parent_id, sampled, attributes):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def finish(self):
+        if self.sampled:
+            _export({
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'service': SERVICE,
+                'pid': os.getpid(),
+                'name': self.name,
+                'kind': self.kind,
+                'start': self.start,
+                'duration': time.perf_counter() - self._started,
+                'attributes': self.attributes,
+            })
+
+
+class _NoSpan:
+    # Stands in for the spans of unsampled traces, so callers need not check
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def parse(traceparent):
+    """
+    Returns (trace ID, parent span ID, sampled) from a traceparent header, or None if it is
+    malformed.
+    """
+    try:
+        version, trace_id, span_id, flags = traceparent.strip().lower().split('-')[:4]
+        int(trace_id, 16), int(span_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except (AttributeError, ValueError):
+        return None
+    if (version == 'ff' or len(trace_id) != 32 or len(span_id) != 16
+            or not trace_id.strip('0') or not span_id.strip('0')):
+        return None
+    return trace_id, span_id, sampled
+
+
+def begin(name, traceparent=None, kind='server', **attributes):
+    """
+    Starts the span of an incoming request, in the caller's trace if 'traceparent' is valid and
+    in a new one otherwise, and makes it the current span.
+
+    Returns (span, token) to pass to end().
+    """
+    parent = parse(traceparent) if traceparent else None
+    if parent is None:
+        parent = (f'{random.getrandbits(128):032x}', None, random.random() < SAMPLE_RATE)
+    span = Span(name, kind, parent[0], parent[1], parent[2], attributes)
+    return span, _current.set(span)
+
+
+def end(span, token):
+    """
+    Finishes a span started with begin() and restores the previous current span.
+    """
+    try:
+        _current.reset(token)
+    except ValueError:
+        # Ended from another context than it began in; that context is going away anyway
+        pass
+    span.finish()
+
+
+@contextmanager
+def trace(name, **attributes):
+    """
+    Runs the enclosed block in a new trace (sampled like a request), for background work that
+    calls other services, e.g. replication.
+    """
+    root, token = begin(name, kind='internal', **attributes)
+    try:
+        yield root
+    except BaseException as e:
+        root.set('error', type(e).__name__)
+        raise
+    finally:
+        end(root, token)
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """
+    Records the enclosed block as a child of the current span, if its trace is sampled.
+
+    Yields the span, or a stand-in whose set() does nothing.
+    """
+    parent = _current.get()
+    if parent is None or not parent.sampled:
+        yield _NO_SPAN
+        return
+    child = Span(name, kind, parent.trace_id, parent.span_id, True, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set('error', type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def current():
+    """
+    Returns the current span, or None outside of a traced request.
+    """
+    return _current.get()
+
+
+def headers(extra=None):
+    """
+    Returns the headers 'extra' (a dict or None) plus the traceparent of the current span, to
+    send with a call to another service.
+    """
+    span = _current.get()
+    if span is None:
+        return extra
+    result = dict(extra) if extra else {}
+    result[HEADER] = span.traceparent
+    return result
+
+
+_file = None
+_file_pid = None
+_file_lock = threading.Lock()
+
+
+def _export(record):
+    global _file, _file_pid
+    if not TRACE_DIR:
+        return
+    line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+    with _file_lock:
+        try:
+            if _file is None or _file_pid != os.getpid():
+                os.makedirs(TRACE_DIR, exist_ok=True)
+                _file = open(os.path.join(TRACE_DIR, f'{SERVICE}-{os.getpid()}.jsonl'), 'a')
+                _file_pid = os.getpid()
+            _file.write(line)
+            _file.flush()
+            if _file.tell() > FILE_MAX_BYTES:
+                _file.close()
+                os.replace(_file.name, _file.name + '.1')
+                _file = None
+        except OSError:
+            # Tracing must never fail the request it describes
+            _file = None
+
+
+def instrument_flask(app):
+    """
+    Traces every request of a Flask app and returns its trace ID as X-Request-ID.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _begin_span():
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        g.trace = begin(f'{request.method} {route}', request.headers.get(HEADER), path=request.path)
+
+    @app.after_request
+    def _record_status(response):
+        trace = g.get('trace')
+        if trace is not None:
+            trace[0].set('status', response.status_code)
+            response.headers[REQUEST_ID_HEADER] = trace[0].trace_id
+        return response
+
+    @app.teardown_request
+    def _end_span(error):
+        trace = g.pop('trace', None)
+        if trace is not None:
+            if error is not None:
+                trace[0].set('error', type(error).__name__)
+            end(*trace)
+
+
+def load(directory):
+    """
+    Returns every span recorded in a TRACE_DIR, as dicts.
+    """
+    spans = []
+    for entry in os.listdir(directory):
+        if not (entry.endswith('.jsonl') or entry.endswith('.jsonl.1')):
+            continue
+        with open(os.path.join(directory, entry)) as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    # A line being written right now
+                    continue
+    return spans
+
+
+def timeline(spans, trace_id):
+    """
+    Returns the lines of a trace's timeline: every span, indented below its parent, with its
+    start relative to the trace's first span, its duration and its attributes.
+    """
+    spans = sorted((s for s in spans if s['trace_id'] == trace_id), key=lambda s: s['start'])
+    if not spans:
+        return []
+    origin = spans[0]['start']
+    ids = {s['span_id'] for s in spans}
+    children = {}
+    for s in spans:
+        parent = s['parent_id'] if s['parent_id'] in ids else None
+        children.setdefault(parent, []).append(s)
+    lines = []
+
+    def add(s, depth):
+        attributes = ' '.join(f'{k}={v}' for k, v in s['attributes'].items())
+        lines.append(f"{(s['start'] - origin) * 1000:9.1f} ms {s['duration'] * 1000:9.1f} ms  "
+                     f"{'  ' * depth}{s['service']}: {s['name']}  {attributes}".rstrip())
+        for child in children.get(s['span_id'], ()):
+            add(child, depth + 1)
+
+    for root in children.get(None, ()):
+        add(root, 0)
+    return lines
+
+
+def slowest(spans, count=20):
+    """
+    Returns the root spans of the 'count' slowest traces, slowest first.
+    """
+    ids = {s['span_id'] for s in spans}
+    roots = [s for s in spans if s['parent_id'] not in ids]
+    return sorted(roots, key=lambda s: s['duration'], reverse=True)[:count]
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the traces recorded in a TRACE_DIR.')
+    parser.add_argument('trace_id', nargs='?', help='trace (X-Request-ID) to show; default: list the slowest')
+    parser.add_argument('--dir', default=TRACE_DIR, required=not TRACE_DIR, help='default: $TRACE_DIR')
+    parser.add_argument('--count', type=int, default=20, help='traces to list (default: 20)')
+    args = parser.parse_args(argv)
+    spans = load(args.dir)
+    if args.trace_id:
+        lines = timeline(spans, args.trace_id.lower())
+        print('\n'.join(lines) if lines else f'no spans of trace {args.trace_id}')
+        return 0 if lines else 1
+    for root in slowest(spans, args.count):
+        print(f"{root['trace_id']} {root['duration'] * 1000:9.1f} ms  {root['service']}: {root['name']}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,38 @@
+"""
+Test setup shared by every service's tests/ directory.
+
+Each service runs from its own directory with the modules of common/ next to it, and imports both
+as top-level modules (app, database, metrics, ...). Several services have modules of the same name,
+so before the tests of a service are collected, its directory is put first on sys.path and the
+modules that another service's tests imported under those names are forgotten.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+COMMON = os.path.join(ROOT, 'common')
+
+sys.path.insert(0, COMMON)
+_service = None
+
+
+def _enter(service):
+    global _service
+    if service == _service:
+        return
+    for name, module in list(sys.modules.items()):
+        directory = os.path.dirname(getattr(module, '__file__', None) or '')
+        if (directory.startswith(ROOT + os.sep) and directory not in (service, COMMON)
+                and os.path.basename(directory) != 'tests'):
+            del sys.modules[name]
+    if _service in sys.path:
+        sys.path.remove(_service)
+    sys.path.insert(0, service)
+    _service = service
+
+
+def pytest_collectstart(collector):
+    path = getattr(collector, 'path', None)
+    if path is not None and path.suffix == '.py' and path.parent.name == 'tests':
+        _enter(str(path.parent.parent))
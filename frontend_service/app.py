@@ -1,53 +1,253 @@
 # frontend_service.py
-from flask import Flask, jsonify, make_response
+from flask import Flask, Response, g, jsonify, make_response, request
 import requests
 import logging
+import os
+import threading
+import time
+import admission
+import codec
+import http_client
+import metrics
+import tracing
+from cache import (FRESH, REVALIDATE, REVALIDATION_FAILED_WARNING, STALE_WARNING, TTLCache, SingleFlight,
+                   export_metrics, load_snapshot, save_snapshot)
 
 app = Flask(__name__)
+metrics.instrument_flask(app)
+tracing.instrument_flask(app)
+# deadlines, per-route and per-upstream limits, load shedding (see admission.py)
+admission.instrument_flask(app)
 logging.basicConfig(level=logging.INFO)
 
-CATALOG_SERVICE_URL = 'http://catalog_service:5001'
-ORDER_SERVICE_URL = 'http://order_service:5002'
+CATALOG_SERVICE_URL = os.environ.get('CATALOG_SERVICE_URL', 'http://catalog_service:5001')
+ORDER_SERVICE_URL = os.environ.get('ORDER_SERVICE_URL', 'http://order_service:5002')
 
-# helper to call upstream safely
-def safe_request(method, url, **kwargs):
+# read-through cache for /info and /search; restocks are picked up from the catalog's
+# restock log (see follow_restocks), other catalog-side writes only through the TTL, so keep it short
+cache = TTLCache(ttl=float(os.environ.get('CACHE_TTL', 5)))
+inflight = SingleFlight()
+export_metrics(cache)
+# seconds between polls of the catalog's restock log, and events read per poll
+# (a full page means there are more)
+RESTOCK_POLL_INTERVAL = float(os.environ.get('RESTOCK_POLL_INTERVAL', 5))
+RESTOCK_PAGE_SIZE = 1000
+# position in the restock log, and whether follow_restocks has caught up with it
+restock_cursor = 0
+restocks_synced = threading.Event()
+
+# a worker saves its most recently used cache entries here when it exits, with its position in
+# the restock log, and a new worker loads them (unset: no snapshot). In the background, every
+# worker also loads up to CACHE_WARMUP_BOOKS books from the catalog's /books dump, for at most
+# CACHE_WARMUP_TIMEOUT seconds, while it already serves requests; /health answers 503 until then
+CACHE_SNAPSHOT = os.environ.get('CACHE_SNAPSHOT')
+CACHE_WARMUP_BOOKS = int(os.environ.get('CACHE_WARMUP_BOOKS', 512))
+CACHE_WARMUP_TIMEOUT = float(os.environ.get('CACHE_WARMUP_TIMEOUT', 10))
+WARMUP_PAGE_SIZE = 500
+ready = threading.Event()
+
+# same bound as the catalog's batch endpoints
+MAX_BATCH_ITEMS = 500
+# page size of title searches if the client gives none (sent explicitly, see search_response)
+SEARCH_PAGE_SIZE = 50
+# bytes read from the order service at a time while streaming /orders
+ORDERS_STREAM_CHUNK = 65536
+
+# helper to call upstream safely (over pooled keep-alive connections); calls made for a
+# client request hold a slot of their upstream's admission limit, and raise admission.Shed
+# (answered with a 503) if there is none
+def safe_request(method, url, upstream=None, **kwargs):
     try:
-        resp = requests.request(method, url, timeout=5, **kwargs)
-        return resp
+        if upstream is None:
+            return http_client.request(method, url, **kwargs)
+        with admission.limit(upstream):
+            return http_client.request(method, url, **kwargs)
     except requests.RequestException as e:
         app.logger.error("Upstream request failed: %s %s -> %s", method, url, e)
         return None
 
-@app.route('/search/<topic>', methods=['GET'])
-def search(topic):
-    resp = safe_request('GET', f"{CATALOG_SERVICE_URL}/search/{topic}")
+# fetch a catalog resource through the cache; concurrent misses for the same key
+# share a single upstream request instead of each hitting the catalog. An entry past its
+# TTL is answered with right away while it is refreshed in the background, and one kept for
+# errors (see cache.py) when the catalog fails or its admission limit sheds the request
+def cached_catalog_get(key, path, params=None):
+    cached = cache.lookup(key)
+    if cached is not None and cached[1] == FRESH:
+        return cached[0]
+    if cached is not None and cached[1] == REVALIDATE:
+        inflight.start(key, lambda: refresh_catalog(key, path, params))
+        mark_stale(STALE_WARNING)
+        return cached[0]
+    try:
+        result = inflight.do(key, lambda: fetch_catalog(key, path, params))
+    except admission.Shed:
+        stale = serve_stale(key)
+        if stale is None:
+            raise
+        return stale
+    if result[1] >= 500:
+        return serve_stale(key) or result
+    return result
+
+# background refreshes run outside of any request, so without its deadline, and in an app
+# context of their own
+def refresh_catalog(key, path, params=None):
+    with app.app_context():
+        return fetch_catalog(key, path, params)
+
+# the stale entry of key, if the cache still has one, marking the response as stale
+def serve_stale(key):
+    stale = cache.get_stale(key, revalidate=True)
+    if stale is not None:
+        mark_stale(REVALIDATION_FAILED_WARNING)
+    return stale
+
+# {id: item} of the stale entries of ids (404s left out), or None if one of them is gone
+def stale_items(ids):
+    stale = {item_id: cache.get_stale(('info', item_id)) for item_id in ids}
+    if None in stale.values():
+        return None
+    mark_stale(REVALIDATION_FAILED_WARNING)
+    return {item_id: cached[0] for item_id, cached in stale.items() if cached[1] == 200}
+
+def mark_stale(warning):
+    g.cache_warning = warning
+
+@app.after_request
+def add_cache_warning(response):
+    warning = g.pop('cache_warning', None)
+    if warning is not None:
+        response.headers['Warning'] = warning
+    return response
+
+# the catalog answers in MessagePack if it can (see codec.py); the JSON body for our clients is
+# encoded once here, or taken as is from a JSON answer, and cached with the payload
+def fetch_catalog(key, path, params=None):
+    generation = cache.generation
+    resp = safe_request('GET', f"{CATALOG_SERVICE_URL}{path}", 'catalog', params=params,
+                        headers={'Accept': codec.ACCEPT})
     if resp is None:
-        return make_response(jsonify({"error": "catalog unreachable"}), 503)
+        return {"error": "catalog unreachable"}, 503, None
+    content_type = resp.headers.get('Content-Type')
     try:
-        return jsonify(resp.json()), resp.status_code
+        payload = codec.decode(resp.content, content_type)
     except ValueError:
-        app.logger.error("Catalog returned non-JSON: %s", resp.text[:200])
-        return make_response(jsonify({"error": "catalog returned non-JSON"}), 502)
+        app.logger.error("Catalog returned an undecodable body for %s: %s", path, resp.content[:200])
+        return {"error": "catalog returned non-JSON"}, 502, None
+    body = resp.content if codec.is_json(content_type) else jsonify(payload).get_data()
+    cache.put_response(key, payload, resp.status_code, generation, body)
+    return payload, resp.status_code, body
+
+# sends a cached JSON body as is; payloads without one are encoded
+def json_response(payload, status, body=None):
+    if body is None:
+        return make_response(jsonify(payload), status)
+    return Response(body, status=status, mimetype='application/json')
+
+# searches can be paginated with limit/cursor; the catalog sends X-Next-Cursor exactly
+# when a page is full, so the header is rebuilt here instead of being cached
+def search_response(payload, status, limit, body=None):
+    response = json_response(payload, status, body)
+    if status == 200 and limit is not None and len(payload) == int(limit):
+        response.headers['X-Next-Cursor'] = str(payload[-1]['id'])
+    return response
+
+@app.route('/search/<topic>', methods=['GET'])
+def search(topic):
+    limit, cursor = request.args.get('limit'), request.args.get('cursor')
+    if limit is None and cursor is None:
+        payload, status, body = cached_catalog_get(('search', topic), f"/search/{topic}")
+    else:
+        params = {k: v for k, v in (('limit', limit), ('cursor', cursor)) if v is not None}
+        payload, status, body = cached_catalog_get(('search', topic, limit, cursor), f"/search/{topic}", params)
+    return search_response(payload, status, limit, body)
+
+# title substring search
+@app.route('/search', methods=['GET'])
+def search_title():
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', str(SEARCH_PAGE_SIZE))
+    params = {'q': query, 'limit': limit}
+    if 'cursor' in request.args:
+        params['cursor'] = request.args['cursor']
+    payload, status, body = cached_catalog_get(('title', query, limit, params.get('cursor')), "/search", params)
+    return search_response(payload, status, limit, body)
 
 @app.route('/info/<int:item_id>', methods=['GET'])
 def info(item_id):
-    resp = safe_request('GET', f"{CATALOG_SERVICE_URL}/info/{item_id}")
-    if resp is None:
-        return make_response(jsonify({"error": "catalog unreachable"}), 503)
+    return json_response(*cached_catalog_get(('info', item_id), f"/info/{item_id}"))
+
+# parse ?ids=1,2,3 into distinct ids (request order); None if invalid
+def parse_ids(raw):
     try:
-        return jsonify(resp.json()), resp.status_code
+        ids = list(dict.fromkeys(int(part) for part in raw.split(',')))
     except ValueError:
-        app.logger.error("Catalog returned non-JSON for info: %s", resp.text[:200])
-        return make_response(jsonify({"error": "catalog returned non-JSON"}), 502)
+        return None
+    if not ids or len(ids) > MAX_BATCH_ITEMS:
+        return None
+    return ids
+
+# multi-get: ids found in the cache are answered from it, only the rest is fetched
+# from the catalog, with a single /info?ids= call; the results are cached per id
+@app.route('/info', methods=['GET'])
+def info_batch():
+    ids = parse_ids(request.args.get('ids', ''))
+    if ids is None:
+        return make_response(jsonify({"error": f"ids must be a comma separated list of at most {MAX_BATCH_ITEMS} book IDs"}), 400)
+    found, wanted = {}, []
+    for item_id in ids:
+        cached = cache.get(('info', item_id))
+        if cached is None:
+            wanted.append(item_id)
+        elif cached[1] == 200:
+            found[item_id] = cached[0]
+    if wanted:
+        generation = cache.generation
+        shed = None
+        try:
+            resp = safe_request('GET', f"{CATALOG_SERVICE_URL}/info", 'catalog',
+                                params={'ids': ','.join(map(str, wanted))}, headers={'Accept': codec.ACCEPT})
+        except admission.Shed as e:
+            resp, shed = None, e
+        # if the catalog fails, answered from stale entries as long as the cache has all of them
+        stale = stale_items(wanted) if resp is None or resp.status_code >= 500 else None
+        if stale is not None:
+            found.update(stale)
+        elif shed is not None:
+            raise shed
+        elif resp is None:
+            return make_response(jsonify({"error": "catalog unreachable"}), 503)
+        else:
+            try:
+                payload = codec.decode(resp.content, resp.headers.get('Content-Type'))
+            except ValueError:
+                app.logger.error("Catalog returned an undecodable body for /info: %s", resp.content[:200])
+                return make_response(jsonify({"error": "catalog returned non-JSON"}), 502)
+            if resp.status_code != 200:
+                return make_response(jsonify(payload), resp.status_code)
+            for key, item in payload['items'].items():
+                found[int(key)] = item
+                cache.put_response(('info', int(key)), item, 200, generation)
+            for item_id in payload['missing']:
+                cache.put_response(('info', item_id), {"error": "Item not found"}, 404, generation)
+    return jsonify({
+        "items": {str(item_id): found[item_id] for item_id in ids if item_id in found},
+        "missing": [item_id for item_id in ids if item_id not in found]
+    })
 
 @app.route('/purchase/<int:item_id>', methods=['PUT', 'POST'])
 def purchase(item_id):
     # forward the request to order service (use PUT as original code did)
-    resp = safe_request('PUT', f"{ORDER_SERVICE_URL}/purchase/{item_id}")
+    resp = safe_request('PUT', f"{ORDER_SERVICE_URL}/purchase/{item_id}", 'order')
     if resp is None:
         return make_response(jsonify({"error": "order service unreachable"}), 503)
+    # the stock of this item has (probably) changed; drop our copy of it
+    cache.invalidate(('info', item_id))
+    # a JSON answer needs no changes: pass its bytes through
+    if codec.is_json(resp.headers.get('Content-Type')):
+        return Response(resp.content, status=resp.status_code, mimetype='application/json')
 
-    # try to parse JSON safely
+    # otherwise try to parse JSON safely
     try:
         payload = resp.json()
     except ValueError:
@@ -65,16 +265,174 @@ def purchase(item_id):
     # return payload and use upstream status code
     return make_response(jsonify(payload), resp.status_code)
 
+# buy several books with one order-service call: {"ids": [1, 2, 2]}
+@app.route('/purchase/batch', methods=['POST'])
+def purchase_batch():
+    data = request.get_json(silent=True) or {}
+    resp = safe_request('POST', f"{ORDER_SERVICE_URL}/purchase/batch", 'order', json=data)
+    if resp is None:
+        return make_response(jsonify({"error": "order service unreachable"}), 503)
+    # the stock of these items has (probably) changed
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if isinstance(ids, list):
+        for item_id in {i for i in ids if isinstance(i, int) and not isinstance(i, bool)}:
+            cache.invalidate(('info', item_id))
+    if not codec.is_json(resp.headers.get('Content-Type')):
+        app.logger.error("Order service returned non-JSON for /purchase/batch: %s", resp.text[:200])
+        return make_response(jsonify({"error": "order service returned non-JSON"}), 502)
+    return Response(resp.content, status=resp.status_code, mimetype='application/json')
+
+# the order list can be arbitrarily long: forward the filters and stream the order
+# service's response through in chunks instead of buffering and re-encoding it
 @app.route('/orders', methods=['GET'])
 def get_all_orders():
-    resp = safe_request('GET', f"{ORDER_SERVICE_URL}/orders")
+    headers = {'Accept': request.headers['Accept']} if 'Accept' in request.headers else {}
+    # the order service is busy until the whole export has been streamed, so its slot is
+    # held until then instead of only for the call
+    release = admission.hold('order')
+    try:
+        resp = safe_request('GET', f"{ORDER_SERVICE_URL}/orders", params=request.args,
+                            headers=headers, stream=True)
+    except BaseException:
+        release()
+        raise
     if resp is None:
+        release()
         return make_response(jsonify({"error": "order service unreachable"}), 503)
+
+    def body():
+        try:
+            yield from resp.iter_content(ORDERS_STREAM_CHUNK)
+        finally:
+            resp.close()
+
+    response = Response(body(), status=resp.status_code,
+                        content_type=resp.headers.get('Content-Type', 'application/json'))
+    if 'X-Next-Cursor' in resp.headers:
+        response.headers['X-Next-Cursor'] = resp.headers['X-Next-Cursor']
+    response.call_on_close(release)
+    return response
+
+@app.route('/invalidate/<int:item_id>', methods=['POST'])
+def invalidate(item_id):
+    cache.invalidate(('info', item_id))
+    return jsonify({"status": "cache invalidated"})
+
+# readiness: 503 until the cache has been warmed up (see warm_up)
+@app.route('/health', methods=['GET'])
+def health():
+    if not ready.is_set():
+        return make_response(jsonify({"status": "warming up"}), 503)
+    return jsonify({"status": "ok"})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(cache.stats())
+
+# request, upstream and cache metrics of all worker processes, for Prometheus
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+# restocks change quantities behind the cache's back: follow the catalog's restock log
+# and drop what is cached about every restocked book. Events trimmed from the log before they
+# were read (after a long pause, or since a restored snapshot was saved) end the freshness of
+# the whole cache instead
+def follow_restocks():
+    global restock_cursor
+    while True:
+        resp = safe_request('GET', f"{CATALOG_SERVICE_URL}/restock/events",
+                            params={'cursor': restock_cursor, 'limit': RESTOCK_PAGE_SIZE},
+                            headers={'Accept': codec.ACCEPT})
+        ok = resp is not None and resp.status_code == 200
+        try:
+            events = codec.decode(resp.content, resp.headers.get('Content-Type')) if ok else []
+        except ValueError:
+            events, ok = [], False
+        if events and events[0]['seq'] > restock_cursor + 1:
+            cache.expire()
+        for event in events:
+            cache.invalidate(('info', event['id']))
+        if events:
+            restock_cursor = events[-1]['seq']
+            if len(events) == RESTOCK_PAGE_SIZE:
+                continue
+        if ok:
+            restocks_synced.set()
+        time.sleep(RESTOCK_POLL_INTERVAL)
+
+# loads the cache snapshot and the restock log position saved with it; before
+# start_worker_tasks, so that follow_restocks replays the restocks since
+def restore_cache():
+    global restock_cursor
+    if not CACHE_SNAPSHOT:
+        return
+    restored, state = load_snapshot(cache, CACHE_SNAPSHOT)
+    if state:
+        restock_cursor = state.get('restock_cursor', 0)
+    app.logger.info("Restored %d cache entries from %s", restored, CACHE_SNAPSHOT)
+
+# writes the cache snapshot, when the worker exits
+def save_cache():
+    if not CACHE_SNAPSHOT:
+        return
+    # position first: a restock applied after it was read is replayed again,
+    # instead of missing from entries saved before it
+    state = {'restock_cursor': restock_cursor}
+    saved = save_snapshot(cache, CACHE_SNAPSHOT, state)
+    app.logger.info("Saved %d cache entries to %s", saved, CACHE_SNAPSHOT)
+
+# pages through the catalog's /books dump into the cache, once follow_restocks has caught up
+# (so that only later restocks evict them), then reports ready; a catalog that fails only
+# leaves the cache colder
+def warm_up():
+    loaded, cursor = 0, 0
     try:
-        return jsonify(resp.json()), resp.status_code
-    except ValueError:
-        app.logger.error("Order service returned non-JSON for /orders: %s", resp.text[:200])
-        return make_response(jsonify({"error": "order service returned non-JSON"}), 502)
+        with http_client.deadline(CACHE_WARMUP_TIMEOUT):
+            # half of the time at most: a catalog that is down is not waited for
+            restocks_synced.wait(CACHE_WARMUP_TIMEOUT / 2)
+            while loaded < CACHE_WARMUP_BOOKS:
+                generation = cache.generation
+                resp = http_client.request('GET', f"{CATALOG_SERVICE_URL}/books", headers={'Accept': codec.ACCEPT},
+                                           params={'cursor': cursor,
+                                                   'limit': min(WARMUP_PAGE_SIZE, CACHE_WARMUP_BOOKS - loaded)})
+                resp.raise_for_status()
+                books = codec.decode(resp.content, resp.headers.get('Content-Type'))
+                for book in books:
+                    item = {'title': book['title'], 'quantity': book['quantity'], 'price': book['price']}
+                    cache.put_response(('info', book['id']), item, 200, generation)
+                loaded += len(books)
+                if 'X-Next-Cursor' not in resp.headers:
+                    break
+                cursor = resp.headers['X-Next-Cursor']
+        app.logger.info("Cache warmed up with %d books", loaded)
+    except (requests.RequestException, ValueError) as e:
+        app.logger.warning("Cache warm-up stopped early after %d books: %s", loaded, e)
+    finally:
+        ready.set()
+
+# per worker process, after the fork (see gunicorn.conf.py)
+def start_worker_tasks():
+    threading.Thread(target=follow_restocks, daemon=True).start()
+
+# warms the cache up in the background, so the worker takes requests meanwhile; after
+# CACHE_WARMUP_TIMEOUT seconds the worker reports ready even if the warm-up is stuck
+def start_warm_up():
+    threading.Thread(target=warm_up, name='cache-warm-up', daemon=True).start()
+    deadline = threading.Timer(CACHE_WARMUP_TIMEOUT, end_warm_up)
+    deadline.daemon = True
+    deadline.start()
+
+# reports ready with whatever the cache holds, if the warm-up has not finished yet
+def end_warm_up():
+    if not ready.is_set():
+        app.logger.warning("Cache warm-up took over %ss, reporting ready with a cold cache", CACHE_WARMUP_TIMEOUT)
+        ready.set()
 
 if __name__ == '__main__':
+    import atexit
+    restore_cache()
+    start_worker_tasks()
+    start_warm_up()
+    atexit.register(save_cache)
     app.run(host='0.0.0.0', port=5000, debug=True)
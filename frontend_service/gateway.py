@@ -0,0 +1,476 @@
+"""
+gateway.py
+
+This module implements an asyncio version of the Bazar.com frontend.
+
+It serves the same routes as app.py (/search, /info, /purchase, /orders, /invalidate,
+/cache/stats and /metrics, including the batch variants) and shares its response cache implementation, but waits on the catalog and order
+services without holding a thread: one event loop per process keeps every in-flight upstream
+call on a single aiohttp session, whose connector pools keep-alive connections to each upstream.
+A process can therefore hold thousands of client requests that are waiting on upstream calls,
+bounded by UPSTREAM_POOL_SIZE connections per upstream rather than by a thread count.
+
+Concurrent cache misses for the same key share one upstream fetch, as in the threaded frontend.
+Catalog responses are fetched in MessagePack where possible (see codec.py) and cached together
+with their JSON encoding, so cache hits are sent without encoding anything.
+Idempotent upstream calls (GET) are retried with exponential backoff on connection errors and
+502/503/504 responses; purchases are only retried when the connection could not be made.
+
+Run it with gunicorn (FRONTEND_MODE=async, see gunicorn.conf.py) or directly with
+'python gateway.py' for development.
+
+Environment Variables:
+- CATALOG_SERVICE_URL: Base URL of the catalog service. Defaults to 'http://catalog_service:5001'.
+- ORDER_SERVICE_URL: Base URL of the order service. Defaults to 'http://order_service:5002'.
+- UPSTREAM_POOL_SIZE: Connections kept per upstream. Defaults to 100.
+- HTTP_CONNECT_TIMEOUT: Connect timeout in seconds. Defaults to 1.
+- HTTP_READ_TIMEOUT: Read timeout in seconds. Defaults to 5.
+- HTTP_RETRIES: Number of retries for idempotent calls. Defaults to 2.
+- HTTP_BACKOFF: Backoff factor in seconds between retries. Defaults to 0.1.
+- CACHE_TTL: Lifetime of a cached catalog response in seconds. Defaults to 5.
+- RESTOCK_POLL_INTERVAL: Seconds between polls of the catalog's restock log. Defaults to 5.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+
+import codec
+import metrics
+import tracing
+from cache import TTLCache, export_metrics
+
+CATALOG_SERVICE_URL = os.environ.get('CATALOG_SERVICE_URL', 'http://catalog_service:5001')
+ORDER_SERVICE_URL = os.environ.get('ORDER_SERVICE_URL', 'http://order_service:5002')
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 100))
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 1))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 5))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.1))
+RESTOCK_POLL_INTERVAL = float(os.environ.get('RESTOCK_POLL_INTERVAL', 5))
+
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+# same bound as the catalog's batch endpoints
+MAX_BATCH_ITEMS = 500
+# page size of title searches if the client gives none (sent explicitly, see search_response)
+SEARCH_PAGE_SIZE = 50
+# restock events read per poll; a full page means there are more
+RESTOCK_PAGE_SIZE = 1000
+# bytes read from the order service at a time while streaming /orders
+ORDERS_STREAM_CHUNK = 65536
+
+logger = logging.getLogger(__name__)
+routes = web.RouteTableDef()
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one, like cache.SingleFlight does for
+    threads. The shared call is shielded, so a client that disconnects does not cancel the
+    fetch the other waiters depend on.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+
+class Upstream:
+    """
+    Response of an upstream call, read completely so the connection goes back to the pool.
+    """
+
+    def __init__(self, status, body, content_type=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+
+    def json(self):
+        # JSON, or MessagePack if the upstream answered in it (see codec.py)
+        return codec.decode(self.body, self.content_type)
+
+
+CACHE = web.AppKey('cache', TTLCache)
+INFLIGHT = web.AppKey('inflight', SingleFlight)
+SESSION = web.AppKey('session', aiohttp.ClientSession)
+
+
+async def upstream_request(session, method, url, retry=True, **kwargs):
+    # Returns an Upstream, or None if the upstream could not be reached
+    parts = urlsplit(url)
+    upstream = f"{parts.scheme}://{parts.netloc}"
+    start = time.perf_counter()
+    with tracing.span(f"{method} {upstream}{parts.path}", kind='client') as span:
+        result = await _upstream_request(session, method, url, retry,
+                                         headers=tracing.headers(kwargs.pop('headers', None)), **kwargs)
+        span.set('status', None if result is None else result.status)
+    outcome = 'error' if result is None else f'{result.status // 100}xx'
+    metrics.UPSTREAM_LATENCY.observe((upstream, method, outcome), time.perf_counter() - start)
+    return result
+
+
+async def _upstream_request(session, method, url, retry, **kwargs):
+    attempts = RETRIES + 1 if retry else 1
+    idempotent = method == 'GET'
+    error = None
+    for attempt in range(attempts):
+        if attempt:
+            await asyncio.sleep(BACKOFF * (2 ** (attempt - 1)))
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                result = Upstream(resp.status, await resp.read(), resp.headers.get('Content-Type'))
+        except aiohttp.ClientConnectorError as e:
+            # the request never reached the upstream, so any method can be retried
+            error = e
+            continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+            if idempotent:
+                continue
+            break
+        if idempotent and result.status in RETRY_STATUSES and attempt < attempts - 1:
+            continue
+        return result
+    logger.error("Upstream request failed: %s %s -> %s", method, url, error)
+    return None
+
+
+# fetch a catalog resource through the cache; concurrent misses for the same key
+# share a single upstream request instead of each hitting the catalog
+async def cached_catalog_get(request, key, path, params=None):
+    cache = request.app[CACHE]
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    return await request.app[INFLIGHT].do(key, lambda: fetch_catalog(request.app, key, path, params))
+
+
+# the catalog answers in MessagePack if it can; the JSON body for our clients is encoded once
+# here, or taken as is from a JSON answer, and cached with the payload
+async def fetch_catalog(app, key, path, params=None):
+    cache = app[CACHE]
+    generation = cache.generation
+    resp = await upstream_request(app[SESSION], 'GET', f"{CATALOG_SERVICE_URL}{path}", params=params,
+                                  headers={'Accept': codec.ACCEPT})
+    if resp is None:
+        return {"error": "catalog unreachable"}, 503, None
+    try:
+        payload = resp.json()
+    except ValueError:
+        logger.error("Catalog returned an undecodable body for %s: %s", path, resp.body[:200])
+        return {"error": "catalog returned non-JSON"}, 502, None
+    body = resp.body if codec.is_json(resp.content_type) else json.dumps(payload).encode()
+    cache.put_response(key, payload, resp.status, generation, body)
+    return payload, resp.status, body
+
+
+# sends a cached JSON body as is; payloads without one are encoded
+def json_response(payload, status, body=None):
+    if body is None:
+        return web.json_response(payload, status=status)
+    return web.Response(body=body, status=status, content_type='application/json')
+
+
+# searches can be paginated with limit/cursor; the catalog sends X-Next-Cursor exactly
+# when a page is full, so the header is rebuilt here instead of being cached
+def search_response(payload, status, limit, body=None):
+    response = json_response(payload, status, body)
+    if status == 200 and limit is not None and len(payload) == int(limit):
+        response.headers['X-Next-Cursor'] = str(payload[-1]['id'])
+    return response
+
+
+@routes.get('/search/{topic}')
+async def search(request):
+    topic = request.match_info['topic']
+    limit, cursor = request.query.get('limit'), request.query.get('cursor')
+    if limit is None and cursor is None:
+        payload, status, body = await cached_catalog_get(request, ('search', topic), f"/search/{topic}")
+    else:
+        params = {k: v for k, v in (('limit', limit), ('cursor', cursor)) if v is not None}
+        payload, status, body = await cached_catalog_get(
+            request, ('search', topic, limit, cursor), f"/search/{topic}", params)
+    return search_response(payload, status, limit, body)
+
+
+# title substring search
+@routes.get('/search')
+async def search_title(request):
+    query = request.query.get('q', '')
+    limit = request.query.get('limit', str(SEARCH_PAGE_SIZE))
+    params = {'q': query, 'limit': limit}
+    if 'cursor' in request.query:
+        params['cursor'] = request.query['cursor']
+    payload, status, body = await cached_catalog_get(
+        request, ('title', query, limit, params.get('cursor')), "/search", params)
+    return search_response(payload, status, limit, body)
+
+
+@routes.get(r'/info/{item_id:\d+}')
+async def info(request):
+    item_id = int(request.match_info['item_id'])
+    return json_response(*await cached_catalog_get(request, ('info', item_id), f"/info/{item_id}"))
+
+
+# parse ?ids=1,2,3 into distinct ids (request order); None if invalid
+def parse_ids(raw):
+    try:
+        ids = list(dict.fromkeys(int(part) for part in raw.split(',')))
+    except ValueError:
+        return None
+    if not ids or len(ids) > MAX_BATCH_ITEMS:
+        return None
+    return ids
+
+
+# multi-get: ids found in the cache are answered from it, only the rest is fetched
+# from the catalog, with a single /info?ids= call; the results are cached per id
+@routes.get('/info')
+async def info_batch(request):
+    ids = parse_ids(request.query.get('ids', ''))
+    if ids is None:
+        return web.json_response(
+            {"error": f"ids must be a comma separated list of at most {MAX_BATCH_ITEMS} book IDs"}, status=400)
+    cache = request.app[CACHE]
+    found, wanted = {}, []
+    for item_id in ids:
+        cached = cache.get(('info', item_id))
+        if cached is None:
+            wanted.append(item_id)
+        elif cached[1] == 200:
+            found[item_id] = cached[0]
+    if wanted:
+        generation = cache.generation
+        resp = await upstream_request(request.app[SESSION], 'GET', f"{CATALOG_SERVICE_URL}/info",
+                                      params={'ids': ','.join(map(str, wanted))},
+                                      headers={'Accept': codec.ACCEPT})
+        if resp is None:
+            return web.json_response({"error": "catalog unreachable"}, status=503)
+        try:
+            payload = resp.json()
+        except ValueError:
+            logger.error("Catalog returned an undecodable body for /info: %s", resp.body[:200])
+            return web.json_response({"error": "catalog returned non-JSON"}, status=502)
+        if resp.status != 200:
+            return web.json_response(payload, status=resp.status)
+        for key, item in payload['items'].items():
+            found[int(key)] = item
+            cache.put_response(('info', int(key)), item, 200, generation)
+        for item_id in payload['missing']:
+            cache.put_response(('info', item_id), {"error": "Item not found"}, 404, generation)
+    return web.json_response({
+        "items": {str(item_id): found[item_id] for item_id in ids if item_id in found},
+        "missing": [item_id for item_id in ids if item_id not in found]
+    })
+
+
+@routes.route('PUT', r'/purchase/{item_id:\d+}')
+@routes.post(r'/purchase/{item_id:\d+}')
+async def purchase(request):
+    item_id = int(request.match_info['item_id'])
+    resp = await upstream_request(request.app[SESSION], 'PUT',
+                                  f"{ORDER_SERVICE_URL}/purchase/{item_id}", retry=False)
+    if resp is None:
+        return web.json_response({"error": "order service unreachable"}, status=503)
+    # the stock of this item has (probably) changed; drop our copy of it
+    request.app[CACHE].invalidate(('info', item_id))
+    # a JSON answer needs no changes: pass its bytes through
+    if codec.is_json(resp.content_type):
+        return web.Response(body=resp.body, status=resp.status, content_type='application/json')
+
+    try:
+        payload = resp.json()
+    except ValueError:
+        body_text = resp.body.decode(errors='replace').strip()
+        if not body_text:
+            if resp.status in (200, 201, 204):
+                payload = {"status": "success", "message": "Upstream returned no body"}
+            else:
+                payload = {"status": "error", "message": f"Upstream status {resp.status}"}
+        else:
+            payload = {"status": "error", "message": "Upstream returned non-JSON", "body": body_text}
+    return web.json_response(payload, status=resp.status)
+
+
+# buy several books with one order-service call: {"ids": [1, 2, 2]}
+@routes.post('/purchase/batch')
+async def purchase_batch(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    resp = await upstream_request(request.app[SESSION], 'POST', f"{ORDER_SERVICE_URL}/purchase/batch",
+                                  retry=False, json=data)
+    if resp is None:
+        return web.json_response({"error": "order service unreachable"}, status=503)
+    # the stock of these items has (probably) changed
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if isinstance(ids, list):
+        for item_id in {i for i in ids if isinstance(i, int) and not isinstance(i, bool)}:
+            request.app[CACHE].invalidate(('info', item_id))
+    if not codec.is_json(resp.content_type):
+        logger.error("Order service returned non-JSON for /purchase/batch: %s", resp.body[:200])
+        return web.json_response({"error": "order service returned non-JSON"}, status=502)
+    return web.Response(body=resp.body, status=resp.status, content_type='application/json')
+
+
+# the order list can be arbitrarily long: forward the filters and stream the order
+# service's response through in chunks instead of buffering it
+@routes.get('/orders')
+async def get_all_orders(request):
+    headers = tracing.headers({'Accept': request.headers['Accept']} if 'Accept' in request.headers else {})
+    url = f"{ORDER_SERVICE_URL}/orders"
+    response = None
+    try:
+        async with request.app[SESSION].get(url, params=request.query, headers=headers) as resp:
+            response = web.StreamResponse(status=resp.status)
+            response.content_type = resp.content_type
+            if 'X-Next-Cursor' in resp.headers:
+                response.headers['X-Next-Cursor'] = resp.headers['X-Next-Cursor']
+            response.headers[tracing.REQUEST_ID_HEADER] = tracing.current().trace_id
+            await response.prepare(request)
+            async for chunk in resp.content.iter_chunked(ORDERS_STREAM_CHUNK):
+                await response.write(chunk)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Upstream request failed: GET %s -> %s", url, e)
+        if response is None or not response.prepared:
+            return web.json_response({"error": "order service unreachable"}, status=503)
+        # headers are already sent: all that is left is to cut the response short
+        raise
+    await response.write_eof()
+    return response
+
+
+@routes.post(r'/invalidate/{item_id:\d+}')
+async def invalidate(request):
+    request.app[CACHE].invalidate(('info', int(request.match_info['item_id'])))
+    return web.json_response({"status": "cache invalidated"})
+
+
+@routes.get('/cache/stats')
+async def cache_stats(request):
+    return web.json_response(request.app[CACHE].stats())
+
+
+# readiness, for the same health check as the Flask app; nothing to warm up here
+@routes.get('/health')
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    # rendering reads the other workers' snapshot files: keep that off the event loop
+    text = await asyncio.get_running_loop().run_in_executor(None, metrics.render)
+    return web.Response(body=text.encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+# counts and times every request, per route and method, like metrics.instrument_flask()
+@web.middleware
+async def record_metrics(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        metrics.REQUEST_LATENCY.observe((route, request.method), time.perf_counter() - start)
+        metrics.REQUESTS.inc((route, request.method, str(status)))
+
+
+# traces every request like tracing.instrument_flask(); the span lives in the request's task,
+# so upstream calls made while handling it become its children
+@web.middleware
+async def trace_requests(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else request.path
+    span, token = tracing.begin(f'{request.method} {route}', request.headers.get(tracing.HEADER),
+                                path=request.path)
+    try:
+        response = await handler(request)
+        span.set('status', response.status)
+        if not response.prepared:
+            response.headers[tracing.REQUEST_ID_HEADER] = span.trace_id
+        return response
+    except web.HTTPException as e:
+        span.set('status', e.status)
+        e.headers[tracing.REQUEST_ID_HEADER] = span.trace_id
+        raise
+    except BaseException as e:
+        span.set('error', type(e).__name__)
+        raise
+    finally:
+        tracing.end(span, token)
+
+
+async def upstream_session(app):
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=UPSTREAM_POOL_SIZE)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    app[SESSION] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    yield
+    await app[SESSION].close()
+
+
+# restocks change quantities behind the cache's back: follow the catalog's restock log
+# and drop what is cached about every restocked book
+async def follow_restocks(app):
+    cursor = 0
+    while True:
+        resp = await upstream_request(app[SESSION], 'GET', f"{CATALOG_SERVICE_URL}/restock/events",
+                                      params={'cursor': cursor, 'limit': RESTOCK_PAGE_SIZE},
+                                      headers={'Accept': codec.ACCEPT})
+        try:
+            events = resp.json() if resp is not None and resp.status == 200 else []
+        except ValueError:
+            events = []
+        for event in events:
+            app[CACHE].invalidate(('info', event['id']))
+        if events:
+            cursor = events[-1]['seq']
+            if len(events) == RESTOCK_PAGE_SIZE:
+                continue
+        await asyncio.sleep(RESTOCK_POLL_INTERVAL)
+
+
+async def restock_listener(app):
+    task = asyncio.ensure_future(follow_restocks(app))
+    yield
+    task.cancel()
+
+
+async def create_app():
+    app = web.Application(middlewares=[record_metrics, trace_requests])
+    app[CACHE] = TTLCache(ttl=float(os.environ.get('CACHE_TTL', 5)))
+    export_metrics(app[CACHE])
+    app[INFLIGHT] = SingleFlight()
+    app.cleanup_ctx.append(upstream_session)
+    app.cleanup_ctx.append(restock_listener)
+    app.add_routes(routes)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,74 @@
+"""
+gunicorn.conf.py
+
+Production serving configuration for the Frontend Service:
+
+    gunicorn -c gunicorn.conf.py
+
+The service runs as several worker processes. By default each one serves the Flask app (app.py)
+on a pool of threads; with FRONTEND_MODE=async each one runs the asyncio gateway (gateway.py)
+on an event loop instead. Every worker has its own response cache and upstream connection pools,
+and follows the catalog's restock log to invalidate its cache. In threaded mode, a worker also
+restores its cache from the snapshot before it takes requests, warms it up in the background,
+and saves it when it exits (see warm_up() in app.py).
+On SIGTERM, workers stop accepting connections and finish their in-flight requests for up to
+GRACEFUL_TIMEOUT seconds.
+
+Environment Variables:
+- FRONTEND_MODE: 'threaded' (Flask) or 'async' (asyncio gateway). Defaults to 'threaded'.
+- PORT: Port to listen on. Defaults to 5000.
+- WEB_CONCURRENCY: Number of worker processes. Defaults to the number of CPUs.
+- THREADS: Request threads per worker process in threaded mode. Defaults to 8.
+- GRACEFUL_TIMEOUT: Seconds to finish in-flight requests on shutdown. Defaults to 30.
+- CACHE_SNAPSHOT: File the cache snapshot is kept in (threaded mode). Unset: no snapshot.
+- CACHE_WARMUP_BOOKS: Books loaded into the cache on start (threaded mode). Defaults to 512.
+- CACHE_WARMUP_TIMEOUT: Seconds the warm-up may take at most. Defaults to 10.
+- METRICS_DIR: Directory the workers share their metrics through.
+               Defaults to a new temporary directory.
+"""
+
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+if os.environ.get('FRONTEND_MODE', 'threaded') == 'async':
+    wsgi_app = 'gateway:create_app'
+    worker_class = 'aiohttp.GunicornWebWorker'
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+# Workers share their metrics through snapshot files in this directory (see metrics.py)
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='bazar-metrics-'))
+
+
+def on_starting(server):
+    import metrics
+    metrics.clear()
+
+
+def post_worker_init(worker):
+    import metrics
+    metrics.start()
+    # The asyncio gateway starts its background tasks with the application
+    if wsgi_app == 'app:app':
+        import app
+        app.restore_cache()
+        app.start_worker_tasks()
+        app.start_warm_up()
+
+
+def worker_exit(server, worker):
+    import metrics
+    metrics.flush()
+    if wsgi_app == 'app:app':
+        import app
+        try:
+            app.save_cache()
+        except OSError as e:
+            worker.log.warning(f"Saving the cache snapshot failed: {e}")
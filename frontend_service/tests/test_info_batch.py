@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import app as frontend
+
+
+class CatalogResponse:
+    status_code = 200
+    headers = {'Content-Type': 'application/json'}
+
+    def __init__(self, payload):
+        self.content = json.dumps(payload).encode()
+
+
+class FakeCatalog:
+    """
+    The Catalog Service's /info?ids= endpoint for books 1 to 3, recording the IDs asked for
+    """
+
+    def __init__(self):
+        self.asked = []
+
+    def request(self, method, url, upstream=None, params=None, **kwargs):
+        ids = [int(i) for i in params['ids'].split(',')]
+        self.asked.append(ids)
+        return CatalogResponse({
+            'items': {str(i): {'title': f'Book {i}', 'quantity': 1, 'price': 1.0} for i in ids if i <= 3},
+            'missing': [i for i in ids if i > 3],
+        })
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    frontend.cache.clear()
+    catalog = FakeCatalog()
+    monkeypatch.setattr(frontend, 'safe_request', catalog.request)
+    yield catalog
+    frontend.cache.clear()
+
+
+def test_multi_get_fetches_only_uncached_books(catalog):
+    client = frontend.app.test_client()
+    assert client.get('/info?ids=1,2').status_code == 200
+    body = client.get('/info?ids=2,3,4,1').get_json()
+    assert set(body['items']) == {'1', '2', '3'} and body['missing'] == [4]
+    # One catalog call per request, each for the books not cached yet
+    assert catalog.asked == [[1, 2], [3, 4]]
+    # Found and missing books are cached per ID, for /info/<id> as well
+    assert client.get('/info/3').get_json()['title'] == 'Book 3'
+    assert client.get('/info/4').status_code == 404
+    assert client.get('/info?ids=4,3').get_json()['missing'] == [4]
+    assert len(catalog.asked) == 2
+
+
+def test_multi_get_rejects_invalid_ids(catalog):
+    assert frontend.app.test_client().get('/info?ids=1,,x').status_code == 400
+    assert catalog.asked == []
@@ -0,0 +1,41 @@
+import admission
+import app as frontend
+
+
+class StreamedResponse:
+    """
+    An export from the order service, read chunk by chunk
+    """
+
+    status_code = 200
+    headers = {'Content-Type': 'application/x-ndjson'}
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, size):
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+def test_order_slot_is_held_until_the_export_is_sent(monkeypatch):
+    upstream = StreamedResponse([b'{"order_id": 1}\n', b'{"order_id": 2}\n'])
+    monkeypatch.setattr(frontend, 'safe_request', lambda *args, **kwargs: upstream)
+    order = admission.limiters['order']
+    response = frontend.app.test_client().get('/orders', buffered=False)
+    assert order.in_flight == 1
+    assert b''.join(response.response) == b'{"order_id": 1}\n{"order_id": 2}\n'
+    response.close()
+    assert order.in_flight == 0
+    assert upstream.closed
+
+
+def test_order_slot_is_released_when_the_order_service_is_down(monkeypatch):
+    monkeypatch.setattr(frontend, 'safe_request', lambda *args, **kwargs: None)
+    response = frontend.app.test_client().get('/orders')
+    assert response.status_code == 503
+    response.close()
+    assert admission.limiters['order'].in_flight == 0
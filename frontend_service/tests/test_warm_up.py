@@ -0,0 +1,27 @@
+import threading
+
+import pytest
+
+import app as frontend
+
+
+@pytest.fixture
+def stuck_warm_up(monkeypatch):
+    # A warm-up that never gets an answer from the catalog
+    release = threading.Event()
+    monkeypatch.setattr(frontend, 'warm_up', release.wait)
+    monkeypatch.setattr(frontend, 'CACHE_WARMUP_TIMEOUT', 0.2)
+    monkeypatch.setattr(frontend, 'ready', threading.Event())
+    yield
+    release.set()
+
+
+def test_health_is_unavailable_while_warming_up(stuck_warm_up):
+    frontend.start_warm_up()
+    assert frontend.app.test_client().get('/health').status_code == 503
+
+
+def test_ready_after_the_warm_up_deadline(stuck_warm_up):
+    frontend.start_warm_up()
+    assert frontend.ready.wait(5)
+    assert frontend.app.test_client().get('/health').status_code == 200
@@ -3,22 +3,56 @@ order_service.py
 
 This module implements the Order Service for Bazar.com, an online bookstore.
 It handles purchase requests by interacting with the Catalog Service to check stock,
-updates inventory, and records orders in the database.
+updates inventory, and records orders in the database. Copies of hot books are sold from blocks
+of stock leased from the Catalog Service (see leases.py).
 
 Endpoints provided by this service:
 - /purchase/<item_id> : Purchase a book by its ID.
-- /orders             : Retrieve all orders placed.
+- /purchase/batch     : Purchase several books at once.
+- /orders             : Retrieve the orders placed, filtered and paginated.
+- /metrics            : Service metrics in the Prometheus text format.
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+import json
+import os
 import requests
+import http_client
 import sqlite3
-from database import init_db
+import threading
+from database import init_db, DATABASE
+import db_pool
+import metrics
+import tracing
+from group_commit import GroupCommit
+from leases import StockLeases
 import datetime
+from collections import Counter
 
 app = Flask(__name__)
-DATABASE = 'orders.db'
-CATALOG_SERVICE_URL = 'http://catalog_service:5001'
+metrics.instrument_flask(app)
+tracing.instrument_flask(app)
+# Calls to the catalog use no more than the time the frontend's client still waits
+http_client.instrument_flask(app)
+CATALOG_SERVICE_URL = os.environ.get('CATALOG_SERVICE_URL', 'http://catalog_service:5001')
+
+# Order inserts of concurrent purchases share transactions (see group_commit.py)
+writer = GroupCommit(DATABASE)
+
+# Hot books are sold from leased blocks of stock instead of one catalog write per copy
+leases = StockLeases(DATABASE, CATALOG_SERVICE_URL)
+metrics.callback('stock_lease_outstanding_copies', 'Leased copies not sold yet.', (),
+                 lambda: {(): leases.outstanding()}, scope='global')
+
+INSERT_ORDER = 'INSERT INTO orders (item_id, quantity, timestamp) VALUES (?, ?, ?)'
+
+# Upper bound on the number of distinct books in one batch purchase (see the Catalog Service)
+MAX_BATCH_ITEMS = 500
+
+# Largest page of /orders, and how many orders are read from the database at a time while
+# streaming a response
+MAX_ORDERS_PAGE_SIZE = 10000
+ORDERS_CHUNK_SIZE = 1000
 
 @app.route('/purchase/<int:item_id>', methods=['PUT'])
 def purchase(item_id):
@@ -26,9 +60,11 @@ def purchase(item_id):
     Handles PUT requests to /purchase/<item_id>.
 
     Processes a purchase of a book by its ID. It performs the following steps:
-    - Checks the item's availability by querying the Catalog Service.
-    - Decrements the item's quantity in the Catalog Service if in stock.
-    - Records the order in the local orders database.
+    - Takes a copy from this process's stock lease if the book is hot (see leases.py), or else
+      atomically checks and decrements the item's stock with a single call to the Catalog Service.
+    - Records the order in the local orders database, in a transaction shared with concurrent
+      purchases, together with the sale of a leased copy; the response is only sent once it
+      has committed.
 
     Parameters:
         item_id (int): The ID of the book to purchase.
@@ -37,60 +73,231 @@ def purchase(item_id):
         Response: A JSON response indicating the result of the purchase operation,
                   or an error message with an appropriate HTTP status code.
     """
-    # Check item info from Catalog Service
-    response = requests.get(f"{CATALOG_SERVICE_URL}/info/{item_id}")
-    if response.status_code != 200:
+    lease_id = leases.take(item_id)
+    if lease_id is not None:
+        try:
+            writer.execute((INSERT_ORDER, (item_id, 1, datetime.datetime.now().isoformat())),
+                           leases.sale(lease_id))
+            return jsonify({'message': f'Purchased item {item_id}'})
+        except sqlite3.IntegrityError:
+            # The lease was closed before the sale committed: buy the copy from the catalog
+            pass
+
+    # Check and decrement stock in the Catalog Service in one round trip
+    try:
+        response = http_client.put(f"{CATALOG_SERVICE_URL}/decrement/{item_id}", params={'n': 1})
+    except requests.RequestException:
+        return jsonify({'error': 'Catalog service unreachable'}), 503
+    if response.status_code == 404:
         return jsonify({'error': 'Item not found'}), 404
-    item_info = response.json()
-    if item_info['quantity'] <= 0:
+    if response.status_code == 409:
         return jsonify({'error': 'Item out of stock'}), 400
-    # Decrement quantity in Catalog Service
-    new_quantity = item_info['quantity'] - 1
-    update_response = requests.put(f"{CATALOG_SERVICE_URL}/update/{item_id}", json={'quantity': new_quantity})
-    if update_response.status_code != 200:
+    if response.status_code != 200:
         return jsonify({'error': 'Failed to update stock'}), 500
-    # Record the order
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
     # Get current timestamp
     current_timestamp = datetime.datetime.now().isoformat()
 
-    # Insert the order with timestamp
-    cursor.execute(
-        'INSERT INTO orders (item_id, quantity, timestamp) VALUES (?, ?, ?)',
-        (item_id, 1, current_timestamp)
-    )
-    conn.commit()
-    conn.close()
+    # Record the order with timestamp
+    writer.execute((INSERT_ORDER, (item_id, 1, current_timestamp)))
     return jsonify({'message': f'Purchased item {item_id}'})
 
+@app.route('/purchase/batch', methods=['POST'])
+def purchase_batch():
+    """
+    Handles POST requests to /purchase/batch with a JSON payload {"ids": [<item_id>, ...]}.
+
+    Purchases several books at once; an ID listed n times buys n copies. It performs the
+    following steps:
+    - Removes the stock of all books with a single call to the Catalog Service, which either
+      decrements every book or none of them.
+    - Records one order per book, all in the same transaction.
+
+    Returns:
+        Response: A JSON response with the number of copies bought per book,
+                  or an error message with an appropriate HTTP status code. Errors caused by
+                  a single book name it in 'item_id'.
+    """
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return jsonify({'error': 'ids must be a non-empty list of book IDs'}), 400
+    counts = Counter(ids)
+    if len(counts) > MAX_BATCH_ITEMS:
+        return jsonify({'error': f'At most {MAX_BATCH_ITEMS} distinct books per purchase'}), 400
+
+    # Check and decrement the stock of every book in one round trip
+    try:
+        response = http_client.put(
+            f"{CATALOG_SERVICE_URL}/decrement",
+            json={'items': {str(item_id): n for item_id, n in counts.items()}}
+        )
+    except requests.RequestException:
+        return jsonify({'error': 'Catalog service unreachable'}), 503
+    if response.status_code == 404:
+        return jsonify({'error': 'Item not found', 'item_id': response.json().get('item_id')}), 404
+    if response.status_code == 409:
+        return jsonify({'error': 'Item out of stock', 'item_id': response.json().get('item_id')}), 400
+    if response.status_code != 200:
+        return jsonify({'error': 'Failed to update stock'}), 500
+    current_timestamp = datetime.datetime.now().isoformat()
+
+    # Record all orders in the same transaction
+    writer.execute(*[(INSERT_ORDER, (item_id, n, current_timestamp)) for item_id, n in counts.items()])
+    return jsonify({'message': 'Purchased items', 'items': {str(item_id): n for item_id, n in counts.items()}})
+
+def parse_orders_query():
+    """
+    Parses the filters and pagination parameters of a /orders request.
+
+    Returns:
+        tuple: (where, params, limit) where 'where' is the SQL condition selecting the orders
+               after the cursor that match the filters and 'params' its parameters,
+               or None if a parameter is invalid.
+    """
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = request.args.get('limit')
+        limit = None if limit is None else int(limit)
+        item_id = request.args.get('item_id')
+        item_id = None if item_id is None else int(item_id)
+        since, until = request.args.get('since'), request.args.get('until')
+        for bound in (since, until):
+            if bound is not None:
+                datetime.datetime.fromisoformat(bound)
+    except ValueError:
+        return None
+    if cursor < 0 or (limit is not None and not 0 < limit <= MAX_ORDERS_PAGE_SIZE):
+        return None
+    clauses, params = ['order_id > ?'], [cursor]
+    if item_id is not None:
+        clauses.append('item_id = ?')
+        params.append(item_id)
+    # Timestamps are ISO 8601 strings, which sort chronologically
+    if since is not None:
+        clauses.append('timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append('timestamp < ?')
+        params.append(until)
+    return ' AND '.join(clauses), params, limit
+
+def stream_orders(where, params, limit, ndjson):
+    """
+    Generates the body of a /orders response, ORDERS_CHUNK_SIZE orders at a time.
+
+    Every chunk is read with its own short keyset query (order_id > the last order sent), so no
+    connection or read transaction is held while the client consumes the stream, and memory use
+    does not depend on the number of orders.
+
+    Parameters:
+        where (str), params (list): The condition from parse_orders_query().
+        limit (int): The maximum number of orders to send, or None for no limit.
+        ndjson (bool): One JSON object per line instead of a JSON array.
+    """
+    after = params[0]
+    remaining = limit
+    if not ndjson:
+        yield '['
+    first = True
+    while remaining is None or remaining > 0:
+        size = ORDERS_CHUNK_SIZE if remaining is None else min(ORDERS_CHUNK_SIZE, remaining)
+        with db_pool.connection(DATABASE) as conn:
+            rows = conn.execute(
+                f'SELECT order_id, item_id, quantity, timestamp FROM orders WHERE {where} '
+                'ORDER BY order_id LIMIT ?',
+                [after] + params[1:] + [size]
+            ).fetchall()
+        if rows:
+            # Same keys (and key order) as the jsonify()'d dicts this endpoint used to return
+            lines = [json.dumps({'item_id': row[1], 'order_id': row[0], 'quantity': row[2], 'timestamp': row[3]},
+                                separators=(',', ':')) for row in rows]
+            if ndjson:
+                yield '\n'.join(lines) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(lines)
+            first = False
+            after = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+        if len(rows) < size:
+            break
+    if not ndjson:
+        yield ']'
+
 @app.route('/orders', methods=['GET'])
 def get_all_orders():
     """
-    Handles GET requests to /orders.
+    Handles GET requests to /orders?item_id=<id>&since=<time>&until=<time>&limit=<n>&cursor=<cursor>.
 
-    Retrieves all orders from the orders database and returns them as a JSON response.
+    Streams the orders matching the optional filters in order_id order: 'item_id' selects the
+    orders of one book, 'since' (inclusive) and 'until' (exclusive) are ISO 8601 times. With
+    'limit', at most that many orders are returned and, if there may be more, the X-Next-Cursor
+    header holds the 'cursor' of the next page. The response is a JSON array, or one JSON object
+    per line if 'format=ndjson' is given or the client accepts application/x-ndjson.
 
     Returns:
-        Response: A JSON response containing a list of all orders,
+        Response: A streamed response containing the orders,
+                  an error message with a 400 status code if a parameter is invalid,
                   or an error message with a 500 status code in case of a database error.
     """
+    query = parse_orders_query()
+    if query is None:
+        return jsonify({'error': f'item_id and cursor must be integers, since and until ISO 8601 times, '
+                                 f'limit between 1 and {MAX_ORDERS_PAGE_SIZE}'}), 400
+    where, params, limit = query
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    next_cursor = None
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM orders')
-        rows = cursor.fetchall()
-        # Get column names from the cursor description
-        column_names = [description[0] for description in cursor.description]
-        conn.close()
-
-        # Convert rows to list of dictionaries
-        orders = [dict(zip(column_names, row)) for row in rows]
-
-        return jsonify(orders), 200
+        if limit is not None:
+            # Find the last order of a full page up front, so the cursor can be sent before the body
+            with db_pool.connection(DATABASE) as conn:
+                row = conn.execute(
+                    f'SELECT order_id FROM orders WHERE {where} ORDER BY order_id LIMIT 1 OFFSET ?',
+                    params + [limit - 1]
+                ).fetchone()
+            next_cursor = row[0] if row else None
     except sqlite3.Error as e:
         return jsonify({'error': f'Database error: {e}'}), 500
+    response = Response(stream_orders(where, params, limit, ndjson),
+                        mimetype='application/x-ndjson' if ndjson else 'application/json')
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response
 
-if __name__ == '__main__':
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Handles GET requests to /metrics.
+
+    Returns the metrics of every worker process of the service (request counts and latencies
+    per route, database and connection pool timings, ...) in the Prometheus text format.
+
+    Returns:
+        Response: The metrics as text/plain.
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+def setup():
+    """
+    One-time initialisation of the orders database.
+
+    Runs once per start of the service, before any worker process serves requests.
+    """
     init_db()
+    leases.init_db()
+
+def start_background_tasks():
+    """
+    Starts the background work that must run in exactly one process.
+
+    Under gunicorn only the worker holding the leader lock calls this (see gunicorn.conf.py),
+    so each expired stock lease is returned by one process.
+    """
+    threading.Thread(target=leases.run, daemon=True).start()
+
+if __name__ == '__main__':
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
+    setup()
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5002, debug=True)
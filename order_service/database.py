@@ -2,7 +2,8 @@
 database.py
 
 This module initializes the orders database for the Order Service of Bazar.com.
-It creates the 'orders' table if it doesn't exist, ensuring the database is ready for order records.
+It creates the 'orders' table if it doesn't exist, ensuring the database is ready for order records,
+and the indexes used to filter orders by item and by time.
 
 The 'orders' table schema:
 - order_id (INTEGER PRIMARY KEY AUTOINCREMENT): Unique identifier for each order.
@@ -14,8 +15,11 @@ Environment Variables:
 - DATABASE: Specifies the filename for the orders database. Defaults to 'orders.db' if not set.
 """
 
+import os
 import sqlite3
 
+DATABASE = os.environ.get('DATABASE', 'orders.db')
+
 def init_db():
     """
     Initializes the orders database.
@@ -26,12 +30,13 @@ def init_db():
         - item_id: ID of the purchased item.
         - quantity: Quantity purchased.
         - timestamp: Timestamp of the purchase.
+    - Creates the indexes on item_id and timestamp if they don't exist.
     - Closes the database connection after setup.
 
     Prints:
         A confirmation message indicating that the orders database has been initialized.
     """
-    conn = sqlite3.connect('orders.db')
+    conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS orders (
@@ -41,6 +46,10 @@ def init_db():
             timestamp TEXT
         )
     ''')
+    # Filters of /orders; the item index also keeps each item's orders in order_id order,
+    # so filtered pages are read straight from it
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_item_id ON orders(item_id, order_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_timestamp ON orders(timestamp)')
     conn.commit()
     conn.close()
     print("Orders database initialized.")
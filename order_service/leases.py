@@ -0,0 +1,259 @@
+"""
+leases.py
+
+This module lets the Order Service sell the stock of hot books from blocks of copies leased from
+the Catalog Service ("stock leases").
+
+During a flash sale every purchase of a book decrements the same catalog row, so the purchases
+queue on one SQLite row and write lock. Instead, once a worker process sees STOCK_LEASE_HOT_RATE
+purchases of a book within one second, it leases STOCK_LEASE_SIZE copies at once (POST /leases on
+the Catalog Service) and sells them from memory, so one catalog write covers a whole block of
+purchases instead of one copy.
+
+Leases are tracked durably in the 'stock_leases' table, so that a crash can neither oversell nor
+lose stock:
+- A lease is recorded before it is requested, under an ID chosen here, so the catalog treats a
+  repeated request as the same lease.
+- Every sale counts itself against its lease in the transaction that records the order. The
+  table's CHECK (sold <= granted) makes a sale the lease does not cover fail instead of
+  overselling.
+- A lease expires STOCK_LEASE_TTL seconds after it was requested, and its process stops selling
+  from it. The background task (run(), in one process) then closes it: in one transaction it
+  shrinks the lease to the copies sold, so no later sale can count against it, and then returns
+  the rest to the catalog (DELETE /leases/<id>). The catalog remembers released leases, so a
+  lease returned twice, or a lease request that arrives after its release, changes nothing.
+- No process holds a lease when the service starts, so every lease left over from a previous
+  run is closed right away.
+
+Environment Variables:
+- STOCK_LEASE_SIZE: Copies leased at a time. Defaults to 50; 0 turns stock leases off.
+- STOCK_LEASE_TTL: Seconds a lease is sold from before its unsold copies are returned. Defaults to 10.
+- STOCK_LEASE_HOT_RATE: Purchases of a book per second, in one worker process, from which the
+                        process leases the book's stock. Defaults to 20.
+- STOCK_LEASE_CHECK_INTERVAL: Seconds between checks for expired leases. Defaults to 1.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+import db_pool
+import http_client
+import metrics
+
+LEASE_SIZE = int(os.environ.get('STOCK_LEASE_SIZE', 50))
+LEASE_TTL = float(os.environ.get('STOCK_LEASE_TTL', 10))
+HOT_RATE = int(os.environ.get('STOCK_LEASE_HOT_RATE', 20))
+CHECK_INTERVAL = float(os.environ.get('STOCK_LEASE_CHECK_INTERVAL', 1))
+
+# Seconds a book the catalog would not lease (sold out or missing) is bought copy by copy
+SOLD_OUT_BACKOFF = 1.0
+
+# Seconds closed leases are kept; a sale still counting against one fails rather than oversells
+CLOSED_RETAIN = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+LEASES = metrics.counter('stock_leases_total', 'Stock leases requested from the Catalog Service, by result.',
+                         ('result',))
+
+
+class _Lease:
+    __slots__ = ('lease_id', 'remaining', 'expires')
+
+    def __init__(self, lease_id, remaining, expires):
+        self.lease_id = lease_id
+        self.remaining = remaining
+        self.expires = expires
+
+
+class StockLeases:
+    """
+    The stock leases of one orders database, leased from the Catalog Service at 'catalog_url'.
+
+    Every process sells from its own leases, which it creates on first use, so an instance can
+    be created before a server forks its workers.
+    """
+
+    def __init__(self, database, catalog_url, size=LEASE_SIZE, ttl=LEASE_TTL, hot_rate=HOT_RATE):
+        self.database = database
+        self.catalog_url = catalog_url
+        self.size = size
+        self.ttl = ttl
+        self.hot_rate = hot_rate
+        self._leases = {}     # item_id -> _Lease of this process
+        self._hits = {}       # item_id -> [second, purchases in it]
+        self._sold_out = {}   # item_id -> time until which no lease is requested
+        self._acquiring = {}  # item_id -> lock held while a lease is requested
+        self._lock = threading.Lock()
+
+    def init_db(self):
+        """
+        Creates the 'stock_leases' table and marks every lease in it as expired.
+        """
+        with db_pool.connection(self.database) as conn:
+            # state: 'requested' until the catalog granted it, then 'active', 'returning' while
+            # its unsold copies are returned and 'closed' once they are
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS stock_leases (
+                    lease_id TEXT PRIMARY KEY,
+                    item_id INTEGER NOT NULL,
+                    granted INTEGER NOT NULL DEFAULT 0,
+                    sold INTEGER NOT NULL DEFAULT 0,
+                    expires REAL NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'requested',
+                    CHECK (sold <= granted)
+                )
+            ''')
+            conn.execute("UPDATE stock_leases SET expires = MIN(expires, ?) WHERE state != 'closed'", (time.time(),))
+
+    def take(self, item_id):
+        """
+        Takes one copy of a book from this process's lease, leasing a block first if the book is hot.
+
+        Returns:
+            str: The ID of the lease to count the sale against with sale(), or None if the copy
+                 has to be bought from the catalog.
+        """
+        if self.size <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            hot = self._count(item_id, now)
+            lease_id = self._take(item_id, now)
+            if lease_id is not None or not hot or self._sold_out.get(item_id, 0) > now:
+                return lease_id
+            acquiring = self._acquiring.setdefault(item_id, threading.Lock())
+        # Concurrent purchases of the book wait for one lease instead of each requesting one
+        with acquiring:
+            with self._lock:
+                lease_id = self._take(item_id, time.time())
+                if lease_id is not None or self._sold_out.get(item_id, 0) > time.time():
+                    return lease_id
+            self._acquire(item_id)
+            with self._lock:
+                return self._take(item_id, time.time())
+
+    def sale(self, lease_id):
+        """
+        Returns the (sql, params) statement that counts one sale against a lease; it fails if the
+        lease does not cover the sale (any more), and must be committed with the order.
+        """
+        return 'UPDATE stock_leases SET sold = sold + 1 WHERE lease_id = ?', (lease_id,)
+
+    def outstanding(self):
+        """
+        Returns the number of leased copies not sold yet, over all processes.
+        """
+        with db_pool.connection(self.database) as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(granted - sold), 0) FROM stock_leases WHERE state = 'active'"
+            ).fetchone()[0]
+
+    def run(self):
+        """
+        Closes expired leases every CHECK_INTERVAL seconds, forever.
+        """
+        while True:
+            try:
+                self.close_expired()
+            except Exception as e:
+                logger.warning("Closing expired stock leases failed: %s", e)
+            time.sleep(CHECK_INTERVAL)
+
+    def close_expired(self):
+        """
+        Closes every expired lease and returns its unsold copies to the catalog.
+
+        Returns:
+            int: The number of copies returned.
+        """
+        now = time.time()
+        with db_pool.connection(self.database) as conn:
+            lease_ids = [row[0] for row in conn.execute(
+                "SELECT lease_id FROM stock_leases WHERE state != 'closed' AND expires <= ? ORDER BY expires",
+                (now,)
+            )]
+            conn.execute("DELETE FROM stock_leases WHERE state = 'closed' AND expires < ?", (now - CLOSED_RETAIN,))
+        return sum(self._close(lease_id) for lease_id in lease_ids)
+
+    def _count(self, item_id, now):
+        # Purchases of the book in the current second, this one included, reach the hot rate
+        second = int(now)
+        hits = self._hits.get(item_id)
+        if hits is None or hits[0] != second:
+            hits = self._hits[item_id] = [second, 0]
+        hits[1] += 1
+        return hits[1] >= self.hot_rate
+
+    def _take(self, item_id, now):
+        lease = self._leases.get(item_id)
+        if lease is None:
+            return None
+        if lease.expires <= now:
+            del self._leases[item_id]
+            return None
+        if lease.remaining <= 0:
+            return None
+        lease.remaining -= 1
+        return lease.lease_id
+
+    def _acquire(self, item_id):
+        lease_id = uuid.uuid4().hex
+        expires = time.time() + self.ttl
+        with db_pool.connection(self.database) as conn:
+            conn.execute('INSERT INTO stock_leases (lease_id, item_id, expires) VALUES (?, ?, ?)',
+                         (lease_id, item_id, expires))
+        try:
+            resp = http_client.post(f"{self.catalog_url}/leases",
+                                    json={'id': lease_id, 'item_id': item_id, 'n': self.size})
+        except requests.RequestException as e:
+            # The catalog may have granted it: the lease is returned once it expires
+            LEASES.inc(('error',))
+            logger.warning("Leasing stock of item %s failed: %s", item_id, e)
+            return
+        if resp.status_code in (404, 409):
+            # Nothing was leased; purchases of the book go to the catalog for a while, which
+            # answers them as sold out or missing
+            LEASES.inc(('refused',))
+            with db_pool.connection(self.database) as conn:
+                conn.execute("DELETE FROM stock_leases WHERE lease_id = ? AND state = 'requested'", (lease_id,))
+            with self._lock:
+                self._sold_out[item_id] = time.time() + SOLD_OUT_BACKOFF
+            return
+        if resp.status_code != 200:
+            LEASES.inc(('error',))
+            logger.warning("Leasing stock of item %s failed with status %s", item_id, resp.status_code)
+            return
+        granted = resp.json()['granted']
+        with db_pool.connection(self.database) as conn:
+            activated = conn.execute(
+                "UPDATE stock_leases SET granted = ?, state = 'active' WHERE lease_id = ? AND state = 'requested'",
+                (granted, lease_id)
+            ).rowcount
+        if not activated:
+            # It expired (and was closed) while the catalog was answering
+            return
+        LEASES.inc(('granted',))
+        with self._lock:
+            self._leases[item_id] = _Lease(lease_id, granted, expires)
+
+    def _close(self, lease_id):
+        with db_pool.connection(self.database) as conn:
+            # From here on the lease covers exactly the copies it sold
+            conn.execute('BEGIN IMMEDIATE')
+            sold = conn.execute('SELECT sold FROM stock_leases WHERE lease_id = ?', (lease_id,)).fetchone()[0]
+            conn.execute("UPDATE stock_leases SET granted = sold, state = 'returning' WHERE lease_id = ?",
+                         (lease_id,))
+        resp = http_client.request('DELETE', f"{self.catalog_url}/leases/{lease_id}", params={'sold': sold})
+        resp.raise_for_status()
+        with db_pool.connection(self.database) as conn:
+            conn.execute("UPDATE stock_leases SET state = 'closed' WHERE lease_id = ?", (lease_id,))
+        returned = resp.json()['returned']
+        if returned:
+            logger.info("Returned %d unsold copies of stock lease %s", returned, lease_id)
+        return returned
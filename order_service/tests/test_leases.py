@@ -0,0 +1,152 @@
+import sqlite3
+import time
+
+import pytest
+
+import db_pool
+import leases
+from group_commit import GroupCommit
+from leases import StockLeases
+
+INSERT_ORDER = 'INSERT INTO orders (item_id, quantity, timestamp) VALUES (?, ?, ?)'
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise AssertionError(f"unexpected status {self.status_code}")
+
+
+class FakeCatalog:
+    """
+    The /leases endpoints of the Catalog Service, for the copies of one book
+    """
+
+    def __init__(self, stock):
+        self.stock = stock
+        self.granted = {}
+        self.released = {}
+
+    def post(self, url, json=None, **kwargs):
+        if not self.stock:
+            return FakeResponse(409, {'error': 'Item out of stock'})
+        n = min(json['n'], self.stock)
+        self.stock -= n
+        self.granted[json['id']] = n
+        return FakeResponse(200, {'id': json['id'], 'granted': n})
+
+    def request(self, method, url, params=None, **kwargs):
+        lease_id = url.rsplit('/', 1)[1]
+        returned = self.granted[lease_id] - params['sold']
+        if lease_id not in self.released:
+            self.stock += returned
+            self.released[lease_id] = params['sold']
+        return FakeResponse(200, {'id': lease_id, 'returned': returned})
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    catalog = FakeCatalog(stock=10)
+    monkeypatch.setattr(leases.http_client, 'post', catalog.post)
+    monkeypatch.setattr(leases.http_client, 'request', catalog.request)
+    return catalog
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'orders.db')
+    with db_pool.connection(path) as conn:
+        conn.execute('CREATE TABLE orders (order_id INTEGER PRIMARY KEY AUTOINCREMENT, item_id INTEGER, '
+                     'quantity INTEGER, timestamp TEXT)')
+    return path
+
+
+def make_leases(database, **kwargs):
+    stock_leases = StockLeases(database, 'http://catalog', **dict({'size': 3, 'ttl': 60, 'hot_rate': 1}, **kwargs))
+    stock_leases.init_db()
+    return stock_leases
+
+
+def sell(writer, stock_leases, lease_id, item_id=1):
+    writer.execute((INSERT_ORDER, (item_id, 1, 'now')), stock_leases.sale(lease_id))
+
+
+def orders(database):
+    with db_pool.connection(database) as conn:
+        return conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+
+
+def lease_row(database, lease_id):
+    with db_pool.connection(database) as conn:
+        return conn.execute('SELECT granted, sold, state FROM stock_leases WHERE lease_id = ?',
+                            (lease_id,)).fetchone()
+
+
+def test_hot_book_is_sold_from_one_lease(database, catalog):
+    stock_leases = make_leases(database)
+    taken = [stock_leases.take(1) for _ in range(3)]
+    assert taken[0] is not None and taken == [taken[0]] * 3
+    assert catalog.granted == {taken[0]: 3}
+    assert lease_row(database, taken[0]) == (3, 0, 'active')
+    assert stock_leases.outstanding() == 3
+
+
+def test_cold_book_is_bought_from_the_catalog(database, catalog):
+    stock_leases = make_leases(database, hot_rate=100)
+    assert stock_leases.take(1) is None
+    assert catalog.granted == {}
+
+
+def test_expired_lease_returns_its_unsold_copies(database, catalog):
+    stock_leases = make_leases(database, ttl=0.05)
+    writer = GroupCommit(database)
+    lease_id = stock_leases.take(1)
+    sell(writer, stock_leases, lease_id)
+    time.sleep(0.1)
+    assert stock_leases.close_expired() == 2
+    assert catalog.released == {lease_id: 1}
+    assert catalog.stock == 9
+    assert lease_row(database, lease_id) == (1, 1, 'closed')
+    assert stock_leases.outstanding() == 0
+
+
+def test_expired_lease_is_not_sold_from(database, catalog):
+    stock_leases = make_leases(database, ttl=0.05)
+    lease_id = stock_leases.take(1)
+    catalog.stock = 0
+    time.sleep(0.1)
+    # The catalog has nothing left to lease, so the copy is bought from it (and refused there)
+    assert stock_leases.take(1) is None
+    assert list(catalog.granted) == [lease_id]
+
+
+def test_sale_after_the_lease_was_closed_fails(database, catalog):
+    stock_leases = make_leases(database, ttl=0.05)
+    writer = GroupCommit(database)
+    lease_id = stock_leases.take(1)
+    sell(writer, stock_leases, lease_id)
+    # A second copy is taken from the lease, but the lease closes before its sale commits
+    assert stock_leases.take(1) == lease_id
+    time.sleep(0.1)
+    stock_leases.close_expired()
+    with pytest.raises(sqlite3.IntegrityError):
+        sell(writer, stock_leases, lease_id)
+    # Neither the order nor the sale is recorded: the caller buys the copy from the catalog
+    assert orders(database) == 1
+    assert lease_row(database, lease_id) == (1, 1, 'closed')
+    assert catalog.stock == 9
+
+
+def test_leases_left_from_a_previous_run_are_closed(database, catalog):
+    lease_id = make_leases(database).take(1)
+    restarted = make_leases(database)
+    assert restarted.close_expired() == 3
+    assert lease_row(database, lease_id) == (0, 0, 'closed')
+    assert catalog.stock == 10
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import app as order
+import database
+import db_pool
+
+ORDERS = [(1, 1, '2026-01-01T10:00:00'), (2, 2, '2026-01-01T11:00:00'), (1, 3, '2026-01-02T10:00:00'),
+          (3, 1, '2026-01-02T12:00:00'), (1, 1, '2026-01-03T09:00:00')]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    path = str(tmp_path / 'orders.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    monkeypatch.setattr(order, 'DATABASE', path)
+    # Several chunks per response
+    monkeypatch.setattr(order, 'ORDERS_CHUNK_SIZE', 2)
+    database.init_db()
+    with db_pool.connection(path) as conn:
+        conn.executemany(order.INSERT_ORDER, ORDERS)
+    return order.app.test_client()
+
+
+def ids(resp):
+    return [o['order_id'] for o in resp.get_json()]
+
+
+def test_all_orders_in_order_id_order(client):
+    resp = client.get('/orders')
+    assert ids(resp) == [1, 2, 3, 4, 5]
+    assert resp.get_json()[2] == {'order_id': 3, 'item_id': 1, 'quantity': 3, 'timestamp': '2026-01-02T10:00:00'}
+    assert 'X-Next-Cursor' not in resp.headers
+
+
+def test_pages_follow_the_cursor(client):
+    pages, cursor = [], 0
+    while cursor is not None:
+        resp = client.get(f'/orders?limit=2&cursor={cursor}')
+        pages.append(ids(resp))
+        cursor = resp.headers.get('X-Next-Cursor')
+    assert pages == [[1, 2], [3, 4], [5]]
+
+
+def test_filters(client):
+    assert ids(client.get('/orders?item_id=1')) == [1, 3, 5]
+    assert ids(client.get('/orders?item_id=1&limit=2&cursor=1')) == [3, 5]
+    assert ids(client.get('/orders?since=2026-01-02&until=2026-01-03')) == [3, 4]
+    assert ids(client.get('/orders?item_id=1&since=2026-01-02T10:00:00')) == [3, 5]
+
+
+def test_ndjson(client):
+    resp = client.get('/orders?item_id=1', headers={'Accept': 'application/x-ndjson'})
+    assert resp.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['order_id'] for line in resp.get_data(as_text=True).splitlines()] == [1, 3, 5]
+
+
+@pytest.mark.parametrize('query', ['limit=0', f'limit={order.MAX_ORDERS_PAGE_SIZE + 1}', 'cursor=-1',
+                                   'item_id=x', 'since=yesterday', 'limit=two'])
+def test_invalid_parameters_are_rejected(client, query):
+    assert client.get(f'/orders?{query}').status_code == 400
+
+
+def test_pages_are_read_through_indexes(client):
+    plans = {}
+    for query in ['', 'item_id=1']:
+        with order.app.test_request_context(f'/orders?{query}'):
+            where, params, _ = order.parse_orders_query()
+        with db_pool.connection(order.DATABASE) as conn:
+            plans[query] = ' '.join(row[3] for row in conn.execute(
+                f'EXPLAIN QUERY PLAN SELECT order_id, item_id, quantity, timestamp FROM orders '
+                f'WHERE {where} ORDER BY order_id LIMIT 2', params))
+    # A page is a range of an index in order_id order: no scan of the table, no sort
+    assert plans[''] == 'SEARCH orders USING INTEGER PRIMARY KEY (rowid>?)'
+    assert plans['item_id=1'] == 'SEARCH orders USING INDEX idx_orders_item_id (item_id=? AND order_id>?)'
@@ -0,0 +1,96 @@
+import pytest
+
+import app as order
+import database
+import db_pool
+from group_commit import GroupCommit
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class FakeCatalog:
+    """
+    The /decrement endpoint of the Catalog Service, recording every call
+    """
+
+    def __init__(self, stock):
+        self.stock = stock
+        self.calls = []
+
+    def put(self, url, params=None, json=None, **kwargs):
+        self.calls.append(url)
+        if json is not None:
+            return self.decrement_batch({int(item_id): n for item_id, n in json['items'].items()})
+        item_id = int(url.rsplit('/', 1)[1])
+        n = params['n']
+        if item_id not in self.stock:
+            return FakeResponse(404, {'error': 'Item not found'})
+        if self.stock[item_id] < n:
+            return FakeResponse(409, {'error': 'Item out of stock', 'quantity': self.stock[item_id]})
+        self.stock[item_id] -= n
+        return FakeResponse(200, {'quantity': self.stock[item_id]})
+
+    def decrement_batch(self, items):
+        for item_id, n in items.items():
+            if self.stock.get(item_id, 0) < n:
+                return FakeResponse(409, {'error': 'Item out of stock', 'item_id': item_id})
+        for item_id, n in items.items():
+            self.stock[item_id] -= n
+        return FakeResponse(200, {'quantities': {str(item_id): self.stock[item_id] for item_id in items}})
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    path = str(tmp_path / 'orders.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    monkeypatch.setattr(order, 'DATABASE', path)
+    monkeypatch.setattr(order, 'writer', GroupCommit(path))
+    database.init_db()
+    # Every book is cold: no stock leases
+    monkeypatch.setattr(order.leases, 'take', lambda item_id: None)
+    catalog = FakeCatalog({1: 1})
+    monkeypatch.setattr(order.http_client, 'put', catalog.put)
+    return catalog
+
+
+def orders():
+    with db_pool.connection(order.DATABASE) as conn:
+        return [row[0] for row in conn.execute('SELECT item_id FROM orders')]
+
+
+def test_purchase_is_one_catalog_call(catalog):
+    resp = order.app.test_client().put('/purchase/1')
+    assert resp.status_code == 200
+    assert catalog.calls == [f'{order.CATALOG_SERVICE_URL}/decrement/1']
+    assert orders() == [1]
+
+
+def test_sold_out_book_records_no_order(catalog):
+    client = order.app.test_client()
+    assert client.put('/purchase/1').status_code == 200
+    resp = client.put('/purchase/1')
+    assert resp.status_code == 400 and resp.get_json()['error'] == 'Item out of stock'
+    assert client.put('/purchase/7').status_code == 404
+    assert orders() == [1]
+
+
+def test_batch_purchase_is_one_catalog_call(catalog):
+    catalog.stock = {1: 2, 2: 1}
+    resp = order.app.test_client().post('/purchase/batch', json={'ids': [1, 2, 1]})
+    assert resp.status_code == 200 and resp.get_json()['items'] == {'1': 2, '2': 1}
+    assert catalog.calls == [f'{order.CATALOG_SERVICE_URL}/decrement']
+    with db_pool.connection(order.DATABASE) as conn:
+        assert sorted(conn.execute('SELECT item_id, quantity FROM orders')) == [(1, 2), (2, 1)]
+
+
+def test_batch_purchase_buys_nothing_if_one_book_is_sold_out(catalog):
+    resp = order.app.test_client().post('/purchase/batch', json={'ids': [1, 1]})
+    assert resp.status_code == 400 and resp.get_json()['item_id'] == 1
+    assert catalog.stock == {1: 1} and orders() == []
@@ -1,46 +1,291 @@
-from flask import Flask, jsonify
-import requests
-from database import init_db, get_book, update_stock
+from flask import Flask, jsonify, request, Response, stream_with_context
+import os
+import codec
+import db_pool
+import metrics
+import tracing
+from database import init_db, get_book, get_books, list_books, search_books, update_stock, DATABASE
+from feed import InvalidationFeed
+from rebalance import Rebalancer, check_books
+from replication import Replicator, SequenceMismatch, StaleSnapshot
+from sharding import MISDIRECTED, ShardMap, parse_shards
 
 app = Flask(__name__)
-init_db()
+metrics.instrument_flask(app)
+tracing.instrument_flask(app)
+# MessagePack responses for the frontends and replicas that ask for them
+codec.install(app)
 
-FRONTEND = "http://frontend_service:5000"
-REPLICA = "http://catalog_service_2:5000"
+# Most IDs accepted by one /info?ids= request
+MAX_BATCH_IDS = 500
+
+# Most books on one /search/<topic> page
+MAX_SEARCH_PAGE_SIZE = 1000
+
+# Books per /books page: the default and the most a client may ask for
+BOOKS_PAGE_SIZE = 500
+MAX_BOOKS_PAGE_SIZE = 5000
+
+# Other catalog replicas, comma separated
+REPLICAS = os.environ.get("REPLICA", "http://catalog_service_2:5000").split(",")
+
+# Shard group of this replica (its REPLICA peers are the rest of the group), and
+# the initial shard map; both unset, the catalog is not sharded (see sharding.py)
+SHARD_NAME = os.environ.get("SHARD_NAME")
+CATALOG_SHARDS = parse_shards(os.environ.get("CATALOG_SHARDS"))
+
+# Frontends subscribe to row version changes instead of being called on every write
+feed = InvalidationFeed(DATABASE)
+
+# Books owned by another shard group are handed over to it in the background
+rebalancer = Rebalancer(DATABASE, SHARD_NAME, REPLICAS)
+
+# Stock changes (and handed over books) are shipped to the other replicas in batches
+replicator = Replicator(DATABASE, REPLICAS, on_change=feed.record, on_move=rebalancer.remove,
+                        tombstones=rebalancer.tombstones)
+
+
+def replication_lag():
+    # Only the process running the replicator knows what its peers acknowledged
+    if not replicator.acked:
+        return {}
+    last_seq = replicator.last_seq()
+    return {(peer,): last_seq - acked for peer, acked in list(replicator.acked.items())}
+
+
+metrics.callback("replication_lag_entries",
+                 "Local replication log entries a peer has not acknowledged yet.",
+                 ("peer",), replication_lag, aggregate="max")
+
+metrics.callback("shard_handoff_pending_books",
+                 "Books moved out of this replica that their new shard group has not imported yet.",
+                 ("shard",), lambda: {(shard,): n for shard, n in rebalancer.pending().items()},
+                 scope="global")
+
+def setup():
+    """
+    One-time initialisation (schema and migrations), before any worker starts
+    """
+    rebalancer.init_db(CATALOG_SHARDS)
+    init_db(seeds=rebalancer.seeds)
+    replicator.init_db()
+    feed.init_db()
+
+def start_worker_tasks():
+    """
+    Background work every serving process needs
+    """
+    feed.start()
+
+def start_background_tasks():
+    """
+    Background work that must run in exactly one process
+    """
+    replicator.start()
+    rebalancer.start(replicator)
+
+def moved(book_id):
+    """
+    Answer for a book that is not here: 421 with its shard group if it was handed over
+    """
+    shard = rebalancer.moved_to(book_id) if SHARD_NAME else None
+    if shard is not None:
+        return jsonify({"error": "Book moved to another shard group", "shard": shard}), MISDIRECTED
+    return jsonify({"error": "Book not found"}), 404
 
 @app.route("/info/<int:book_id>", methods=["GET"])
 def info(book_id):
     """
     Read-only request (can be cached at frontend)
     """
-    return jsonify(get_book(book_id))
+    book = get_book(book_id)
+    if "error" in book:
+        return moved(book_id)
+    return jsonify(book)
+
+@app.route("/info", methods=["GET"])
+def info_batch():
+    """
+    Read-only multi-get: /info?ids=1,2,3 -> {"items": {"1": {...}}, "missing": [...]}
+    """
+    try:
+        book_ids = list(dict.fromkeys(int(i) for i in request.args.get("ids", "").split(",")))
+    except ValueError:
+        book_ids = []
+    if not book_ids or len(book_ids) > MAX_BATCH_IDS:
+        return jsonify({"error": f"ids must be a comma separated list of at most {MAX_BATCH_IDS} book IDs"}), 400
+    books = get_books(book_ids)
+    return jsonify({
+        "items": {str(book_id): books[book_id] for book_id in book_ids if book_id in books},
+        "missing": [book_id for book_id in book_ids if book_id not in books]
+    })
+
+@app.route("/books", methods=["GET"])
+def books():
+    """
+    Read-only bulk dump of this replica's books in ID order, for warming caches:
+    /books?cursor=<last ID>&limit=<n>. A full page carries X-Next-Cursor
+    """
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        limit = int(request.args.get("limit", BOOKS_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_BOOKS_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_BOOKS_PAGE_SIZE}, cursor a book ID"}), 400
+    page = list_books(cursor, limit)
+    response = jsonify(page)
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = str(page[-1]["id"])
+    return response
+
+@app.route("/search/<topic>", methods=["GET"])
+def search(topic):
+    """
+    Read-only request (can be cached at frontend): /search/<topic>?limit=<n>&cursor=<last ID>,
+    in ID order. A full page carries X-Next-Cursor; without limit every book is returned
+    """
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        limit = request.args.get("limit")
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        cursor = -1
+    if cursor < 0 or (limit is not None and not 1 <= limit <= MAX_SEARCH_PAGE_SIZE):
+        return jsonify({"error": f"limit must be between 1 and {MAX_SEARCH_PAGE_SIZE}, cursor a book ID"}), 400
+    books = search_books(topic, cursor, limit)
+    response = jsonify(books)
+    if limit is not None and len(books) == limit:
+        response.headers["X-Next-Cursor"] = str(books[-1]["id"])
+    return response
 
 @app.route("/update/<int:book_id>", methods=["POST"])
 def update(book_id):
     """
     Write request:
-    1. Invalidate cache
-    2. Update local DB
-    3. Replicate write
+    1. Update local DB (bumps the row version)
+    2. Log the change for replication in the same transaction
+    3. Publish the new version to the invalidation feed; replication runs in the background
+    """
+    with db_pool.connection(DATABASE) as conn:
+        version = update_stock(book_id, -1, conn)
+        if version is None:
+            return moved(book_id)
+        replicator.record(conn, book_id, -1, version)
+        feed.record(conn, [(book_id, version)])
+    replicator.notify()
+    feed.notify()
+
+    return jsonify({"status": "updated", "version": version})
+
+@app.route("/shards", methods=["GET"])
+def shards():
+    """
+    This replica's shard map (see sharding.py) and how far it has rebalanced
+    """
+    return jsonify(rebalancer.status())
+
+@app.route("/shards", methods=["PUT"])
+def install_shards():
+    """
+    Installs a newer shard map; books owned by other groups are then handed over
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "expected a JSON shard map"}), 400
+    try:
+        installed = rebalancer.install(ShardMap.from_dict(data))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(rebalancer.status()), 200 if installed else 409
+
+@app.route("/shards/import", methods=["POST"])
+def import_books():
+    """
+    Books handed over by another shard group
     """
-    # invalidate cache before write
-    requests.post(f"{FRONTEND}/invalidate/{book_id}")
+    data = request.get_json(silent=True)
+    books = data.get("books") if isinstance(data, dict) else None
+    try:
+        rebalancer.import_books(books)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "imported", "count": len(books)})
 
-    # update local stock
-    update_stock(book_id, -1)
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify({"status": "ok"})
 
-    # replicate to the other catalog replica
-    requests.post(f"{REPLICA}/sync/{book_id}")
 
-    return jsonify({"status": "updated"})
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Metrics of every worker process, in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route("/invalidations/stream", methods=["GET"])
+def invalidations_stream():
+    """
+    Server-Sent Events feed of [book_id, version] pairs for frontend caches
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    return Response(
+        stream_with_context(feed.stream(last_event_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/replication/apply", methods=["POST"])
+def replication_apply():
+    """
+    Replication endpoint: applies a batch of stock deltas from another replica
+    """
+    try:
+        last_seq = replicator.apply(request.get_json())
+    except SequenceMismatch as e:
+        return jsonify({"error": str(e), "last_seq": e.last_seq}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    feed.notify()
+    return jsonify({"status": "replica synced", "last_seq": last_seq})
+
+@app.route("/replication/snapshot", methods=["POST"])
+def replication_snapshot():
+    """
+    Replication endpoint: replaces this replica's state with another replica's whole state
+    """
+    snapshot = request.get_json(silent=True)
+    if not isinstance(snapshot, dict):
+        return jsonify({"error": "expected a JSON snapshot"}), 400
+    try:
+        check_books(snapshot.get("books"))
+        last_seq = replicator.apply_snapshot(snapshot)
+    except StaleSnapshot as e:
+        return jsonify({"error": str(e)}), 409
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid snapshot: {e}"}), 400
+    feed.notify()
+    return jsonify({"status": "replica synced", "last_seq": last_seq})
+
+@app.route("/replication/state", methods=["GET"])
+def replication_state():
+    """
+    This replica's log position and the last sequence applied from every origin
+    """
+    return jsonify({"origin": replicator.origin, "last_seq": replicator.last_seq(), **replicator.state()})
 
-@app.route("/sync/<int:book_id>", methods=["POST"])
-def sync(book_id):
+@app.route("/replication/log", methods=["GET"])
+def replication_log():
     """
-    Replication endpoint
+    Catch-up endpoint: local log entries after ?since=<seq> as one batch
     """
-    update_stock(book_id, -1)
-    return jsonify({"status": "replica synced"})
+    since = request.args.get("since", 0, type=int)
+    return jsonify(replicator.log_since(since))
 
 if __name__ == "__main__":
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
+    setup()
+    start_worker_tasks()
+    start_background_tasks()
     app.run(host="0.0.0.0", port=5000)
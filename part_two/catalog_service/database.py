@@ -1,18 +1,23 @@
 import sqlite3
 import os
+from contextlib import closing
 import logging
+import db_pool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
-def init_db():
+DATABASE = os.environ.get('DATABASE', 'catalog.db')
+
+def init_db(seeds=None):
     """
     Initializes the catalog database.
+    A new database gets the default books for which seeds(book_id) is true (all if not given).
     """
-    DATABASE = os.environ.get('DATABASE', 'catalog.db')
-
     try:
-        with sqlite3.connect(DATABASE) as conn:
+        # Closed before gunicorn forks its workers: a connection the workers inherit
+        # keeps the WAL files of a database they no longer share with anybody else
+        with closing(sqlite3.connect(DATABASE)) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS books (
@@ -20,9 +25,16 @@ def init_db():
                     title TEXT,
                     topic TEXT,
                     quantity INTEGER,
-                    price REAL
+                    price REAL,
+                    version INTEGER NOT NULL DEFAULT 0
                 )
             ''')
+            # Databases created before rows were versioned
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(books)')]
+            if 'version' not in columns:
+                cursor.execute('ALTER TABLE books ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            # Topic searches use this index instead of scanning the table
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_topic ON books(topic, id)')
             cursor.execute('SELECT COUNT(*) FROM books')
             if cursor.fetchone()[0] == 0:
                 books = [
@@ -34,9 +46,11 @@ def init_db():
                     (6, 'Why theory classes are so hard', 'education', 10, 40.0),
                     (7, 'Spring in the Pioneer Valley', 'travel', 10, 30.0),
                 ]
-                cursor.executemany('INSERT INTO books VALUES (?, ?, ?, ?, ?)', books)
-                conn.commit()
+                # A shard group only gets the books it owns (see rebalance.py)
+                books = [book for book in books if seeds is None or seeds(book[0])]
+                cursor.executemany('INSERT INTO books (id, title, topic, quantity, price) VALUES (?, ?, ?, ?, ?)', books)
                 logging.info("Database initialized with default books.")
+            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Database initialization failed: {e}")
 
@@ -44,33 +58,81 @@ def get_book(book_id):
     """
     Returns book info by ID.
     """
-    DATABASE = os.environ.get('DATABASE', 'catalog.db')
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, title, topic, quantity, price FROM books WHERE id = ?",
+    with db_pool.connection(DATABASE) as conn:
+        row = conn.execute(
+            "SELECT id, title, topic, quantity, price, version FROM books WHERE id = ?",
             (book_id,)
-        )
-        row = cursor.fetchone()
+        ).fetchone()
         if row:
             return {
                 "id": row[0],
                 "title": row[1],
                 "topic": row[2],
                 "quantity": row[3],
-                "price": row[4]
+                "price": row[4],
+                "version": row[5]
             }
         return {"error": "Book not found"}
 
-def update_stock(book_id, delta):
+def get_books(book_ids):
+    """
+    Returns {book_id: book info} for the given IDs with one query; unknown IDs are left out.
+    """
+    placeholders = ",".join("?" * len(book_ids))
+    with db_pool.connection(DATABASE) as conn:
+        rows = conn.execute(
+            f"SELECT id, title, topic, quantity, price, version FROM books WHERE id IN ({placeholders})",
+            list(book_ids)
+        ).fetchall()
+    return {
+        row[0]: {
+            "id": row[0],
+            "title": row[1],
+            "topic": row[2],
+            "quantity": row[3],
+            "price": row[4],
+            "version": row[5]
+        }
+        for row in rows
+    }
+
+def list_books(after, limit):
+    """
+    Returns up to 'limit' books with IDs above 'after', in ID order (a page of a bulk read).
+    """
+    with db_pool.connection(DATABASE) as conn:
+        rows = conn.execute(
+            "SELECT id, title, topic, quantity, price, version FROM books WHERE id > ? ORDER BY id LIMIT ?",
+            (after, limit)
+        ).fetchall()
+    return [
+        {"id": row[0], "title": row[1], "topic": row[2], "quantity": row[3], "price": row[4], "version": row[5]}
+        for row in rows
+    ]
+
+def search_books(topic, after=0, limit=None):
+    """
+    Returns the id and title of the books on a topic with IDs above 'after', in ID order,
+    at most 'limit' of them (all if not given).
+    """
+    with db_pool.connection(DATABASE) as conn:
+        rows = conn.execute(
+            "SELECT id, title FROM books WHERE topic = ? AND id > ? ORDER BY id LIMIT ?",
+            (topic, after, -1 if limit is None else limit)
+        ).fetchall()
+    return [{"id": row[0], "title": row[1]} for row in rows]
+
+def update_stock(book_id, delta, conn=None):
     """
-    Updates stock quantity (delta can be negative or positive).
+    Updates stock quantity (delta can be negative or positive) and bumps the row version.
+    Runs inside the caller's transaction when a connection is given.
+    Returns the new version, or None if the book does not exist.
     """
-    DATABASE = os.environ.get('DATABASE', 'catalog.db')
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE books SET quantity = quantity + ? WHERE id = ?",
-            (delta, book_id)
-        )
-        conn.commit()
+    if conn is None:
+        with db_pool.connection(DATABASE) as conn:
+            return update_stock(book_id, delta, conn)
+    row = conn.execute(
+        "UPDATE books SET quantity = quantity + ?, version = version + 1 WHERE id = ? RETURNING version",
+        (delta, book_id)
+    ).fetchone()
+    return row[0] if row else None
@@ -0,0 +1,149 @@
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+import db_pool
+
+FEED_RETAIN = int(os.environ.get('INVALIDATION_FEED_RETAIN', 10000))
+FEED_HEARTBEAT = float(os.environ.get('INVALIDATION_FEED_HEARTBEAT', 15.0))
+# How often a process looks for changes committed by other worker processes
+FEED_POLL_INTERVAL = float(os.environ.get('INVALIDATION_FEED_POLL_INTERVAL', 0.05))
+FEED_PRUNE_INTERVAL = 60.0
+
+
+class InvalidationFeed:
+    """
+    Stream of (book_id, version) changes, served as Server-Sent Events.
+
+    Every write records the new version of the rows it changed in the 'feed_log'
+    table, in its own transaction. Each server process tails that table into an
+    in-memory buffer, so subscribers see changes made by any worker process.
+    Subscribers receive all changes since their last event in one batched event:
+
+        id: <epoch>:<seq>
+        data: [[book_id, version], ...]
+
+    A subscriber that reconnects with Last-Event-ID continues where it left off.
+    If that is impossible (no or unknown id, a different database, or the events
+    were pruned) it gets a 'reset' event instead and must treat everything it
+    cached as stale. Idle streams get a comment line when they connect and every
+    FEED_HEARTBEAT seconds, so dead connections are noticed.
+    """
+
+    def __init__(self, database, retain=FEED_RETAIN):
+        self.database = database
+        self.retain = retain
+        self.epoch = None
+        self._events = deque(maxlen=retain)  # (seq, book_id, version)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+
+    def init_db(self):
+        with db_pool.connection(self.database) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS feed_log (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    book_id INTEGER NOT NULL,
+                    version INTEGER NOT NULL
+                )
+            ''')
+            # Identifies this log, so ids from another database are not resumed
+            conn.execute('CREATE TABLE IF NOT EXISTS feed_meta (epoch TEXT NOT NULL)')
+            if conn.execute('SELECT COUNT(*) FROM feed_meta').fetchone()[0] == 0:
+                conn.execute('INSERT INTO feed_meta (epoch) VALUES (?)', (uuid.uuid4().hex[:8],))
+
+    def start(self):
+        """
+        Loads the retained changes and starts tailing the log in this process.
+        """
+        with db_pool.connection(self.database) as conn:
+            self.epoch = conn.execute('SELECT epoch FROM feed_meta').fetchone()[0]
+            rows = conn.execute(
+                'SELECT seq, book_id, version FROM feed_log ORDER BY seq DESC LIMIT ?',
+                (self.retain,)
+            ).fetchall()
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'feed_log'").fetchone()
+        with self._cond:
+            self._events.extend(reversed(rows))
+            self._seq = row[0] if row else 0
+        threading.Thread(target=self._tail, daemon=True).start()
+
+    def record(self, conn, changes):
+        """
+        Adds [(book_id, version), ...] inside the caller's transaction.
+
+        Call notify() once the transaction has committed.
+        """
+        conn.executemany('INSERT INTO feed_log (book_id, version) VALUES (?, ?)', changes)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _tail(self):
+        last_prune = time.monotonic()
+        while True:
+            self._wakeup.wait(FEED_POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                with db_pool.connection(self.database) as conn:
+                    rows = conn.execute(
+                        'SELECT seq, book_id, version FROM feed_log WHERE seq > ? ORDER BY seq',
+                        (self._seq,)
+                    ).fetchall()
+                    if time.monotonic() - last_prune > FEED_PRUNE_INTERVAL:
+                        conn.execute('DELETE FROM feed_log WHERE seq <= ?', (self._seq - self.retain,))
+                        last_prune = time.monotonic()
+            except Exception:
+                continue
+            if rows:
+                with self._cond:
+                    self._events.extend(rows)
+                    self._seq = rows[-1][0]
+                    self._cond.notify_all()
+
+    def _since(self, seq):
+        # Caller holds the condition; None means the events cannot be replayed
+        if seq > self._seq:
+            return None
+        first = self._events[0][0] if self._events else self._seq + 1
+        if seq < first - 1:
+            return None
+        return list(itertools.islice(self._events, seq - first + 1, None))
+
+    def _position(self, last_event_id):
+        epoch, _, seq = (last_event_id or '').partition(':')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def stream(self, last_event_id=None):
+        """
+        Generator producing the SSE stream for one subscriber.
+        """
+        seq = self._position(last_event_id)
+        yield 'retry: 1000\n\n'
+        # A subscriber that is caught up when it connects gets a heartbeat right
+        # away, so it knows that it is
+        synced = False
+        while True:
+            with self._cond:
+                events = None if seq is None else self._since(seq)
+                if events == [] and synced:
+                    self._cond.wait(FEED_HEARTBEAT)
+                    events = self._since(seq)
+                current = self._seq
+            synced = True
+            if events is None:
+                seq = current
+                yield f'event: reset\nid: {self.epoch}:{seq}\ndata: []\n\n'
+            elif events:
+                seq = events[-1][0]
+                data = json.dumps([[book_id, version] for _, book_id, version in events])
+                yield f'id: {self.epoch}:{seq}\ndata: {data}\n\n'
+            else:
+                yield ': keepalive\n\n'
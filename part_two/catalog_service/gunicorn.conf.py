@@ -0,0 +1,61 @@
+# Production serving: gunicorn -c gunicorn.conf.py app:app
+#
+# Schema setup runs once in the master before workers fork. Every worker tails
+# the invalidation feed; replication must run in exactly one process, so the
+# workers compete for a lock file next to the database and the holder runs it.
+import fcntl
+import os
+import tempfile
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+# Threads, not processes, hold the long-lived invalidation streams
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 16))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+# Workers share their metrics through snapshot files in this directory (see metrics.py)
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='bazar-metrics-'))
+
+LEADER_LOCK = os.environ.get(
+    'LEADER_LOCK', os.path.abspath(os.environ.get('DATABASE', 'catalog.db')) + '.leader'
+)
+
+
+def on_starting(server):
+    import app
+    import metrics
+    metrics.clear()
+    import db_pool
+    app.setup()
+    # Workers open their own connections; don't keep the master's around
+    db_pool.get_pool(app.DATABASE).close()
+
+
+def post_worker_init(worker):
+    import metrics
+    metrics.start()
+    import app
+    app.start_worker_tasks()
+    threading.Thread(target=_lead, args=(worker,), daemon=True).start()
+
+
+def _lead(worker):
+    # Blocks until no other worker holds the lock; the descriptor stays open,
+    # so the lock is released only when this worker exits
+    fd = os.open(LEADER_LOCK, os.O_CREAT | os.O_RDWR, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    worker.log.info(f"Worker {worker.pid} runs the background tasks")
+    import app
+    app.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    import app
+    import db_pool
+    import metrics
+    metrics.flush()
+    db_pool.get_pool(app.DATABASE).close()
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import db_pool
+import http_client
+import tracing
+from sharding import ShardMap
+
+REBALANCE_BATCH_SIZE = int(os.environ.get('REBALANCE_BATCH_SIZE', 100))
+REBALANCE_POLL_INTERVAL = float(os.environ.get('REBALANCE_POLL_INTERVAL', 1.0))
+REBALANCE_MAX_BACKOFF = float(os.environ.get('REBALANCE_MAX_BACKOFF', 10.0))
+
+BOOK_COLUMNS = 'id, title, topic, quantity, price, version'
+
+
+def _is_int(value):
+    # JSON true/false arrive as bools, which are ints to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def check_books(books):
+    """
+    Raises ValueError unless 'books' is a list of [id, title, topic, quantity, price, version]
+    rows as sent by a handover.
+    """
+    if not isinstance(books, list):
+        raise ValueError("books must be a list of [id, title, topic, quantity, price, version]")
+    for book in books:
+        if not (isinstance(book, list) and len(book) == 6 and _is_int(book[0]) and _is_int(book[5])
+                and all(value is None or isinstance(value, str) for value in book[1:3])
+                and (book[3] is None or _is_int(book[3]))
+                and (book[4] is None or (isinstance(book[4], (int, float)) and not isinstance(book[4], bool)))):
+            raise ValueError(f"invalid book {book!r}, expected [id, title, topic, quantity, price, version]")
+
+
+class Rebalancer:
+    """
+    Keeps this replica's copy of the shard map (see sharding.py) and hands the
+    books its group no longer owns over to their new group.
+
+    The map lives in the 'shard_map' table: it starts out as CATALOG_SHARDS and
+    is replaced by newer epochs through PUT /shards. After a change, the primary
+    of the group moves the books it no longer owns out in batches. One
+    transaction deletes a batch from 'books', keeps a copy in 'shard_handoff',
+    leaves a tombstone in 'moved_books' and logs the moves for replication, so
+    the other replicas of the group drop the books too. Every replica of the new
+    group then imports the copies, the primary last: it takes the group's
+    writes, and a stock delta replicated to a replica that does not have the
+    book yet would be lost. The copies are deleted once all of them acknowledged.
+
+    A request for a moved book is answered 421 with the book's group. Between
+    its move and its import a book is unavailable for a moment, which the
+    routers report as a retryable error.
+
+    Once no book of another group is left and everything has been handed over,
+    the replica records the map's epoch as rebalanced.
+    """
+
+    def __init__(self, database, name, peers):
+        self.database = database
+        self.name = name
+        self.peers = [peer.rstrip('/') for peer in peers]
+        self.replicator = None
+        self._settled = None
+
+    def init_db(self, shards=None):
+        """
+        Creates the tables; 'shards' becomes epoch 1 of the map if none is stored yet.
+        """
+        if shards and self.name not in shards:
+            raise ValueError(f"SHARD_NAME {self.name!r} is not a group of CATALOG_SHARDS")
+        with db_pool.connection(self.database) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS shard_map (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    epoch INTEGER NOT NULL,
+                    shards TEXT NOT NULL,
+                    previous TEXT,
+                    rebalanced INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS shard_handoff (
+                    book_id INTEGER PRIMARY KEY,
+                    shard TEXT NOT NULL,
+                    title TEXT,
+                    topic TEXT,
+                    quantity INTEGER,
+                    price REAL,
+                    version INTEGER NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS moved_books (
+                    book_id INTEGER PRIMARY KEY,
+                    shard TEXT NOT NULL
+                )
+            ''')
+            if shards:
+                conn.execute('INSERT OR IGNORE INTO shard_map (id, epoch, shards) VALUES (1, 1, ?)',
+                             (json.dumps(shards),))
+
+    def start(self, replicator):
+        """
+        Starts rebalancing in this process; moves are logged for the group's other
+        replicas through 'replicator'.
+        """
+        if not self.name:
+            return
+        self.replicator = replicator
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def shard_map(self):
+        return ShardMap.from_dict(self.status())
+
+    def status(self):
+        """
+        Returns the map, this replica's group and the last epoch it finished rebalancing.
+        """
+        with db_pool.connection(self.database) as conn:
+            row = conn.execute('SELECT epoch, shards, previous, rebalanced FROM shard_map').fetchone()
+        if row is None:
+            return {'epoch': 0, 'shards': {}, 'previous': None, 'name': self.name, 'rebalanced': 0}
+        return {
+            'epoch': row[0],
+            'shards': json.loads(row[1]),
+            'previous': json.loads(row[2]) if row[2] else None,
+            'name': self.name,
+            'rebalanced': row[3],
+        }
+
+    def install(self, shard_map):
+        """
+        Stores a newer map. Returns False if this replica already has its epoch or a newer one;
+        raises ValueError if the map is not one for this replica.
+        """
+        if not self.name:
+            raise ValueError("this catalog replica is not sharded (SHARD_NAME is unset)")
+        if self.name not in shard_map.shards:
+            raise ValueError(f"group {self.name!r} is missing from the shard map")
+        if not isinstance(shard_map.epoch, int) or isinstance(shard_map.epoch, bool) or shard_map.epoch < 1:
+            raise ValueError("shard map epochs are integers starting at 1")
+        for groups in (shard_map.shards, shard_map.previous or {}):
+            if not all(isinstance(urls, list) and urls and all(isinstance(url, str) for url in urls)
+                       for urls in groups.values()):
+                raise ValueError("each shard group must map to a list of replica URLs")
+        with db_pool.connection(self.database) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT epoch FROM shard_map').fetchone()
+            if row and row[0] >= shard_map.epoch:
+                return False
+            conn.execute(
+                'INSERT INTO shard_map (id, epoch, shards, previous) VALUES (1, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET epoch = excluded.epoch, shards = excluded.shards, '
+                'previous = excluded.previous',
+                (shard_map.epoch, json.dumps(shard_map.shards),
+                 json.dumps(shard_map.previous) if shard_map.previous else None)
+            )
+        logging.info(f"Installed shard map epoch {shard_map.epoch}")
+        return True
+
+    def seeds(self, book_id):
+        """
+        Whether a new database gets one of the default books: all of them without sharding,
+        the group's own in the initial map, and none once books have been moved.
+        """
+        if not self.name:
+            return True
+        shard_map = self.shard_map()
+        return shard_map.epoch == 1 and shard_map.owner(book_id) == self.name
+
+    def moved_to(self, book_id):
+        """
+        Returns the group a book was handed over to, or None.
+        """
+        with db_pool.connection(self.database) as conn:
+            row = conn.execute('SELECT shard FROM moved_books WHERE book_id = ?', (book_id,)).fetchone()
+        return row[0] if row else None
+
+    def import_books(self, books):
+        """
+        Adds books handed over by another group, as [[id, title, topic, quantity, price, version], ...].
+
+        Books this replica already has are kept as they are, so a repeated handoff changes nothing.
+        Raises ValueError if a book is malformed, before anything is imported.
+        """
+        check_books(books)
+        with db_pool.connection(self.database) as conn:
+            conn.executemany(f'INSERT OR IGNORE INTO books ({BOOK_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)', books)
+            conn.executemany('DELETE FROM moved_books WHERE book_id = ?', [(book[0],) for book in books])
+
+    def remove(self, conn, moves):
+        """
+        Drops books moved to other groups, [(book_id, group), ...], and leaves their
+        tombstones, inside the caller's transaction.
+        """
+        conn.executemany('DELETE FROM books WHERE id = ?', [(book_id,) for book_id, _ in moves])
+        conn.executemany('INSERT OR REPLACE INTO moved_books (book_id, shard) VALUES (?, ?)', moves)
+
+    def tombstones(self, conn):
+        """
+        Returns [(book_id, group), ...] of the books handed over to other groups.
+        """
+        return conn.execute('SELECT book_id, shard FROM moved_books ORDER BY book_id').fetchall()
+
+    def pending(self):
+        """
+        Returns the number of books waiting to be handed over, per group.
+        """
+        with db_pool.connection(self.database) as conn:
+            return dict(conn.execute('SELECT shard, COUNT(*) FROM shard_handoff GROUP BY shard'))
+
+    def _run(self):
+        backoff = REBALANCE_POLL_INTERVAL
+        while True:
+            try:
+                shard_map = self.shard_map()
+                if shard_map.shards and self._settled != shard_map.epoch:
+                    self._rebalance(shard_map)
+                backoff = REBALANCE_POLL_INTERVAL
+            except Exception as e:
+                logging.warning(f"Rebalancing failed, retrying in {backoff:.1f}s: {e}")
+                backoff = min(backoff * 2, REBALANCE_MAX_BACKOFF)
+            time.sleep(backoff)
+
+    def _is_primary(self, shard_map):
+        group = shard_map.shards.get(self.name)
+        return bool(group) and group[0] not in self.peers
+
+    def _strays(self, shard_map):
+        # Local books another group owns
+        with db_pool.connection(self.database) as conn:
+            book_ids = [row[0] for row in conn.execute('SELECT id FROM books')]
+        return [book_id for book_id in book_ids if shard_map.owner(book_id) != self.name]
+
+    def _rebalance(self, shard_map):
+        if self._is_primary(shard_map):
+            # Copies left over from before a restart go first
+            self._deliver(shard_map)
+            strays = self._strays(shard_map)
+            for i in range(0, len(strays), REBALANCE_BATCH_SIZE):
+                self._move_out(shard_map, strays[i:i + REBALANCE_BATCH_SIZE])
+                self._deliver(shard_map)
+        # The other replicas wait until the primary's moves have been replicated
+        if self._strays(shard_map) or self.pending():
+            return
+        with db_pool.connection(self.database) as conn:
+            conn.execute('UPDATE shard_map SET rebalanced = epoch WHERE epoch = ?', (shard_map.epoch,))
+        self._settled = shard_map.epoch
+        logging.info(f"Shard map epoch {shard_map.epoch} rebalanced")
+
+    def _move_out(self, shard_map, book_ids):
+        placeholders = ','.join('?' * len(book_ids))
+        with db_pool.connection(self.database) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(f'SELECT {BOOK_COLUMNS} FROM books WHERE id IN ({placeholders})',
+                                book_ids).fetchall()
+            moves = [(row[0], shard_map.owner(row[0])) for row in rows]
+            conn.executemany(
+                'INSERT OR REPLACE INTO shard_handoff (book_id, shard, title, topic, quantity, price, version) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(row[0], shard, *row[1:]) for row, (_, shard) in zip(rows, moves)]
+            )
+            self.remove(conn, moves)
+            for book_id, shard in moves:
+                self.replicator.record_move(conn, book_id, shard)
+        self.replicator.notify()
+
+    def _deliver(self, shard_map):
+        while True:
+            with db_pool.connection(self.database) as conn:
+                rows = conn.execute(
+                    'SELECT shard, book_id, title, topic, quantity, price, version FROM shard_handoff '
+                    'ORDER BY book_id LIMIT ?', (REBALANCE_BATCH_SIZE,)
+                ).fetchall()
+            if not rows:
+                return
+            handoffs = {}
+            for shard, *book in rows:
+                handoffs.setdefault(shard, []).append(book)
+            for shard, books in handoffs.items():
+                urls = shard_map.group(shard)
+                if not urls:
+                    raise RuntimeError(f"group {shard!r} is not in the shard map")
+                with tracing.trace("shard handoff", shard=shard, books=len(books)):
+                    for url in reversed(urls):
+                        http_client.post(f"{url}/shards/import", json={'books': books}).raise_for_status()
+                with db_pool.connection(self.database) as conn:
+                    conn.executemany('DELETE FROM shard_handoff WHERE book_id = ?', [(book[0],) for book in books])
+                logging.info(f"Handed {len(books)} books over to group {shard}")
@@ -0,0 +1,453 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import codec
+import db_pool
+import http_client
+import tracing
+
+PROTOCOL_VERSION = 4
+# Version 2 batches have no moves and version 3 batches no log id, but are otherwise the same
+SUPPORTED_VERSIONS = (2, 3, 4)
+REPLICATION_BATCH_SIZE = int(os.environ.get('REPLICATION_BATCH_SIZE', 500))
+# How long a shipper lingers after being woken up so that writes arriving
+# together are sent (and coalesced) in one batch
+REPLICATION_LINGER = float(os.environ.get('REPLICATION_LINGER', 0.005))
+# Writes made by other worker processes cannot wake the shipper, so it also polls
+REPLICATION_POLL_INTERVAL = float(os.environ.get('REPLICATION_POLL_INTERVAL', 0.2))
+REPLICATION_MAX_BACKOFF = float(os.environ.get('REPLICATION_MAX_BACKOFF', 10.0))
+
+
+class SequenceMismatch(Exception):
+    """
+    A batch does not start where the receiver's copy of the origin's log ends.
+    """
+
+    def __init__(self, last_seq):
+        super().__init__(f"expected batch starting at sequence {last_seq}")
+        self.last_seq = last_seq
+
+
+class StaleSnapshot(Exception):
+    """
+    A snapshot lacks local writes that the receiver no longer has in its log.
+    """
+
+
+class Replicator:
+    """
+    Ships stock deltas between catalog replicas in sequence-numbered batches.
+
+    Every local write appends (book_id, delta) to the 'replication_log' table in
+    the same transaction as the write, which assigns it the next sequence number.
+    One shipper thread per peer sends everything after the sequence the peer has
+    acknowledged as a single batch, with deltas for the same book summed up and
+    the newest row version of each book, and the books that were handed over to
+    another shard group (see rebalance.py):
+
+        {"version": 4, "origin": name, "log_id": id, "from_seq": a, "to_seq": b,
+         "deltas": [[book_id, delta, row_version], ...],
+         "moved": [[book_id, group], ...]}
+
+    'from_seq' is the sequence right before the batch's first entry. The receiver
+    applies a batch in one transaction and records 'to_seq' as the last sequence
+    applied for that origin ('replication_state'). A batch whose 'from_seq' does
+    not match, e.g. because entries before it were pruned, is rejected with the receiver's actual position,
+    and the shipper resends from there, so a replica that was down catches up
+    from its own last sequence once it is back. A restarted replica also pulls
+    what it missed from /replication/log on startup.
+
+    Every database has a random log id ('replication_meta'), which batches carry:
+    a replica that comes back with a new database starts a new log at sequence 1,
+    and its peers start counting its sequences from 0 again instead of taking the
+    new entries for ones they already applied.
+
+    A peer that needs entries which were already pruned (every other peer had
+    acknowledged them), or that has not been synced since its database was
+    created, gets a snapshot of the whole state instead of deltas:
+
+        {"version": 4, "origin": name, "log_id": id, "to_seq": b,
+         "applied": {origin: [log_id, last_seq], ...},
+         "books": [[id, title, topic, quantity, price, version], ...],
+         "moved": [[book_id, group], ...]}
+
+    The receiver replaces its books with the snapshot's, takes over its positions
+    ('applied', and 'to_seq' for the sender) and then replays the entries of its
+    own log that the snapshot does not include yet. It rejects a snapshot that
+    lacks own entries it has already pruned, and the sender takes a newer one.
+
+    Applying a batch sets each row version to max(local version + 1, origin's
+    version), so versions only grow and replicas agree once they converge.
+    'on_change' is called with the open connection and the [(book_id, version), ...]
+    a batch or snapshot changed, and 'on_move' with the connection and the batch's
+    moves (after its deltas), both inside the batch's transaction. 'tombstones'
+    returns the moves a snapshot carries, given an open connection.
+    """
+
+    def __init__(self, database, peers, origin=None, on_change=None, on_move=None, tombstones=None):
+        self.database = database
+        self.peers = peers
+        self.on_change = on_change
+        self.on_move = on_move
+        self.tombstones = tombstones
+        self.origin = origin or os.environ.get('REPLICA_NAME') or socket.gethostname()
+        self.acked = {}
+        self._log_id = None
+        self._wakeups = {peer: threading.Event() for peer in peers}
+
+    def init_db(self):
+        with db_pool.connection(self.database) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS replication_log (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    book_id INTEGER NOT NULL,
+                    delta INTEGER NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    moved_to TEXT
+                )
+            ''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(replication_log)')]
+            if 'version' not in columns:
+                conn.execute('ALTER TABLE replication_log ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+            if 'moved_to' not in columns:
+                conn.execute('ALTER TABLE replication_log ADD COLUMN moved_to TEXT')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS replication_state (
+                    origin TEXT PRIMARY KEY,
+                    last_seq INTEGER NOT NULL,
+                    log_id TEXT
+                )
+            ''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(replication_state)')]
+            if 'log_id' not in columns:
+                conn.execute('ALTER TABLE replication_state ADD COLUMN log_id TEXT')
+            # 'synced' is 0 until a peer sent a snapshot into this database
+            conn.execute('CREATE TABLE IF NOT EXISTS replication_meta (log_id TEXT NOT NULL, synced INTEGER NOT NULL)')
+            if conn.execute('SELECT COUNT(*) FROM replication_meta').fetchone()[0] == 0:
+                conn.execute('INSERT INTO replication_meta (log_id, synced) VALUES (?, 0)', (uuid.uuid4().hex[:8],))
+
+    @property
+    def log_id(self):
+        if self._log_id is None:
+            with db_pool.connection(self.database) as conn:
+                self._log_id = conn.execute('SELECT log_id FROM replication_meta').fetchone()[0]
+        return self._log_id
+
+    def start(self):
+        for peer in self.peers:
+            threading.Thread(target=self._catch_up, args=(peer,), daemon=True).start()
+            threading.Thread(target=self._ship, args=(peer,), daemon=True).start()
+
+    def record(self, conn, book_id, delta, version):
+        """
+        Appends a local stock change (and the row version it produced) to the log,
+        inside the caller's transaction.
+
+        Call notify() once the transaction has committed.
+        """
+        conn.execute(
+            'INSERT INTO replication_log (book_id, delta, version) VALUES (?, ?, ?)',
+            (book_id, delta, version)
+        )
+
+    def record_move(self, conn, book_id, group):
+        """
+        Logs that a book was handed over to another shard group, inside the caller's
+        transaction.
+
+        Call notify() once the transaction has committed.
+        """
+        conn.execute(
+            'INSERT INTO replication_log (book_id, delta, moved_to) VALUES (?, 0, ?)',
+            (book_id, group)
+        )
+
+    def notify(self):
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+
+    def last_seq(self):
+        # Read from sqlite_sequence: acknowledged entries are pruned from the log itself
+        with db_pool.connection(self.database) as conn:
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'"
+            ).fetchone()
+        return row[0] if row else 0
+
+    def state(self):
+        """
+        Returns this replica's log id, whether it was synced since its database was
+        created, and the last sequence applied from every origin and that origin's log id.
+        """
+        with db_pool.connection(self.database) as conn:
+            synced = conn.execute('SELECT synced FROM replication_meta').fetchone()[0]
+            rows = conn.execute('SELECT origin, last_seq, log_id FROM replication_state').fetchall()
+        return {
+            "log_id": self.log_id,
+            "synced": bool(synced),
+            "applied": {origin: last_seq for origin, last_seq, _ in rows},
+            "logs": {origin: log_id for origin, _, log_id in rows if log_id},
+        }
+
+    def _applied(self, conn, origin, log_id):
+        # The last sequence applied from an origin's current log
+        row = conn.execute(
+            'SELECT last_seq, log_id FROM replication_state WHERE origin = ?', (origin,)
+        ).fetchone()
+        if row is None or (log_id and row[1] and row[1] != log_id):
+            return 0
+        return row[0]
+
+    def log_since(self, seq, limit=REPLICATION_BATCH_SIZE):
+        """
+        Returns the local log entries after 'seq' as a batch (used for pull catch-up).
+        """
+        with db_pool.connection(self.database) as conn:
+            rows = conn.execute(
+                'SELECT seq, book_id, delta, version, moved_to FROM replication_log '
+                'WHERE seq > ? ORDER BY seq LIMIT ?',
+                (seq, limit)
+            ).fetchall()
+        return self._batch(rows, seq)
+
+    def apply(self, batch):
+        """
+        Applies a batch from another replica in one transaction.
+
+        Returns the last sequence now applied for the batch's origin; raises
+        SequenceMismatch if the batch does not continue from it.
+        """
+        if batch.get('version') not in SUPPORTED_VERSIONS:
+            raise ValueError(f"unsupported replication protocol version {batch.get('version')}")
+        origin = batch['origin']
+        with db_pool.connection(self.database) as conn:
+            # Take the write lock up front so concurrent batches (push and pull)
+            # cannot both pass the sequence check
+            conn.execute('BEGIN IMMEDIATE')
+            last_seq = self._applied(conn, origin, batch.get('log_id'))
+            if batch['to_seq'] <= last_seq:
+                # Already applied (e.g. a retry after a lost acknowledgement)
+                return last_seq
+            if batch['from_seq'] != last_seq:
+                raise SequenceMismatch(last_seq)
+            changes = self._apply_deltas(conn, batch['deltas'])
+            if self.on_change and changes:
+                self.on_change(conn, changes)
+            moves = batch.get('moved')
+            if self.on_move and moves:
+                self.on_move(conn, [tuple(move) for move in moves])
+            self._set_applied(conn, origin, batch['to_seq'], batch.get('log_id'))
+        return batch['to_seq']
+
+    def snapshot(self):
+        """
+        Returns the whole state of this replica as a snapshot (see the class docstring).
+        """
+        with db_pool.connection(self.database) as conn:
+            # One read transaction, so the books match the positions
+            conn.execute('BEGIN')
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'").fetchone()
+            applied = {origin: [log_id, last_seq] for origin, last_seq, log_id
+                       in conn.execute('SELECT origin, last_seq, log_id FROM replication_state')}
+            books = conn.execute(
+                'SELECT id, title, topic, quantity, price, version FROM books ORDER BY id'
+            ).fetchall()
+            moved = self.tombstones(conn) if self.tombstones else []
+        return {
+            'version': PROTOCOL_VERSION,
+            'origin': self.origin,
+            'log_id': self.log_id,
+            'to_seq': row[0] if row else 0,
+            'applied': applied,
+            'books': [list(book) for book in books],
+            'moved': [list(move) for move in moved],
+        }
+
+    def apply_snapshot(self, snapshot):
+        """
+        Replaces this replica's state with a snapshot from another replica, then replays
+        the local writes it does not include, in one transaction.
+
+        Returns the snapshot's 'to_seq'; raises StaleSnapshot if local writes it lacks
+        were pruned from the log already.
+        """
+        if snapshot.get('version') != PROTOCOL_VERSION:
+            raise ValueError(f"unsupported replication protocol version {snapshot.get('version')}")
+        log_id, own = snapshot['applied'].get(self.origin) or [None, 0]
+        if log_id != self.log_id:
+            own = 0
+        with db_pool.connection(self.database) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            first = conn.execute('SELECT MIN(seq) FROM replication_log').fetchone()[0]
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'").fetchone()
+            horizon = first - 1 if first is not None else (row[0] if row else 0)
+            if own < horizon:
+                raise StaleSnapshot(f"snapshot includes local writes up to {own}, the log starts after {horizon}")
+            old = dict(conn.execute('SELECT id, version FROM books'))
+            conn.execute('DELETE FROM books')
+            conn.executemany(
+                'INSERT INTO books (id, title, topic, quantity, price, version) VALUES (?, ?, ?, ?, ?, ?)',
+                snapshot['books']
+            )
+            if self.on_move and snapshot['moved']:
+                self.on_move(conn, [tuple(move) for move in snapshot['moved']])
+            conn.execute('DELETE FROM replication_state')
+            for origin, (origin_log_id, last_seq) in snapshot['applied'].items():
+                if origin != self.origin:
+                    self._set_applied(conn, origin, last_seq, origin_log_id)
+            self._set_applied(conn, snapshot['origin'], snapshot['to_seq'], snapshot['log_id'])
+            # Local writes the sender had not received yet
+            rows = conn.execute(
+                'SELECT seq, book_id, delta, version, moved_to FROM replication_log WHERE seq > ? ORDER BY seq',
+                (own,)
+            ).fetchall()
+            batch = self._batch(rows)
+            self._apply_deltas(conn, batch['deltas'])
+            if self.on_move and batch['moved']:
+                self.on_move(conn, [tuple(move) for move in batch['moved']])
+            conn.execute('UPDATE replication_meta SET synced = 1')
+            versions = dict(conn.execute('SELECT id, version FROM books'))
+            # Books that are gone get a version above their last one, so caches drop them
+            changes = [(book_id, version + 1) for book_id, version in old.items() if book_id not in versions]
+            changes += versions.items()
+            if self.on_change and changes:
+                self.on_change(conn, changes)
+        logging.info(f"Replaced the local state with a snapshot of {snapshot['origin']} "
+                     f"({len(snapshot['books'])} books), then replayed {len(rows)} local log entries")
+        return snapshot['to_seq']
+
+    def _apply_deltas(self, conn, deltas):
+        changes = []
+        for book_id, delta, version in deltas:
+            row = conn.execute(
+                'UPDATE books SET quantity = quantity + ?, version = MAX(version + 1, ?) '
+                'WHERE id = ? RETURNING version',
+                (delta, version, book_id)
+            ).fetchone()
+            if row:
+                changes.append((book_id, row[0]))
+        return changes
+
+    def _set_applied(self, conn, origin, last_seq, log_id):
+        conn.execute(
+            'INSERT INTO replication_state (origin, last_seq, log_id) VALUES (?, ?, ?) '
+            'ON CONFLICT(origin) DO UPDATE SET last_seq = excluded.last_seq, '
+            'log_id = COALESCE(excluded.log_id, log_id)',
+            (origin, last_seq, log_id)
+        )
+
+    def _batch(self, rows, from_seq=None):
+        deltas = {}
+        moved = []
+        for _, book_id, delta, version, moved_to in rows:
+            if moved_to is not None:
+                moved.append([book_id, moved_to])
+                continue
+            total, newest = deltas.get(book_id, (0, 0))
+            deltas[book_id] = (total + delta, max(newest, version))
+        # A batch starts right before its first entry, so a receiver that misses
+        # pruned entries before it rejects the batch instead of skipping them
+        if rows:
+            from_seq = rows[0][0] - 1
+        return {
+            'version': PROTOCOL_VERSION,
+            'origin': self.origin,
+            'log_id': self.log_id,
+            'from_seq': from_seq,
+            'to_seq': rows[-1][0] if rows else from_seq,
+            'deltas': [[book_id, delta, version] for book_id, (delta, version) in deltas.items()],
+            'moved': moved,
+        }
+
+    def _prune(self):
+        # Entries every peer has acknowledged are no longer needed
+        if len(self.acked) < len(self.peers):
+            return
+        with db_pool.connection(self.database) as conn:
+            conn.execute('DELETE FROM replication_log WHERE seq <= ?', (min(self.acked.values()),))
+
+    def _catch_up(self, peer):
+        """
+        Pulls and applies everything the peer logged since our last applied sequence.
+        """
+        try:
+            while True:
+                resp = http_client.get(f"{peer}/replication/state")
+                resp.raise_for_status()
+                state = resp.json()
+                with db_pool.connection(self.database) as conn:
+                    since = self._applied(conn, state['origin'], state.get('log_id'))
+                resp = http_client.get(f"{peer}/replication/log", params={'since': since},
+                                       headers={'Accept': codec.ACCEPT})
+                resp.raise_for_status()
+                batch = codec.decode(resp.content, resp.headers.get('Content-Type'))
+                if batch['to_seq'] == since:
+                    return
+                self.apply(batch)
+        except Exception as e:
+            # The peer's shipper will push the missing entries once it reaches us
+            logging.info(f"Replication catch-up from {peer} skipped: {e}")
+
+    def _resync(self, peer):
+        # Sends the peer a snapshot; returns the sequence it now has applied from here
+        snapshot = self.snapshot()
+        with tracing.trace("replication snapshot", peer=peer, books=len(snapshot['books'])):
+            resp = http_client.post(f"{peer}/replication/snapshot", json=snapshot)
+        resp.raise_for_status()
+        logging.info(f"Sent {peer} a snapshot of {len(snapshot['books'])} books")
+        return resp.json()['last_seq']
+
+    def _ship(self, peer):
+        wakeup = self._wakeups[peer]
+        acked = None
+        backoff = 0.1
+        while True:
+            try:
+                if acked is None:
+                    resp = http_client.get(f"{peer}/replication/state")
+                    resp.raise_for_status()
+                    state = resp.json()
+                    if state.get('logs', {}).get(self.origin, self.log_id) != self.log_id:
+                        # The peer only knows an earlier database of ours
+                        acked = 0
+                    else:
+                        acked = state['applied'].get(self.origin, 0)
+                    resync = state.get('synced') is False
+                with db_pool.connection(self.database) as conn:
+                    # One read transaction, so the entries match the log position
+                    conn.execute('BEGIN')
+                    rows = conn.execute(
+                        'SELECT seq, book_id, delta, version, moved_to FROM replication_log '
+                        'WHERE seq > ? ORDER BY seq LIMIT ?',
+                        (acked, REPLICATION_BATCH_SIZE)
+                    ).fetchall()
+                    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'").fetchone()
+                # A new database, or one that is behind what is left of the log
+                if resync or (rows[0][0] > acked + 1 if rows else (row[0] if row else 0) > acked):
+                    acked = self._resync(peer)
+                    resync = False
+                    self.acked[peer] = acked
+                    continue
+                if not rows:
+                    self.acked[peer] = acked
+                    wakeup.wait(REPLICATION_POLL_INTERVAL)
+                    wakeup.clear()
+                    time.sleep(REPLICATION_LINGER)
+                    continue
+                with tracing.trace("replication ship", peer=peer, entries=len(rows)):
+                    resp = http_client.post(f"{peer}/replication/apply", json=self._batch(rows))
+                if resp.status_code not in (200, 409):
+                    resp.raise_for_status()
+                acked = resp.json()['last_seq']
+                self.acked[peer] = acked
+                self._prune()
+                backoff = 0.1
+            except Exception as e:
+                logging.warning(f"Replication to {peer} failed, retrying in {backoff:.1f}s: {e}")
+                acked = None
+                time.sleep(backoff)
+                backoff = min(backoff * 2, REPLICATION_MAX_BACKOFF)
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+import db_pool
+from feed import InvalidationFeed
+
+
+@pytest.fixture
+def feed(tmp_path):
+    feed = InvalidationFeed(str(tmp_path / 'catalog.db'), retain=3)
+    feed.init_db()
+    return feed
+
+
+def record(feed, *changes):
+    with db_pool.connection(feed.database) as conn:
+        feed.record(conn, list(changes))
+    feed.notify()
+
+
+def events(stream, n):
+    return [next(stream) for _ in range(n)]
+
+
+def wait_for(feed, seq):
+    deadline = time.monotonic() + 5
+    while feed._seq < seq:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_new_subscriber_is_reset_to_the_current_position(feed):
+    record(feed, (1, 1), (2, 1))
+    feed.start()
+    assert events(feed.stream(), 2) == ['retry: 1000\n\n', f'event: reset\nid: {feed.epoch}:2\ndata: []\n\n']
+
+
+def test_changes_are_batched_and_resumed(feed):
+    record(feed, (1, 1))
+    feed.start()
+    stream = feed.stream(f'{feed.epoch}:1')
+    # Caught up: a heartbeat right away
+    assert events(stream, 2) == ['retry: 1000\n\n', ': keepalive\n\n']
+    record(feed, (1, 2), (2, 5))
+    wait_for(feed, 3)
+    assert next(stream) == f'id: {feed.epoch}:3\ndata: [[1, 2], [2, 5]]\n\n'
+    # A subscriber that reconnects continues after its last event
+    assert events(feed.stream(f'{feed.epoch}:2'), 2)[1] == f'id: {feed.epoch}:3\ndata: [[2, 5]]\n\n'
+
+
+@pytest.mark.parametrize('last_event_id', ['other:1', 'garbage', '{epoch}:9'])
+def test_unknown_positions_get_a_reset(feed, last_event_id):
+    record(feed, (1, 1))
+    feed.start()
+    event = events(feed.stream(last_event_id.format(epoch=feed.epoch)), 2)[1]
+    assert event.startswith('event: reset\n')
+
+
+def test_pruned_events_get_a_reset(feed):
+    record(feed, *[(book_id, 1) for book_id in range(1, 6)])
+    feed.start()
+    # Only the last 3 of 5 events are retained
+    assert events(feed.stream(f'{feed.epoch}:1'), 2)[1].startswith('event: reset\n')
+    assert events(feed.stream(f'{feed.epoch}:2'), 2)[1] == f'id: {feed.epoch}:5\ndata: [[3, 1], [4, 1], [5, 1]]\n\n'
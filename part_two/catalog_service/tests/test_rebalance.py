@@ -0,0 +1,130 @@
+import pytest
+
+import database
+import db_pool
+import rebalance
+from rebalance import Rebalancer
+from replication import Replicator
+from sharding import ShardMap
+
+A = ['http://a1', 'http://a2']
+B = ['http://b1', 'http://b2']
+# Of the default books, group 'b' owns 1 and 3
+SPLIT = ShardMap({'a': A, 'b': B}, 2, previous={'a': A})
+
+
+class FakeResponse:
+    def raise_for_status(self):
+        pass
+
+
+class Cluster:
+    """
+    Replicas a1 (the primary) and a2 of group 'a', which starts with every book, and b1 (the
+    primary) and b2 of the new group 'b'; handoffs to /shards/import go straight to the replica's Rebalancer.
+    """
+
+    def __init__(self, tmp_path, monkeypatch):
+        self.rebalancers = {}
+        self.replicators = {}
+        self.imports = []
+        self.failures = 0
+        for url, group, shards in (('http://a1', 'a', {'a': A}), ('http://a2', 'a', {'a': A}),
+                                   ('http://b1', 'b', None), ('http://b2', 'b', None)):
+            path = str(tmp_path / f"{url.rsplit('/', 1)[1]}.db")
+            peers = [peer for peer in (A if group == 'a' else B) if peer != url]
+            rebalancer = Rebalancer(path, group, peers)
+            rebalancer.init_db(shards)
+            monkeypatch.setattr(database, 'DATABASE', path)
+            database.init_db(seeds=rebalancer.seeds)
+            replicator = Replicator(path, peers, origin=url, on_move=rebalancer.remove,
+                                    tombstones=rebalancer.tombstones)
+            replicator.init_db()
+            rebalancer.replicator = replicator
+            self.rebalancers[url] = rebalancer
+            self.replicators[url] = replicator
+        monkeypatch.setattr(rebalance.http_client, 'post', self.post)
+
+    def post(self, url, json=None, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('connection refused')
+        replica, _, path = url.partition('/shards')
+        assert path == '/import'
+        self.imports.append((replica, [book[0] for book in json['books']]))
+        self.rebalancers[replica].import_books(json['books'])
+        return FakeResponse()
+
+    def install(self, shard_map):
+        for rebalancer in self.rebalancers.values():
+            assert rebalancer.install(shard_map)
+
+    def books(self, url):
+        with db_pool.connection(self.rebalancers[url].database) as conn:
+            return dict(conn.execute('SELECT id, quantity FROM books'))
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    return Cluster(tmp_path, monkeypatch)
+
+
+def test_primary_hands_the_new_groups_books_over(cluster):
+    assert sorted(cluster.books('http://a1')) == [1, 2, 3, 4, 5, 6, 7]
+    assert cluster.books('http://b1') == {}
+    cluster.install(SPLIT)
+    a1 = cluster.rebalancers['http://a1']
+    a1._rebalance(SPLIT)
+    # Every replica of the new group gets the books, its primary last
+    assert cluster.imports == [('http://b2', [1, 3]), ('http://b1', [1, 3])]
+    assert sorted(cluster.books('http://b1')) == sorted(cluster.books('http://b2')) == [1, 3]
+    assert sorted(cluster.books('http://a1')) == [2, 4, 5, 6, 7]
+    assert a1.moved_to(1) == 'b' and a1.moved_to(2) is None
+    assert a1.pending() == {} and a1.status()['rebalanced'] == 2
+
+
+def test_other_replicas_finish_once_the_moves_are_replicated(cluster):
+    cluster.install(SPLIT)
+    cluster.rebalancers['http://a1']._rebalance(SPLIT)
+    a2 = cluster.rebalancers['http://a2']
+    a2._rebalance(SPLIT)
+    assert len(cluster.imports) == 2
+    assert a2.status()['rebalanced'] == 0
+    cluster.replicators['http://a2'].apply(cluster.replicators['http://a1'].log_since(0))
+    assert sorted(cluster.books('http://a2')) == [2, 4, 5, 6, 7]
+    assert a2.moved_to(3) == 'b'
+    a2._rebalance(SPLIT)
+    assert a2.status()['rebalanced'] == 2
+
+
+def test_failed_handoff_is_kept_and_retried(cluster):
+    cluster.install(SPLIT)
+    cluster.failures = 1
+    a1 = cluster.rebalancers['http://a1']
+    with pytest.raises(ConnectionError):
+        a1._rebalance(SPLIT)
+    # The books left 'a' but are kept until 'b' has them
+    assert sorted(cluster.books('http://a1')) == [2, 4, 5, 6, 7]
+    assert a1.pending() == {'b': 2}
+    a1._rebalance(SPLIT)
+    assert sorted(cluster.books('http://b1')) == [1, 3]
+    assert a1.pending() == {} and a1.status()['rebalanced'] == 2
+
+
+def test_repeated_import_changes_nothing(cluster):
+    b1 = cluster.rebalancers['http://b1']
+    b1.import_books([[1, 'Book', 'travel', 5, 10.0, 3]])
+    b1.import_books([[1, 'Book', 'travel', 9, 10.0, 3]])
+    assert cluster.books('http://b1') == {1: 5}
+    with pytest.raises(ValueError):
+        b1.import_books([[2, 'Book', 'travel', True, 10.0, 3]])
+    assert cluster.books('http://b1') == {1: 5}
+
+
+def test_older_shard_maps_are_not_installed(cluster):
+    b1 = cluster.rebalancers['http://b1']
+    assert b1.install(SPLIT)
+    assert not b1.install(SPLIT)
+    with pytest.raises(ValueError):
+        b1.install(ShardMap({'a': A}, 3))
+    assert b1.status()['epoch'] == 2 and b1.shard_map().owners(1) == ['b', 'a']
@@ -0,0 +1,108 @@
+import pytest
+
+import database
+import db_pool
+from replication import Replicator, SequenceMismatch, StaleSnapshot
+
+
+def replica(tmp_path, monkeypatch, name):
+    path = str(tmp_path / f'{name}.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    database.init_db()
+    replicator = Replicator(path, [], origin=name)
+    replicator.init_db()
+    return replicator
+
+
+@pytest.fixture
+def a(tmp_path, monkeypatch):
+    return replica(tmp_path, monkeypatch, 'a')
+
+
+@pytest.fixture
+def b(tmp_path, monkeypatch):
+    return replica(tmp_path, monkeypatch, 'b')
+
+
+def write(replicator, book_id, delta):
+    with db_pool.connection(replicator.database) as conn:
+        version = database.update_stock(book_id, delta, conn)
+        replicator.record(conn, book_id, delta, version)
+
+
+def prune(replicator, seq):
+    with db_pool.connection(replicator.database) as conn:
+        conn.execute('DELETE FROM replication_log WHERE seq <= ?', (seq,))
+
+
+def quantities(replicator):
+    with db_pool.connection(replicator.database) as conn:
+        return dict(conn.execute('SELECT id, quantity FROM books'))
+
+
+def test_batches_are_applied_in_sequence(a, b):
+    write(a, 1, -1)
+    write(a, 1, -2)
+    write(a, 2, -1)
+    batch = a.log_since(0)
+    assert (batch['from_seq'], batch['to_seq']) == (0, 3)
+    assert batch['deltas'] == [[1, -3, 2], [2, -1, 1]]
+    assert b.apply(batch) == 3
+    # A retry after a lost acknowledgement changes nothing
+    assert b.apply(batch) == 3
+    assert quantities(b)[1] == 7 and quantities(b)[2] == 9
+    assert b.state()['applied'] == {'a': 3}
+
+
+def test_batch_after_a_gap_is_rejected(a, b):
+    for _ in range(3):
+        write(a, 1, -1)
+    prune(a, 2)
+    batch = a.log_since(0)
+    # The batch starts right before its first entry, not where the receiver asked
+    assert batch['from_seq'] == 2
+    with pytest.raises(SequenceMismatch) as e:
+        b.apply(batch)
+    assert e.value.last_seq == 0
+    assert quantities(b)[1] == 10
+
+
+def test_new_log_of_an_origin_is_counted_from_zero(a, b, tmp_path, monkeypatch):
+    for _ in range(3):
+        write(a, 1, -1)
+    b.apply(a.log_since(0))
+    # 'a' comes back with a new database, whose log starts over at 1
+    (tmp_path / 'restarted').mkdir()
+    restarted = replica(tmp_path / 'restarted', monkeypatch, 'a')
+    write(restarted, 2, -1)
+    assert b.apply(restarted.log_since(0)) == 1
+    assert quantities(b)[2] == 9
+
+
+def test_snapshot_replaces_the_state_and_replays_own_writes(a, b):
+    for _ in range(3):
+        write(a, 1, -1)
+    write(b, 2, -1)
+    a.apply(b.log_since(0))
+    # Not yet shipped to 'a'
+    write(b, 3, -4)
+    prune(a, 2)
+    assert not b.state()['synced']
+    assert b.apply_snapshot(a.snapshot()) == 3
+    assert quantities(b) == {**quantities(a), 3: 6}
+    state = b.state()
+    assert state['synced'] and state['applied'] == {'a': 3} and state['logs'] == {'a': a.log_id}
+    # Deltas continue after the snapshot
+    write(a, 1, -1)
+    assert b.apply(a.log_since(3)) == 4
+    assert quantities(b)[1] == 6
+
+
+def test_snapshot_without_pruned_own_writes_is_stale(a, b):
+    write(b, 2, -1)
+    write(b, 2, -1)
+    snapshot = a.snapshot()
+    prune(b, 1)
+    with pytest.raises(StaleSnapshot):
+        b.apply_snapshot(snapshot)
+    assert quantities(b)[2] == 8
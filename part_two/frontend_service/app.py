@@ -1,81 +1,521 @@
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlencode
+import contextvars
+import logging
+import os
+import threading
 import requests
-from collections import OrderedDict
+import admission
+import codec
+import http_client
+import metrics
+import tracing
+from cache import (FRESH, REVALIDATE, REVALIDATION_FAILED_WARNING, STALE_WARNING, TTLCache, SingleFlight,
+                   export_metrics, load_snapshot, save_snapshot)
+from replicas import ReplicaSet
+from invalidation import VersionTracker, InvalidationListener
+from sharding import MISDIRECTED, ShardRouter
 
 app = Flask(__name__)
+metrics.instrument_flask(app)
+tracing.instrument_flask(app)
+# Deadlines, per-route and per-upstream limits, load shedding (see admission.py)
+admission.instrument_flask(app)
 
-CATALOG_REPLICAS = [
-    "http://catalog_service_1:5000",
-    "http://catalog_service_2:5000"
-]
-
-ORDER_REPLICAS = [
-    "http://order_service_1:5001",
-    "http://order_service_2:5001"
-]
-
-catalog_rr = 0
-order_rr = 0
-
-CACHE_SIZE = 5
-cache = OrderedDict()
-
-def get_catalog_replica():
-    global catalog_rr
-    replica = CATALOG_REPLICAS[catalog_rr]
-    catalog_rr = (catalog_rr + 1) % len(CATALOG_REPLICAS)
-    return replica
-
-def get_order_replica():
-    global order_rr
-    replica = ORDER_REPLICAS[order_rr]
-    order_rr = (order_rr + 1) % len(ORDER_REPLICAS)
-    return replica
-
-def cache_get(key):
-    if key in cache:
-        cache.move_to_end(key)
-        return cache[key]
-    return None
-
-def cache_put(key, value):
-    cache[key] = value
-    cache.move_to_end(key)
-    if len(cache) > CACHE_SIZE:
-        cache.popitem(last=False)
+# Most IDs accepted by one /info?ids= request (as on the catalog)
+MAX_BATCH_IDS = 500
+
+# Replica lists, comma separated
+CATALOG_REPLICAS = os.environ.get(
+    "CATALOG_REPLICAS", "http://catalog_service_1:5000,http://catalog_service_2:5000"
+).split(",")
+
+ORDER_REPLICAS = os.environ.get(
+    "ORDER_REPLICAS", "http://order_service_1:5001,http://order_service_2:5001"
+).split(",")
+
+# Catalog shard groups (see sharding.py); without CATALOG_SHARDS the catalog
+# replicas above are the only group
+catalog_shards = ShardRouter(CATALOG_REPLICAS)
+order_replicas = ReplicaSet("order", ORDER_REPLICAS)
+
+# Shard group name -> ReplicaSet, created as groups appear in the shard map
+catalog_replicas = {}
+catalog_replicas_lock = threading.Lock()
+health_checks_started = False
+
+# Calls to several shard groups (search, multi-get) run in parallel
+SCATTER_THREADS = int(os.environ.get("SCATTER_THREADS", 16))
+scatter_pool = ThreadPoolExecutor(max_workers=SCATTER_THREADS)
+
+cache = TTLCache()
+inflight = SingleFlight()
+export_metrics(cache)
+
+# A worker saves its hottest cache entries here when it exits, and a new worker loads them
+# (unset: no snapshot). In the background, every worker also loads up to CACHE_WARMUP_BOOKS
+# books from the catalogs' /books dump, for at most CACHE_WARMUP_TIMEOUT seconds, while it
+# already serves requests; /health answers 503 until then
+CACHE_SNAPSHOT = os.environ.get("CACHE_SNAPSHOT")
+CACHE_WARMUP_BOOKS = int(os.environ.get("CACHE_WARMUP_BOOKS", 512))
+CACHE_WARMUP_TIMEOUT = float(os.environ.get("CACHE_WARMUP_TIMEOUT", 10))
+WARMUP_PAGE_SIZE = 500
+ready = threading.Event()
+
+# Catalog replicas push [book_id, version] pairs for every write; entries older
+# than the newest known version of their book are never served from the cache
+versions = VersionTracker()
+invalidations = InvalidationListener(catalog_shards.map.urls(), cache, versions)
+
+def shard_replicas(name):
+    """
+    The replicas of one catalog shard group
+    """
+    replicas = catalog_replicas.get(name)
+    if replicas is None:
+        with catalog_replicas_lock:
+            replicas = catalog_replicas.get(name)
+            if replicas is None:
+                replicas = catalog_replicas[name] = ReplicaSet("catalog", catalog_shards.map.group(name))
+                if health_checks_started:
+                    replicas.start_health_checks()
+    return replicas
+
+def on_shard_map(shard_map):
+    # A new shard group: check its replicas' health and follow their invalidations
+    for name in shard_map.names():
+        shard_replicas(name)
+    for url in shard_map.urls():
+        invalidations.add(url)
+
+catalog_shards.subscribe(on_shard_map)
+on_shard_map(catalog_shards.map)
+
+def start_worker_tasks():
+    """
+    Background work every serving process needs: each has its own cache, replica
+    statistics and copy of the shard map
+    """
+    global health_checks_started
+    with catalog_replicas_lock:
+        health_checks_started = True
+        for replicas in catalog_replicas.values():
+            replicas.start_health_checks()
+    order_replicas.start_health_checks()
+    catalog_shards.start()
+    invalidations.start()
+
+def restore_cache():
+    """
+    Loads the cache snapshot and the invalidation feed positions saved with it;
+    before start_worker_tasks(), so that the feeds replay what changed since
+    """
+    if not CACHE_SNAPSHOT:
+        return
+    restored, state = load_snapshot(cache, CACHE_SNAPSHOT)
+    if state:
+        invalidations.resume(state.get("feeds") or {})
+    logging.info(f"Restored {restored} cache entries from {CACHE_SNAPSHOT}")
+
+def save_cache():
+    """
+    Writes the cache snapshot, when the worker exits
+    """
+    if not CACHE_SNAPSHOT:
+        return
+    # Positions first: an event applied after they were read is replayed again,
+    # instead of missing from entries saved before it
+    state = {"feeds": dict(invalidations.positions)}
+    saved = save_snapshot(cache, CACHE_SNAPSHOT, state)
+    logging.info(f"Saved {saved} cache entries to {CACHE_SNAPSHOT}")
+
+def warm_up():
+    """
+    Loads books from every shard group's /books dump into the cache, once the
+    invalidation feeds have caught up (so that only later changes evict them),
+    then reports ready; a catalog that fails only leaves the cache colder.
+    Runs in a thread of its own (see start_warm_up())
+    """
+    try:
+        with http_client.deadline(CACHE_WARMUP_TIMEOUT):
+            # Half of the time at most: a catalog that is down is not waited for
+            invalidations.wait_synced(CACHE_WARMUP_TIMEOUT / 2)
+            shard_map = catalog_shards.map
+            names = shard_map.names()
+            per_group = -(-CACHE_WARMUP_BOOKS // len(names)) if names else 0
+            loaded = sum(warm_up_group(name, per_group) for name in names)
+        logging.info(f"Cache warmed up with {loaded} books")
+    except (requests.exceptions.RequestException, ValueError, admission.Shed) as e:
+        logging.warning(f"Cache warm-up stopped early: {e}")
+    finally:
+        ready.set()
+
+def start_warm_up():
+    """
+    Warms the cache up in the background, so the worker takes requests meanwhile.
+    After CACHE_WARMUP_TIMEOUT seconds the worker reports ready even if the warm-up is stuck
+    """
+    threading.Thread(target=warm_up, name="cache-warm-up", daemon=True).start()
+    deadline = threading.Timer(CACHE_WARMUP_TIMEOUT, end_warm_up)
+    deadline.daemon = True
+    deadline.start()
+
+def end_warm_up():
+    """
+    Reports ready with whatever the cache holds, if the warm-up has not finished yet
+    """
+    if not ready.is_set():
+        logging.warning(f"Cache warm-up took over {CACHE_WARMUP_TIMEOUT}s, reporting ready with a cold cache")
+        ready.set()
+
+def warm_up_group(name, limit):
+    """
+    Pages through one shard group's books, caching at most 'limit'
+    """
+    loaded, cursor = 0, 0
+    while loaded < limit:
+        generation = cache.generation
+        resp = shard_replicas(name).request("GET", "/books", headers={"Accept": codec.ACCEPT},
+                                            params={"cursor": cursor, "limit": min(WARMUP_PAGE_SIZE, limit - loaded)})
+        resp.raise_for_status()
+        books = codec.decode(resp.content, resp.headers.get("Content-Type"))
+        for book in books:
+            key = ("info", book["id"])
+            versions.observe(book["id"], book["version"])
+            if not is_stale(key, book):
+                cache.put_response(key, book, 200, generation)
+        loaded += len(books)
+        if "X-Next-Cursor" not in resp.headers:
+            return loaded
+        cursor = resp.headers["X-Next-Cursor"]
+    return loaded
+
+def scatter(calls):
+    """
+    Runs {name: function} in parallel, each in a copy of the request's context (so
+    its trace), and returns {name: result}; raises the error of a failed call
+    """
+    if len(calls) == 1:
+        return {name: call() for name, call in calls.items()}
+    futures = {name: scatter_pool.submit(contextvars.copy_context().run, call) for name, call in calls.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+def is_stale(key, data):
+    return key[0] == "info" and "version" in data and versions.is_stale(key[1], data["version"])
+
+def cached_catalog_get(key, path):
+    """
+    Read-through lookup; concurrent misses for the same key share one upstream fetch.
+    An entry past its TTL is answered with right away and refreshed in the background,
+    and one kept for errors (see cache.py) if every replica fails or the catalog's
+    admission limit sheds the request
+    """
+    cached = cache.lookup(key)
+    if cached is not None and is_stale(key, cached[0][0]):
+        cache.invalidate(key)
+        cached = None
+    if cached is not None and cached[1] == FRESH:
+        return cached[0]
+    if cached is not None and cached[1] == REVALIDATE:
+        inflight.start(key, lambda: refresh_catalog(key, path))
+        mark_stale(STALE_WARNING)
+        return cached[0]
+    try:
+        result = inflight.do(key, lambda: fetch_catalog(key, path))
+    except admission.Shed:
+        stale = serve_stale(key)
+        if stale is None:
+            raise
+        return stale
+    if result[1] >= 500:
+        return serve_stale(key) or result
+    return result
+
+def refresh_catalog(key, path):
+    """
+    Background refreshes run outside of any request (so without its deadline), in
+    an app context of their own
+    """
+    with app.app_context():
+        return fetch_catalog(key, path)
+
+def serve_stale(key):
+    """
+    The entry of key the cache keeps for errors, if any and not outdated by the
+    invalidation feed; the response is marked as stale
+    """
+    stale = cache.get_stale(key, revalidate=True)
+    if stale is None or is_stale(key, stale[0]):
+        return None
+    mark_stale(REVALIDATION_FAILED_WARNING)
+    return stale
+
+def mark_stale(warning):
+    g.cache_warning = warning
+
+@app.after_request
+def add_cache_warning(response):
+    warning = g.pop("cache_warning", None)
+    if warning is not None:
+        response.headers["Warning"] = warning
+    return response
+
+def fetch_catalog(key, path):
+    """
+    /info goes to the shard group that owns the book, /search to all of them
+    """
+    generation = cache.generation
+    shard_map = catalog_shards.map
+    try:
+        if key[0] == "search":
+            data, status, body = search_catalog(path, key[2])
+        else:
+            resp = catalog_shards.route(key[1], lambda shard: shard_replicas(shard).request(
+                "GET", path, headers={"Accept": codec.ACCEPT}))
+            data, status, body = decode_response(resp)
+    except requests.exceptions.RequestException:
+        return {"error": "All catalog replicas are down"}, 503, None
+    if status == MISDIRECTED:
+        return {"error": "Book is being moved to another shard group, try again"}, 503, None
+    if key[0] == "info" and "version" in data:
+        versions.observe(key[1], data["version"])
+    # A lagging replica may answer with an older version than the feed announced,
+    # and a book missing while books move between shard groups may turn up soon
+    if not is_stale(key, data) and not (status == 404 and shard_map.rebalancing):
+        cache.put_response(key, data, status, generation, body)
+    return data, status, body
+
+def decode_response(resp):
+    """
+    The catalog answers in MessagePack if it can (see codec.py); the JSON body for
+    clients is encoded once here, or taken as is from a JSON answer, and cached too
+    """
+    content_type = resp.headers.get("Content-Type")
+    data = codec.decode(resp.content, content_type)
+    body = resp.content if codec.is_json(content_type) else jsonify(data).get_data()
+    return data, resp.status_code, body
+
+def search_catalog(path, limit=None):
+    """
+    Scatter-gather: every shard group is searched in parallel, results are merged by ID.
+    Each group answers with a page after the same cursor, so the first 'limit' merged
+    books are the page of the whole catalog
+    """
+    responses = scatter({
+        name: partial(shard_replicas(name).request, "GET", path, headers={"Accept": codec.ACCEPT})
+        for name in catalog_shards.map.names()
+    })
+    if len(responses) == 1:
+        return decode_response(*responses.values())
+    books = {}
+    for resp in responses.values():
+        data, status, body = decode_response(resp)
+        if status != 200:
+            return data, status, body
+        for book in data:
+            books.setdefault(book["id"], book)
+    merged = [books[book_id] for book_id in sorted(books)]
+    if limit is not None:
+        merged = merged[:int(limit)]
+    return merged, 200, jsonify(merged).get_data()
+
+def fetch_batch(book_ids, owner):
+    """
+    One /info?ids= call per shard group (owner(book_id) names it), in parallel.
+    Returns ({book_id: book}, [missing IDs], (error, status) of a failed call or None)
+    """
+    by_shard = {}
+    for book_id in book_ids:
+        by_shard.setdefault(owner(book_id), []).append(book_id)
+    responses = scatter({
+        name: partial(shard_replicas(name).request, "GET", "/info", params={"ids": ",".join(map(str, ids))},
+                      headers={"Accept": codec.ACCEPT})
+        for name, ids in by_shard.items()
+    })
+    items, missing = {}, []
+    for resp in responses.values():
+        data = codec.decode(resp.content, resp.headers.get("Content-Type"))
+        if resp.status_code != 200:
+            return items, missing, (data, resp.status_code)
+        for book in data["items"].values():
+            items[book["id"]] = book
+        missing.extend(data["missing"])
+    return items, missing, None
+
+def json_response(data, status, body=None):
+    """
+    Sends a cached JSON body as is; data without one is encoded
+    """
+    if body is None:
+        return jsonify(data), status
+    return Response(body, status=status, mimetype="application/json")
 
 @app.route("/info/<int:book_id>", methods=["GET"])
 def book_info(book_id):
-    cached = cache_get(book_id)
-    if cached:
-        print("CACHE HIT for book", book_id)
-        return jsonify(cached)
+    return json_response(*cached_catalog_get(("info", book_id), f"/info/{book_id}"))
+
 
-    print("CACHE MISS for book", book_id)
-    replica = get_catalog_replica()
-    resp = requests.get(f"{replica}/info/{book_id}")
-    data = resp.json()
-    cache_put(book_id, data)
-    return jsonify(data)
+@app.route("/info", methods=["GET"])
+def book_info_batch():
+    """
+    Multi-get: cached, current entries are answered locally; the remaining IDs
+    are fetched with one /info?ids= call per shard group and cached one by one
+    """
+    try:
+        book_ids = list(dict.fromkeys(int(i) for i in request.args.get("ids", "").split(",")))
+    except ValueError:
+        book_ids = []
+    if not book_ids or len(book_ids) > MAX_BATCH_IDS:
+        return jsonify({"error": f"ids must be a comma separated list of at most {MAX_BATCH_IDS} book IDs"}), 400
+    found, wanted = {}, []
+    for book_id in book_ids:
+        key = ("info", book_id)
+        cached = cache.get(key)
+        if cached is not None and is_stale(key, cached[0]):
+            cache.invalidate(key)
+            cached = None
+        if cached is None:
+            wanted.append(book_id)
+        elif cached[1] == 200:
+            found[book_id] = cached[0]
+    if wanted:
+        generation = cache.generation
+        shard_map = catalog_shards.map
+        try:
+            items, missing, error = fetch_batch(wanted, shard_map.owner)
+            # Books their new shard group has not imported yet are at the previous one
+            moving = [book_id for book_id in missing if len(shard_map.owners(book_id)) > 1]
+            if error is None and moving:
+                moved, _, error = fetch_batch(moving, lambda book_id: shard_map.owners(book_id)[1])
+                items.update(moved)
+        except (requests.exceptions.RequestException, admission.Shed) as e:
+            stale = stale_books(wanted)
+            if stale is not None:
+                found.update(stale)
+                return batch_response(book_ids, found)
+            if isinstance(e, admission.Shed):
+                raise
+            return jsonify({"error": "All catalog replicas are down"}), 503
+        if error is not None:
+            stale = stale_books(wanted) if error[1] >= 500 else None
+            if stale is None:
+                return jsonify(error[0]), error[1]
+            found.update(stale)
+            return batch_response(book_ids, found)
+        for book in items.values():
+            key = ("info", book["id"])
+            versions.observe(book["id"], book["version"])
+            found[book["id"]] = book
+            if not is_stale(key, book):
+                cache.put_response(key, book, 200, generation)
+        if not shard_map.rebalancing:
+            for book_id in missing:
+                cache.put_response(("info", book_id), {"error": "Book not found"}, 404, generation)
+    return batch_response(book_ids, found)
+
+def stale_books(book_ids):
+    """
+    {book_id: book} of the entries the cache keeps for errors (404s left out), or
+    None if one of them is gone or outdated; the response is marked as stale
+    """
+    stale = {}
+    for book_id in book_ids:
+        cached = cache.get_stale(("info", book_id))
+        if cached is None or is_stale(("info", book_id), cached[0]):
+            return None
+        if cached[1] == 200:
+            stale[book_id] = cached[0]
+    mark_stale(REVALIDATION_FAILED_WARNING)
+    return stale
+
+def batch_response(book_ids, found):
+    return jsonify({
+        "items": {str(book_id): found[book_id] for book_id in book_ids if book_id in found},
+        "missing": [book_id for book_id in book_ids if book_id not in found]
+    })
+
+
+@app.route("/search/<topic>", methods=["GET"])
+def search(topic):
+    """
+    Paginated with limit/cursor like the catalog, each page cached on its own; the
+    X-Next-Cursor header is rebuilt from the page instead of being cached
+    """
+    limit, cursor = request.args.get("limit"), request.args.get("cursor")
+    params = {name: value for name, value in (("limit", limit), ("cursor", cursor)) if value is not None}
+    path = f"/search/{topic}?{urlencode(params)}" if params else f"/search/{topic}"
+    data, status, body = cached_catalog_get(("search", topic, limit, cursor), path)
+    response = make_response(json_response(data, status, body))
+    if status == 200 and limit is not None and len(data) == int(limit):
+        response.headers["X-Next-Cursor"] = str(data[-1]["id"])
+    return response
 
 
 @app.route("/purchase/<int:book_id>", methods=["POST"])
 def purchase(book_id):
-    for replica in ORDER_REPLICAS:
-        try:
-            resp = requests.post(f"{replica}/purchase/{book_id}", timeout=2)
-            return jsonify(resp.json())
-        except requests.exceptions.RequestException:
-            continue
-
-    return jsonify({"error": "All order replicas are down"}), 500
+    try:
+        resp = order_replicas.request("POST", f"/purchase/{book_id}", idempotent=False)
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "All order replicas are down"}), 500
+    # The order service's JSON needs no changes: pass its bytes through
+    return Response(resp.content, status=resp.status_code, mimetype="application/json")
 
 @app.route("/invalidate/<int:book_id>", methods=["POST"])
 def invalidate(book_id):
-    if book_id in cache:
-        del cache[book_id]
+    cache.invalidate(("info", book_id))
     return jsonify({"status": "cache invalidated"})
 
+
+@app.route("/invalidate", methods=["POST"])
+def invalidate_batch():
+    data = request.get_json(silent=True)
+    book_ids = data.get("ids") if isinstance(data, dict) else None
+    if (not isinstance(book_ids, list) or not book_ids
+            or not all(isinstance(i, int) and not isinstance(i, bool) for i in book_ids)):
+        return jsonify({"error": "ids must be a non-empty list of book IDs"}), 400
+    for book_id in book_ids:
+        cache.invalidate(("info", book_id))
+    return jsonify({"status": "cache invalidated", "count": len(book_ids)})
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """
+    Readiness: 503 until the cache has been warmed up (see warm_up())
+    """
+    if not ready.is_set():
+        return jsonify({"status": "warming up"}), 503
+    return jsonify({"status": "ok"})
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(cache.stats())
+
+
+@app.route("/replicas", methods=["GET"])
+def replica_stats():
+    catalog = [dict(stats, shard=name) for name, replicas in list(catalog_replicas.items())
+               for stats in replicas.stats()]
+    return jsonify({"catalog": catalog, "order": order_replicas.stats()})
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Metrics of every worker process, in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
+    import atexit
+    restore_cache()
+    start_worker_tasks()
+    start_warm_up()
+    atexit.register(save_cache)
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,42 @@
+# Production serving: gunicorn -c gunicorn.conf.py app:app
+#
+# Every worker has its own cache, replica statistics and invalidation streams.
+# A worker restores its cache before it takes requests, warms it up in the
+# background, and saves it when it exits (see warm_up() in app.py).
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+# Workers share their metrics through snapshot files in this directory (see metrics.py)
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='bazar-metrics-'))
+
+
+def on_starting(server):
+    import metrics
+    metrics.clear()
+
+
+def post_worker_init(worker):
+    import metrics
+    metrics.start()
+    import app
+    app.restore_cache()
+    app.start_worker_tasks()
+    app.start_warm_up()
+
+
+def worker_exit(server, worker):
+    import app
+    import metrics
+    metrics.flush()
+    try:
+        app.save_cache()
+    except OSError as e:
+        worker.log.warning(f"Saving the cache snapshot failed: {e}")
@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import http_client
+
+FEED_PATH = "/invalidations/stream"
+# Catalog sends a heartbeat every 15 s by default; a silent stream is dead
+FEED_READ_TIMEOUT = float(os.environ.get('INVALIDATION_FEED_READ_TIMEOUT', 45.0))
+FEED_MAX_BACKOFF = float(os.environ.get('INVALIDATION_FEED_MAX_BACKOFF', 5.0))
+
+
+class VersionTracker:
+    """
+    Newest row version seen for every book, from the feed or from responses.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def observe(self, book_id, version):
+        """
+        Records a version; returns True if it is newer than anything seen before.
+        """
+        with self._lock:
+            if version <= self._versions.get(book_id, -1):
+                return False
+            self._versions[book_id] = version
+            return True
+
+    def latest(self, book_id):
+        with self._lock:
+            return self._versions.get(book_id, 0)
+
+    def is_stale(self, book_id, version):
+        return version < self.latest(book_id)
+
+
+class InvalidationListener:
+    """
+    Consumes the invalidation feed of every catalog replica.
+
+    Each [book_id, version] pair newer than the known version evicts the book's
+    cached /info entry; a 'reset' event (the replica restarted or we fell too far
+    behind) expires the whole cache, whose entries are then only answered with
+    while the catalog fails (see TTLCache.expire()). Streams are resumed with
+    Last-Event-ID after a disconnect, and after a restart from the positions
+    saved with a cache snapshot (see resume()).
+    """
+
+    def __init__(self, urls, cache, versions):
+        self.urls = list(urls)
+        self.cache = cache
+        self.versions = versions
+        self.connected = {url: False for url in self.urls}
+        # Whether a feed has caught up since it connected: it replayed what was
+        # missed, sent a reset or a heartbeat
+        self.synced = {url: False for url in self.urls}
+        # url -> id of the last event applied to the cache
+        self.positions = {}
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._started = True
+            for url in self.urls:
+                threading.Thread(target=self._listen, args=(url,), daemon=True).start()
+
+    def resume(self, positions):
+        """
+        Continues the feeds from positions saved with the cache's entries, before
+        start(): the events missed in between are replayed instead of a reset.
+        """
+        self.positions.update((url, position) for url, position in positions.items() if position)
+
+    def wait_synced(self, timeout):
+        """
+        Waits until every feed has caught up; returns False if one has not in time.
+        """
+        deadline = time.monotonic() + timeout
+        while not all(self.synced.values()):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def add(self, url):
+        """
+        Follows one more replica's feed, e.g. of a new shard group.
+        """
+        with self._lock:
+            if url in self.connected:
+                return
+            self.urls.append(url)
+            self.connected[url] = False
+            self.synced[url] = False
+            if self._started:
+                threading.Thread(target=self._listen, args=(url,), daemon=True).start()
+
+    def _listen(self, url):
+        last_event_id = self.positions.get(url)
+        backoff = 0.1
+        while True:
+            try:
+                headers = {"Last-Event-ID": last_event_id} if last_event_id else {}
+                with http_client.get(f"{url}{FEED_PATH}", headers=headers, stream=True, retry=False,
+                                     timeout=(http_client.CONNECT_TIMEOUT, FEED_READ_TIMEOUT)) as resp:
+                    resp.raise_for_status()
+                    self.connected[url] = True
+                    backoff = 0.1
+                    event, data = None, []
+                    for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+                        if line == "":
+                            if data:
+                                self._dispatch(event, "\n".join(data))
+                                self.positions[url] = last_event_id
+                                self.synced[url] = True
+                            event, data = None, []
+                        elif line.startswith(":"):
+                            self.synced[url] = True
+                        else:
+                            field, _, value = line.partition(":")
+                            value = value[1:] if value.startswith(" ") else value
+                            if field == "event":
+                                event = value
+                            elif field == "data":
+                                data.append(value)
+                            elif field == "id":
+                                last_event_id = value
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.info(f"Invalidation feed from {url} interrupted: {e}")
+            self.connected[url] = False
+            self.synced[url] = False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, FEED_MAX_BACKOFF)
+
+    def _dispatch(self, event, data):
+        if event == "reset":
+            self.cache.expire()
+            return
+        for book_id, version in json.loads(data):
+            if self.versions.observe(book_id, version):
+                self.cache.invalidate(("info", book_id))
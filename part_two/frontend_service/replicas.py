@@ -0,0 +1,159 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+import admission
+import http_client
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 2.0))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 0.5))
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', 3))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 5.0))
+EWMA_ALPHA = 0.3
+# Latency charged for a failed call, so a replica that fails fast does not look fast
+FAILURE_PENALTY = 1.0
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.ewma = None          # smoothed latency in seconds
+        self.outstanding = 0      # requests currently in flight
+        self.failures = 0         # consecutive failures
+        self.open_until = 0.0     # circuit is open (replica skipped) until then
+        self.healthy = True       # result of the last active health check
+
+    def available(self, now):
+        return self.healthy and self.open_until <= now
+
+    def score(self):
+        # Expected wait: latency times the queue we would join
+        return (self.ewma or 0.0) * (self.outstanding + 1)
+
+
+class ReplicaSet:
+    """
+    Picks a replica for each upstream call based on load and health.
+
+    Selection uses the power of two choices: two random available replicas are
+    compared and the one with the lower EWMA latency x outstanding requests wins.
+    A replica is unavailable while its last health check failed or while its
+    circuit is open, which happens after CIRCUIT_FAILURES consecutive failed
+    calls and lasts CIRCUIT_OPEN_SECONDS; after that one trial call decides.
+    If no replica is available, all of them are tried anyway.
+    """
+
+    def __init__(self, name, urls, health_path="/health"):
+        self.name = name
+        self.replicas = [Replica(url) for url in urls]
+        self.health_path = health_path
+        self._lock = threading.Lock()
+
+    def ranked(self):
+        """
+        Returns the replicas in the order they should be tried.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [r for r in self.replicas if r.available(now)] or list(self.replicas)
+            if len(candidates) > 1:
+                a, b = random.sample(candidates, 2)
+                first = a if a.score() <= b.score() else b
+            else:
+                first = candidates[0]
+        rest = sorted((r for r in self.replicas if r is not first),
+                      key=lambda r: (not r.available(now), r.score()))
+        return [first] + rest
+
+    def request(self, method, path, idempotent=True, **kwargs):
+        """
+        Sends the request to the best replica, failing over to the next ones.
+
+        Idempotent calls fail over on any error or 5xx response. Other calls only
+        fail over when the connection could not be made, so they are never sent
+        twice. Raises the last error if every replica failed. Calls for a client request
+        hold a slot of the admission limit named after the set (see admission.py).
+        """
+        with admission.limit(self.name):
+            return self._request(method, path, idempotent, **kwargs)
+
+    def _request(self, method, path, idempotent, **kwargs):
+        error = None
+        resp = None
+        for replica in self.ranked():
+            with self._lock:
+                replica.outstanding += 1
+            start = time.monotonic()
+            try:
+                resp = http_client.request(method, f"{replica.url}{path}", retry=False, **kwargs)
+            except http_client.DeadlineExceeded:
+                # Not the replica's fault: the client stopped waiting
+                raise
+            except requests.exceptions.RequestException as e:
+                self._record(replica, time.monotonic() - start, ok=False)
+                error = e
+                if idempotent or isinstance(e, requests.exceptions.ConnectionError):
+                    continue
+                raise
+            finally:
+                with self._lock:
+                    replica.outstanding -= 1
+            # A non-idempotent call's 5xx usually reports a failure further
+            # downstream (e.g. the catalog), not of this replica
+            ok = resp.status_code < 500 or not idempotent
+            self._record(replica, time.monotonic() - start, ok)
+            if ok:
+                return resp
+        if resp is not None:
+            return resp
+        raise error
+
+    def _record(self, replica, elapsed, ok):
+        sample = elapsed if ok else max(elapsed, FAILURE_PENALTY)
+        with self._lock:
+            replica.ewma = sample if replica.ewma is None else (
+                EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * replica.ewma)
+            if ok:
+                replica.failures = 0
+                return
+            replica.failures += 1
+            if replica.failures >= CIRCUIT_FAILURES:
+                if replica.open_until <= time.monotonic():
+                    logging.warning(f"Opening circuit for {self.name} replica {replica.url}")
+                replica.open_until = time.monotonic() + CIRCUIT_OPEN_SECONDS
+
+    def start_health_checks(self, interval=HEALTH_CHECK_INTERVAL):
+        threading.Thread(target=self._health_loop, args=(interval,), daemon=True).start()
+
+    def _health_loop(self, interval):
+        while True:
+            for replica in self.replicas:
+                try:
+                    resp = http_client.get(f"{replica.url}{self.health_path}",
+                                           timeout=HEALTH_CHECK_TIMEOUT, retry=False)
+                    healthy = resp.status_code == 200
+                except requests.exceptions.RequestException:
+                    healthy = False
+                with self._lock:
+                    if healthy and not replica.healthy:
+                        # Back up: give it a clean slate
+                        replica.failures = 0
+                        replica.open_until = 0.0
+                    replica.healthy = healthy
+            time.sleep(interval)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "url": r.url,
+                "healthy": r.healthy,
+                "circuit_open": r.open_until > now,
+                "ewma_ms": round(r.ewma * 1000, 2) if r.ewma is not None else None,
+                "outstanding": r.outstanding,
+                "consecutive_failures": r.failures,
+            } for r in self.replicas]
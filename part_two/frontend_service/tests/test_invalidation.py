@@ -0,0 +1,29 @@
+from invalidation import InvalidationListener, VersionTracker
+
+
+class FakeCache:
+    def __init__(self):
+        self.invalidated = []
+        self.expired = 0
+
+    def invalidate(self, key):
+        self.invalidated.append(key)
+
+    def expire(self):
+        self.expired += 1
+
+
+def test_only_newer_versions_evict():
+    cache, versions = FakeCache(), VersionTracker()
+    listener = InvalidationListener(['http://catalog'], cache, versions)
+    listener._dispatch(None, '[[1, 3], [2, 1]]')
+    # Replicas publish the same versions; old and repeated ones change nothing
+    listener._dispatch(None, '[[1, 3], [1, 2], [2, 2]]')
+    assert cache.invalidated == [('info', 1), ('info', 2), ('info', 2)]
+    assert versions.latest(1) == 3 and versions.is_stale(2, 1)
+
+
+def test_reset_expires_the_whole_cache():
+    cache = FakeCache()
+    InvalidationListener(['http://catalog'], cache, VersionTracker())._dispatch('reset', '[]')
+    assert cache.expired == 1 and cache.invalidated == []
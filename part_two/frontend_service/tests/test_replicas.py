@@ -0,0 +1,113 @@
+import pytest
+import requests
+
+import http_client
+import replicas
+from replicas import ReplicaSet
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Upstreams:
+    """
+    Replicas answering with the statuses (or raising the exceptions) queued for them, 200 by
+    default; records the replicas called, in order.
+    """
+
+    def __init__(self, monkeypatch):
+        self.answers = {}
+        self.calls = []
+        monkeypatch.setattr(replicas.http_client, 'request', self.request)
+
+    def request(self, method, url, **kwargs):
+        replica = url.split('/')[2]
+        self.calls.append(replica)
+        answers = self.answers.get(replica)
+        answer = answers.pop(0) if answers else 200
+        if isinstance(answer, Exception):
+            raise answer
+        return FakeResponse(answer)
+
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    return Upstreams(monkeypatch)
+
+
+def make_set(*names):
+    return ReplicaSet('catalog', [f'http://{name}' for name in names])
+
+
+def replica(replica_set, name):
+    return next(r for r in replica_set.replicas if r.url == f'http://{name}')
+
+
+def test_least_loaded_replica_is_picked(upstreams):
+    replica_set = make_set('a', 'b')
+    replica(replica_set, 'a').ewma = 0.5
+    replica(replica_set, 'b').ewma = 0.01
+    for _ in range(10):
+        replica_set.request('GET', '/info/1')
+    assert upstreams.calls == ['b'] * 10
+    # Queued requests count too: none in flight at 500 ms beat 60 at 10 ms
+    replica(replica_set, 'b').ewma = 0.01
+    replica(replica_set, 'b').outstanding = 60
+    assert replica_set.ranked()[0].url == 'http://a'
+
+
+def test_unhealthy_replica_is_tried_last(upstreams):
+    replica_set = make_set('a', 'b', 'c')
+    replica(replica_set, 'b').healthy = False
+    for _ in range(10):
+        assert replica_set.ranked()[-1].url == 'http://b'
+
+
+def test_idempotent_call_fails_over(upstreams):
+    replica_set = make_set('a', 'b')
+    replica(replica_set, 'b').ewma = 1
+    upstreams.answers = {'a': [503]}
+    assert replica_set.request('GET', '/info/1').status_code == 200
+    assert upstreams.calls == ['a', 'b']
+    assert replica(replica_set, 'a').failures == 1
+
+
+def test_other_calls_are_not_sent_twice(upstreams):
+    replica_set = make_set('a', 'b')
+    replica(replica_set, 'b').ewma = 1
+    upstreams.answers = {'a': [503, requests.exceptions.ReadTimeout()]}
+    # A 5xx is passed on: the purchase may have failed further downstream
+    assert replica_set.request('POST', '/purchase/1', idempotent=False).status_code == 503
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        replica_set.request('POST', '/purchase/1', idempotent=False)
+    assert upstreams.calls == ['a', 'a']
+    # ... unless it never reached the replica
+    upstreams.answers = {'a': [requests.exceptions.ConnectionError()]}
+    assert replica_set.request('POST', '/purchase/1', idempotent=False).status_code == 200
+    assert upstreams.calls[2:] == ['a', 'b']
+
+
+def test_circuit_opens_after_consecutive_failures(upstreams, monkeypatch):
+    monkeypatch.setattr(replicas, 'CIRCUIT_FAILURES', 2)
+    replica_set = make_set('a', 'b')
+    replica(replica_set, 'a').ewma = 1
+    replica(replica_set, 'b').ewma = 0.001
+    upstreams.answers = {'b': [requests.exceptions.ConnectionError()] * 2}
+    replica_set.request('GET', '/info/1')
+    replica_set.request('GET', '/info/1')
+    assert upstreams.calls == ['b', 'a', 'b', 'a']
+    # 'b' is skipped while its circuit is open, although it had been the fastest
+    replica_set.request('GET', '/info/1')
+    assert upstreams.calls[4:] == ['a']
+    assert [r['circuit_open'] for r in replica_set.stats()] == [False, True]
+
+
+def test_deadline_is_not_a_replica_failure(upstreams):
+    replica_set = make_set('a', 'b')
+    upstreams.answers = {'a': [http_client.DeadlineExceeded()], 'b': [http_client.DeadlineExceeded()]}
+    with pytest.raises(http_client.DeadlineExceeded):
+        replica_set.request('GET', '/info/1')
+    assert len(upstreams.calls) == 1
+    assert all(r.failures == 0 for r in replica_set.replicas)
@@ -1,48 +1,139 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
+import os
 import requests
-from database import init_db, buy_book
+import http_client
+import metrics
+import tracing
+from database import init_db, order_statement, sync_orders, DATABASE
+from group_commit import GroupCommit
+from outbox import Outbox
+from sharding import MISDIRECTED, ShardRouter
 
 app = Flask(__name__)
-
-# ✅ Initialize orders database on startup (for EVERY replica)
-init_db(service_type='order')
-
-FRONTEND = "http://frontend_service:5000"
+metrics.instrument_flask(app)
+tracing.instrument_flask(app)
+# Calls to the catalog use no more than the time the frontend's client still waits
+http_client.instrument_flask(app)
 
 # Order replica (for order replication)
-ORDER_REPLICA = "http://order_service_2:5001"
+ORDER_REPLICA = os.environ.get("ORDER_REPLICA", "http://order_service_2:5001")
 
 # Catalog replicas (for stock update + replication)
-CATALOG_REPLICA_1 = "http://catalog_service_1:5000"
-CATALOG_REPLICA_2 = "http://catalog_service_2:5000"
+CATALOG_REPLICA_1 = os.environ.get("CATALOG_REPLICA_1", "http://catalog_service_1:5000")
+CATALOG_REPLICA_2 = os.environ.get("CATALOG_REPLICA_2", "http://catalog_service_2:5000")
+
+# Stock updates go to the primary (first replica) of the shard group owning the
+# book; without CATALOG_SHARDS the two replicas above are the only group
+catalog_shards = ShardRouter([CATALOG_REPLICA_1, CATALOG_REPLICA_2])
+
+
+def send_syncs(target, entries):
+    http_client.post(f"{target}/sync", json={"origin": outbox.origin, "entries": entries}).raise_for_status()
+
+
+# Order replication is delivered in the background
+outbox = Outbox(DATABASE, {"sync": send_syncs})
+
+# Orders of concurrent requests are written in shared transactions
+writer = GroupCommit(DATABASE)
+
+# Replication backlog, read from the shared database by whichever process serves /metrics
+metrics.callback("outbox_pending_entries", "Undelivered outbox entries per target.",
+                 ("target",), lambda: {(target,): n for target, n in outbox.pending().items()},
+                 scope="global")
+
+
+def setup():
+    """
+    One-time initialisation (schema and migrations), before any worker starts
+    """
+    # ✅ Initialize orders database on startup (for EVERY replica)
+    init_db(service_type='order')
+    outbox.init_db()
+
+
+def start_worker_tasks():
+    """
+    Background work every serving process needs: each routes by its own copy of the shard map
+    """
+    catalog_shards.start()
+
+
+def start_background_tasks():
+    """
+    Background work that must run in exactly one process
+    """
+    outbox.start([ORDER_REPLICA])
 
 
 @app.route("/purchase/<int:book_id>", methods=["POST"])
 def purchase(book_id):
-    # 1. Invalidate cache
-    requests.post(f"{FRONTEND}/invalidate/{book_id}")
-
-    # 2. Record order
-    buy_book(book_id)
+    # 1. Update catalog (primary of the book's shard group ONLY)
+    # Catalog service will handle cache invalidation and replication internally
+    def update(shard):
+        return http_client.post(f"{catalog_shards.map.group(shard)[0]}/update/{book_id}")
 
-    # 3. Update catalog (replica 1 ONLY)
-    # Catalog service will handle replication internally
-    requests.post(f"{CATALOG_REPLICA_1}/update/{book_id}")
+    try:
+        resp = catalog_shards.route(book_id, update)
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "Catalog service unreachable"}), 503
+    if resp.status_code == MISDIRECTED:
+        return jsonify({"error": "Book is being moved to another shard group, try again"}), 503
+    if resp.status_code != 200:
+        return jsonify({"error": "Catalog update failed"}), resp.status_code
 
-    # 4. Replicate order
-    requests.post(f"{ORDER_REPLICA}/sync/{book_id}")
+    # 2. Record order and queue its replication in one transaction
+    # (shared with concurrent purchases; returns once it has committed)
+    writer.execute(order_statement(book_id), outbox.statement(ORDER_REPLICA, "sync", book_id))
+    outbox.notify()
 
     return jsonify({"status": "purchased"})
 
 
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify({"status": "ok"})
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Metrics of every worker process, in the Prometheus text format
+    """
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 @app.route("/sync/<int:book_id>", methods=["POST"])
 def sync(book_id):
     """
     Order replication endpoint
     """
-    buy_book(book_id)
+    writer.execute(order_statement(book_id))
     return jsonify({"status": "replica synced"})
 
 
+@app.route("/sync", methods=["POST"])
+def sync_batch():
+    """
+    Batched order replication endpoint: one order per entry of another replica's outbox,
+    {"origin": <outbox origin>, "entries": [[outbox_id, book_id], ...]}; entries that were
+    already applied are skipped
+    """
+    data = request.get_json(silent=True)
+    origin = data.get("origin") if isinstance(data, dict) else None
+    entries = data.get("entries") if isinstance(data, dict) else None
+    if (not isinstance(origin, str) or not origin or not isinstance(entries, list) or not entries
+            or not all(isinstance(entry, list) and len(entry) == 2
+                       and all(isinstance(i, int) and not isinstance(i, bool) for i in entry)
+                       for entry in entries)):
+        return jsonify({"error": "expected an origin and a non-empty list of [outbox_id, book_id] entries"}), 400
+    count = sync_orders(origin, entries)
+    return jsonify({"status": "replica synced", "count": count})
+
+
 if __name__ == "__main__":
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
+    setup()
+    start_worker_tasks()
+    start_background_tasks()
     app.run(host="0.0.0.0", port=5001)
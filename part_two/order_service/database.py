@@ -1,16 +1,21 @@
 import sqlite3
 import os
+from contextlib import closing
 import logging
+import db_pool
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
+DATABASE = os.environ.get('DATABASE', 'orders.db')
+
 def init_db(service_type='order'):
     """
     Initializes the orders database.
     """
-    DATABASE = os.environ.get('DATABASE', 'orders.db')
     try:
-        with sqlite3.connect(DATABASE) as conn:
+        # Closed before gunicorn forks its workers: a connection the workers inherit
+        # keeps the WAL files of a database they no longer share with anybody else
+        with closing(sqlite3.connect(DATABASE)) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS orders (
@@ -20,20 +25,58 @@ def init_db(service_type='order'):
                     timestamp TEXT
                 )
             ''')
+            # The last outbox entry applied from every other replica (see sync_orders())
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS synced_orders (
+                    origin TEXT PRIMARY KEY,
+                    last_id INTEGER NOT NULL
+                )
+            ''')
             conn.commit()
             logging.info("Orders database initialized successfully.")
     except sqlite3.Error as e:
         logging.error(f"Failed to initialize database: {e}")
 
-def buy_book(book_id, quantity=1):
+def order_statement(book_id, quantity=1):
+    """
+    Returns the (sql, params) that inserts a purchase record, for batched writers.
+    """
+    return (
+        "INSERT INTO orders (item_id, quantity, timestamp) VALUES (?, ?, datetime('now'))",
+        (book_id, quantity)
+    )
+
+def buy_book(book_id, quantity=1, conn=None):
     """
     Inserts a purchase record into the orders table.
+    Runs inside the caller's transaction when a connection is given.
+    """
+    if conn is None:
+        with db_pool.connection(DATABASE) as conn:
+            return buy_book(book_id, quantity, conn)
+    conn.execute(*order_statement(book_id, quantity))
+
+def sync_orders(origin, entries):
     """
-    DATABASE = os.environ.get('DATABASE', 'orders.db')
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO orders (item_id, quantity, timestamp) VALUES (?, ?, datetime('now'))",
-            (book_id, quantity)
+    Inserts one purchase record per [outbox_id, book_id] entry another replica's outbox sent,
+    in a single transaction. Outbox ids only grow per origin, so entries up to the last one
+    applied from it are skipped: a delivery that is retried does not add orders twice.
+    Returns the number of orders inserted.
+    """
+    with db_pool.connection(DATABASE) as conn:
+        # Take the write lock up front, so a retry that overlaps the original cannot pass the check too
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT last_id FROM synced_orders WHERE origin = ?", (origin,)).fetchone()
+        last_id = row[0] if row else 0
+        new = [(book_id,) for outbox_id, book_id in entries if outbox_id > last_id]
+        if not new:
+            return 0
+        conn.executemany(
+            "INSERT INTO orders (item_id, quantity, timestamp) VALUES (?, 1, datetime('now'))", new
+        )
+        conn.execute(
+            "INSERT INTO synced_orders (origin, last_id) VALUES (?, ?) "
+            "ON CONFLICT(origin) DO UPDATE SET last_id = excluded.last_id",
+            (origin, max(outbox_id for outbox_id, _ in entries))
         )
-        conn.commit()
+    return len(new)
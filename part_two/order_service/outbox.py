@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+import db_pool
+import tracing
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 100))
+# Entries committed by other worker processes cannot wake a worker, so it also polls
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 0.2))
+OUTBOX_MAX_BACKOFF = float(os.environ.get('OUTBOX_MAX_BACKOFF', 10.0))
+
+
+class Outbox:
+    """
+    Durable queue of calls to other services (cache invalidations, replica syncs).
+
+    Entries are rows of the 'outbox' table, written in the same transaction as the
+    local change they describe, so a request can return as soon as it commits.
+    One background worker per target delivers that target's entries in order,
+    batching consecutive entries of the same kind into a single call and retrying
+    with exponential backoff while the target is down. Delivery is at-least-once:
+    an entry is only deleted after its target acknowledged it.
+
+    'senders' maps an entry kind to a function(target, entries) that performs the
+    call for [[id, book_id], ...] and raises on failure. Entry ids only grow, and
+    'origin' identifies this outbox (a new database gets a new one), so a receiver
+    can skip entries it already applied instead of applying a retry twice. Any
+    process may enqueue entries, but only the one that called start() delivers them.
+    """
+
+    def __init__(self, database, senders):
+        self.database = database
+        self.senders = senders
+        self._wakeups = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._origin = None
+
+    def init_db(self):
+        with db_pool.connection(self.database) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    book_id INTEGER NOT NULL,
+                    created TEXT DEFAULT (datetime('now'))
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_target ON outbox(target, id)')
+            conn.execute('CREATE TABLE IF NOT EXISTS outbox_meta (origin TEXT NOT NULL)')
+            if conn.execute('SELECT COUNT(*) FROM outbox_meta').fetchone()[0] == 0:
+                conn.execute('INSERT INTO outbox_meta (origin) VALUES (?)', (uuid.uuid4().hex,))
+
+    @property
+    def origin(self):
+        if self._origin is None:
+            with db_pool.connection(self.database) as conn:
+                self._origin = conn.execute('SELECT origin FROM outbox_meta').fetchone()[0]
+        return self._origin
+
+    def start(self, targets=()):
+        """
+        Starts delivery in this process: a worker for each of 'targets' and for every
+        target that still has undelivered entries.
+        """
+        self._running = True
+        with db_pool.connection(self.database) as conn:
+            pending = [row[0] for row in conn.execute('SELECT DISTINCT target FROM outbox')]
+        for target in set(targets) | set(pending):
+            self._worker(target)
+
+    def enqueue(self, conn, target, kind, book_id):
+        """
+        Adds an entry using the caller's connection (i.e. inside its transaction).
+
+        Call notify() once the transaction has committed.
+        """
+        conn.execute(*self.statement(target, kind, book_id))
+
+    def statement(self, target, kind, book_id):
+        """
+        Returns the (sql, params) that adds an entry, for callers that batch their
+        writes (see group_commit.py).
+
+        Call notify() once it has committed.
+        """
+        if self._running:
+            self._worker(target)
+        return (
+            'INSERT INTO outbox (target, kind, book_id) VALUES (?, ?, ?)',
+            (target, kind, book_id)
+        )
+
+    def notify(self):
+        """
+        Wakes every worker so newly committed entries are sent right away.
+        """
+        for wakeup in list(self._wakeups.values()):
+            wakeup.set()
+
+    def pending(self):
+        """
+        Returns the number of undelivered entries per target.
+        """
+        with db_pool.connection(self.database) as conn:
+            return dict(conn.execute('SELECT target, COUNT(*) FROM outbox GROUP BY target'))
+
+    def _worker(self, target):
+        if target in self._wakeups:
+            return
+        with self._lock:
+            if target in self._wakeups:
+                return
+            wakeup = self._wakeups[target] = threading.Event()
+        threading.Thread(target=self._run, args=(target, wakeup), daemon=True).start()
+
+    def _next_batch(self, target):
+        with db_pool.connection(self.database) as conn:
+            rows = conn.execute(
+                'SELECT id, kind, book_id FROM outbox WHERE target = ? ORDER BY id LIMIT ?',
+                (target, OUTBOX_BATCH_SIZE)
+            ).fetchall()
+        # Only the leading run of one kind is sent together, which preserves ordering
+        batch = []
+        for row in rows:
+            if row[1] != rows[0][1]:
+                break
+            batch.append(row)
+        return batch
+
+    def _run(self, target, wakeup):
+        backoff = 0.1
+        while True:
+            try:
+                batch = self._next_batch(target)
+                if not batch:
+                    wakeup.wait(OUTBOX_POLL_INTERVAL)
+                    wakeup.clear()
+                    continue
+                kind = batch[0][1]
+                # Deliveries happen after the requests that enqueued them: each is a trace of its own
+                with tracing.trace(f"outbox {kind}", target=target, entries=len(batch)):
+                    self.senders[kind](target, [[row[0], row[2]] for row in batch])
+                    with db_pool.connection(self.database) as conn:
+                        conn.executemany('DELETE FROM outbox WHERE id = ?', [(row[0],) for row in batch])
+                backoff = 0.1
+            except Exception as e:
+                logging.warning(f"Outbox delivery to {target} failed, retrying in {backoff:.1f}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, OUTBOX_MAX_BACKOFF)
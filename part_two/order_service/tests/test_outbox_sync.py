@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+import app as order
+import database
+import db_pool
+import outbox as outbox_module
+from outbox import Outbox
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'orders.db')
+    monkeypatch.setattr(database, 'DATABASE', path)
+    database.init_db()
+    return path
+
+
+def orders(db):
+    with db_pool.connection(db) as conn:
+        return [row[0] for row in conn.execute('SELECT item_id FROM orders ORDER BY order_id')]
+
+
+def sync(client, origin, entries):
+    return client.post('/sync', json={'origin': origin, 'entries': entries})
+
+
+def test_repeated_entries_are_applied_once(db):
+    client = order.app.test_client()
+    assert sync(client, 'a', [[1, 5], [2, 6]]).get_json()['count'] == 2
+    # A retry after a lost acknowledgement, now with a newer entry as well
+    assert sync(client, 'a', [[1, 5], [2, 6], [3, 7]]).get_json()['count'] == 1
+    assert sync(client, 'a', [[3, 7]]).get_json()['count'] == 0
+    # Outbox ids are per origin
+    assert sync(client, 'b', [[1, 5]]).get_json()['count'] == 1
+    assert orders(db) == [5, 6, 7, 5]
+
+
+@pytest.mark.parametrize('payload', [
+    None, [], {'ids': [1, 2]}, {'origin': 'a', 'entries': []}, {'entries': [[1, 5]]},
+    {'origin': 'a', 'entries': [[1, True]]}, {'origin': 'a', 'entries': [1, 5]},
+    {'origin': 'a', 'entries': [[1, 5, 6]]},
+])
+def test_malformed_syncs_are_rejected(db, payload):
+    assert order.app.test_client().post('/sync', json=payload).status_code == 400
+    assert orders(db) == []
+
+
+def test_outbox_retry_does_not_duplicate_orders(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox_module, 'OUTBOX_POLL_INTERVAL', 0.01)
+    client = order.app.test_client()
+    attempts = []
+    delivered = threading.Event()
+
+    def send_syncs(target, entries):
+        attempts.append(entries)
+        assert sync(client, sender.origin, entries).status_code == 200
+        if len(attempts) == 1:
+            # The receiver applied the entries, but the acknowledgement was lost
+            raise ConnectionError('connection reset')
+        delivered.set()
+
+    sender = Outbox(str(tmp_path / 'sender.db'), {'sync': send_syncs})
+    sender.init_db()
+    with db_pool.connection(sender.database) as conn:
+        for book_id in (3, 4):
+            sender.enqueue(conn, 'replica', 'sync', book_id)
+    monkeypatch.setattr(outbox_module, 'OUTBOX_MAX_BACKOFF', 0.01)
+    sender.start()
+    assert delivered.wait(5)
+    assert attempts[0] == attempts[1] == [[1, 3], [2, 4]]
+    assert orders(db) == [3, 4]